@@ -1,39 +1,179 @@
-import boto3, json, csv
+import boto3, functools, json, csv, os, sys, threading
+import backup_db
+import compact_report
+import idc_clients
+import idc_metrics
+import json_stream
+import policy_store
+import restore_index
+import snapshot_store
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 DEFAULT_REGION = "eu-west-1"
+# Regions searched for IdC instances; every organization and account instance found
+# is exported, in parallel
+INSTANCE_REGIONS = [DEFAULT_REGION]
+# Number of instances exported in parallel
+INSTANCE_WORKERS = 4
+# Number of accounts whose assignments are exported in parallel, per instance (1 = serial)
+EXPORT_WORKERS = 16
+# How account assignments are discovered:
+#   "account"        -> account -> provisioned permission sets -> assignments
+#   "permission-set" -> permission set -> provisioned accounts -> assignments
+#   "auto"           -> whichever needs fewer listing calls
+ASSIGNMENT_PLAN = "auto"
+# Keep a content-hashed snapshot store in <output>/snapshots and only fetch and
+# write the entities whose fingerprint changed since the previous run
+INCREMENTAL_BACKUP = False
+# Account assignment requests made up to this many minutes before the previous
+# snapshot are also checked for changed accounts, for the requests that were
+# still running while it was taken
+SNAPSHOT_CHANGE_MARGIN_MINUTES = 30
+# Write OldApplications.jsonl, one application per line, instead of OldApplications.json
+JSON_LINES = False
+# Write OldIdentityStoreReport.idc.gz, the assignments as dictionary tables and
+# integer-coded rows streamed to a gzip file, instead of OldIdentityStoreReport.csv
+COMPACT_REPORT = False
+# Also build OldBackup.sqlite, the indexed database queried by backup_db.py
+QUERY_DATABASE = False
+# Export only the account assignments of one shard of the organization, into
+# <output>/shards/<shard>, for export_shards.py to merge: an account ID range
+# such as "100000000000-499999999999", or an OU or root ID such as "ou-ab12-cd34"
+# for the accounts of that OU and its child OUs. ACCOUNT_WIDE_SHARD exports the
+# rest once: users, groups, group memberships, permission sets and applications.
+# Also read from the command line
+SHARD = None
+ACCOUNT_WIDE_SHARD = "account-wide"
+# Principal ID -> name maps written by the ACCOUNT_WIDE_SHARD, for merging the
+# rows of the account assignment shards
+PRINCIPALS_FILE = "Principals.json"
 
 session = boto3.Session(
     aws_access_key_id="",
     aws_secret_access_key="",
 )
 
-idstoreclient = session.client("identitystore", region_name=DEFAULT_REGION)
-ssoadminclient = session.client("sso-admin", region_name=DEFAULT_REGION)
-orgsclient = session.client("organizations")
+# The organizations client and its account listing are shared by every instance
+orgsclient = idc_clients.create_client(session, "organizations", workers=EXPORT_WORKERS)
 
-users = {}
-groups = {}
-permissionSets = {}
-permissionSetsData = {}
 Accounts = {}
-applications = []
+# The sso-admin operations of the account assignment crawl
+ASSIGNMENT_OPERATIONS = {
+    "ListPermissionSetsProvisionedToAccount",
+    "ListAccountsForProvisionedPermissionSet",
+    "ListAccountAssignments",
+}
+apiCallsLock = threading.Lock()
 
-Instances = (ssoadminclient.list_instances()).get("Instances")
-InstanceARN = Instances[0].get("InstanceArn")
-IdentityStoreId = Instances[0].get("IdentityStoreId")
 
+def CountAPICall(apiCalls, model, **kwargs):
+    """
+    Count every sso-admin API call of an instance in its 'APICalls' counter.
+
+    Registered as a botocore event handler, so it runs on the export worker threads.
+    """
+    with apiCallsLock:
+        apiCalls[model.name] += 1
+
+
+def DiscoverInstances():
+    """
+    Find every IdC instance in INSTANCE_REGIONS and prepare its export state.
+
+    Each instance gets its own clients, its own maps of users, groups, permission
+    sets and applications, and its own output directory: 'output' when a single
+    instance is found, as before, or 'output/<instance ID>' otherwise.
+
+    Returns:
+        list: One dictionary per instance, passed to every export function.
+    """
+    found = {}
+    for region in INSTANCE_REGIONS:
+        regionClient = idc_clients.create_client(session, "sso-admin", region)
+        ListInstances = regionClient.list_instances()
+        ListOfInstances = ListInstances["Instances"]
+        while "NextToken" in ListInstances.keys():
+            ListInstances = regionClient.list_instances(
+                NextToken=ListInstances["NextToken"]
+            )
+            ListOfInstances.extend(ListInstances["Instances"])
+        for eachInstance in ListOfInstances:
+            # Instance ARNs carry no region, keep the first region an instance is seen in
+            found.setdefault(eachInstance["InstanceArn"], (region, eachInstance))
+
+    ListOfInstances = []
+    for instanceArn, (region, eachInstance) in found.items():
+        instanceId = instanceArn.split("/")[-1]
+        outputDir = "output" if len(found) == 1 else os.path.join("output", instanceId)
+        if SHARD:
+            outputDir = os.path.join(outputDir, "shards", SHARD)
+        os.makedirs(outputDir, exist_ok=True)
+        # Clients are shared by the export workers, see idc_clients for the rate limiting
+        Instance = {
+            "Id": instanceId,
+            "InstanceArn": instanceArn,
+            "IdentityStoreId": eachInstance.get("IdentityStoreId"),
+            "Region": region,
+            "OutputDir": outputDir,
+            "LogPrefix": "" if len(found) == 1 else f"[{instanceId}] ",
+            "IdentityStoreClient": idc_clients.create_client(
+                session, "identitystore", region, workers=EXPORT_WORKERS
+            ),
+            # Shared by the account assignment and the application workers
+            "SSOAdminClient": idc_clients.create_client(
+                session, "sso-admin", region, workers=2 * EXPORT_WORKERS
+            ),
+            "Users": {},
+            "Groups": {},
+            "GroupMemberships": {},
+            "PermissionSets": {},
+            "PermissionSetsData": {},
+            "Applications": [],
+            "Entries": [],
+            "APICalls": Counter(),
+            "Store": (
+                snapshot_store.SnapshotStore(os.path.join(outputDir, "snapshots"))
+                if INCREMENTAL_BACKUP
+                else None
+            ),
+            "PolicyStore": policy_store.PolicyStore(outputDir),
+            # With INCREMENTAL_BACKUP, see GetChangedAccounts
+            "ChangedAccounts": None,
+        }
+        Instance["SSOAdminClient"].meta.events.register(
+            "before-parameter-build.sso-admin",
+            functools.partial(CountAPICall, Instance["APICalls"]),
+        )
+        print(f"Found instance {instanceArn} in {region} -> '{outputDir}'")
+        ListOfInstances.append(Instance)
+    return ListOfInstances
 
-def mapUserIDs():
+
+def IsAssignmentShard():
+    """
+    Whether this run exports the account assignments of one shard only. Its rows
+    hold permission set ARNs and principal IDs, which export_shards.py turns into
+    names with the maps of the ACCOUNT_WIDE_SHARD export.
+    """
+    return bool(SHARD) and SHARD != ACCOUNT_WIDE_SHARD
+
+
+def mapUserIDs(Instance):
     """
     Create a dictionary mapping User IDs to usernames.
 
     This function retrieves all users from the AWS Identity Store and creates
     a dictionary where the key is the User ID and the value is the username.
-    The result is stored in the global 'users' dictionary.
+    The result is stored in the 'Users' dictionary of the instance.
 
     Note:
         This function uses pagination to handle large numbers of users.
     """
+    idstoreclient = Instance["IdentityStoreClient"]
+    IdentityStoreId = Instance["IdentityStoreId"]
+    users = Instance["Users"]
     ListUsers = idstoreclient.list_users(IdentityStoreId=IdentityStoreId)
     ListOfUsers = ListUsers["Users"]
     while "NextToken" in ListUsers.keys():
@@ -45,17 +185,20 @@ def mapUserIDs():
         users.update({eachUser.get("UserId"): eachUser.get("UserName")})
 
 
-def mapGroupIDs():
+def mapGroupIDs(Instance):
     """
     Create a dictionary mapping Group IDs to display names.
 
     This function retrieves all groups from the AWS Identity Store and creates
     a dictionary where the key is the Group ID and the value is the display name.
-    The result is stored in the global 'groups' dictionary.
+    The result is stored in the 'Groups' dictionary of the instance.
 
     Note:
         This function uses pagination to handle large numbers of groups.
     """
+    idstoreclient = Instance["IdentityStoreClient"]
+    IdentityStoreId = Instance["IdentityStoreId"]
+    groups = Instance["Groups"]
     ListGroups = idstoreclient.list_groups(IdentityStoreId=IdentityStoreId)
     ListOfGroups = ListGroups["Groups"]
     while "NextToken" in ListGroups.keys():
@@ -67,6 +210,72 @@ def mapGroupIDs():
         groups.update({eachGroup.get("GroupId"): eachGroup.get("DisplayName")})
 
 
+def ListGroupMembers(Instance, GroupID):
+    """
+    Retrieve the user IDs of the members of a group.
+
+    Args:
+        Instance (dict): The instance being exported, from DiscoverInstances.
+        GroupID (str): The ID of the group.
+
+    Returns:
+        list: The user IDs of the group members.
+
+    Note:
+        This function uses pagination to handle large groups.
+    """
+    idstoreclient = Instance["IdentityStoreClient"]
+    IdentityStoreId = Instance["IdentityStoreId"]
+    GroupMemberships = idstoreclient.list_group_memberships(
+        IdentityStoreId=IdentityStoreId, GroupId=GroupID
+    )
+    ListOfMemberships = GroupMemberships["GroupMemberships"]
+    while "NextToken" in GroupMemberships.keys():
+        GroupMemberships = idstoreclient.list_group_memberships(
+            IdentityStoreId=IdentityStoreId,
+            GroupId=GroupID,
+            NextToken=GroupMemberships["NextToken"],
+        )
+        ListOfMemberships.extend(GroupMemberships["GroupMemberships"])
+    return [
+        eachMembership["MemberId"]["UserId"]
+        for eachMembership in ListOfMemberships
+        if "UserId" in eachMembership.get("MemberId", {})
+    ]
+
+
+def mapGroupMemberships(Instance):
+    """
+    Create a dictionary mapping group display names to the user names of their members.
+
+    The memberships of EXPORT_WORKERS groups are listed in parallel, so large
+    directories are not read one group at a time. The result is stored in the
+    'GroupMemberships' dictionary of the instance, in the order of 'Groups'.
+
+    Note:
+        Must run after mapUserIDs and mapGroupIDs. Members missing from the user
+        listing are left out.
+    """
+    users = Instance["Users"]
+    groups = Instance["Groups"]
+    groupMemberships = Instance["GroupMemberships"]
+    ListOfGroupIDs = list(groups.keys())
+    with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+        for groupID, memberIDs in zip(
+            ListOfGroupIDs,
+            executor.map(
+                lambda groupID: ListGroupMembers(Instance, groupID), ListOfGroupIDs
+            ),
+        ):
+            groupMemberships.update(
+                {
+                    groups[groupID]: [
+                        users[memberID] for memberID in memberIDs if memberID in users
+                    ]
+                }
+            )
+
+
 def GetDescription(permissionSet):
     """
     Retrieve the description of a permission set.
@@ -80,68 +289,190 @@ def GetDescription(permissionSet):
     return permissionSet.get("Description") if "Description" in permissionSet else ""
 
 
-def mapPermissionSetIDs():
+def ListAllPages(operation, key, **kwargs):
+    """
+    Call a paginated API operation until its last page.
+
+    Returns:
+        list: The items under 'key' of every page.
+    """
+    response = operation(**kwargs)
+    items = response[key]
+    while "NextToken" in response:
+        response = operation(NextToken=response["NextToken"], **kwargs)
+        items.extend(response[key])
+    return items
+
+
+def GetInlinePolicy(Instance, PermissionSetArn):
+    """
+    Returns:
+        str: The inline policy document of a permission set, or None without one.
+    """
+    InlinePolicy = Instance["SSOAdminClient"].get_inline_policy_for_permission_set(
+        InstanceArn=Instance["InstanceArn"], PermissionSetArn=PermissionSetArn
+    )
+    return InlinePolicy.get("InlinePolicy") or None
+
+
+def GetPermissionsBoundary(Instance, PermissionSetArn):
+    """
+    Returns:
+        dict: The permissions boundary of a permission set, a managed policy ARN or
+        a customer managed policy reference, or None without one.
+    """
+    ssoadminclient = Instance["SSOAdminClient"]
+    try:
+        return ssoadminclient.get_permissions_boundary_for_permission_set(
+            InstanceArn=Instance["InstanceArn"], PermissionSetArn=PermissionSetArn
+        ).get("PermissionsBoundary")
+    except ssoadminclient.exceptions.ResourceNotFoundException:
+        return None
+
+
+def ExportPermissionSet(Instance, DetailsExecutor, PermissionSetArn):
+    """
+    Describe one permission set and fetch everything attached to it, run by the
+    permission set workers.
+
+    The managed and customer managed policies, the inline policy, the permissions
+    boundary and the tags are fetched at the same time on DetailsExecutor. The
+    inline policy document goes to the instance's policy store and only its hash
+    is kept (see policy_store).
+
+    Everything is fetched even with INCREMENTAL_BACKUP: the describe output does
+    not change when a policy, the boundary or a tag does, so it cannot tell
+    whether the previous snapshot is still right. The whole permission set is the
+    fingerprint instead, and the snapshot store only writes it when it changed.
+
+    Returns:
+        tuple: (the describe_permission_set details, the permission set data).
+    """
+    ssoadminclient = Instance["SSOAdminClient"]
+    InstanceARN = Instance["InstanceArn"]
+    store = Instance["Store"]
+    permissionSetDetails = ssoadminclient.describe_permission_set(
+        InstanceArn=InstanceARN, PermissionSetArn=PermissionSetArn
+    )["PermissionSet"]
+
+    managedPolicies = DetailsExecutor.submit(
+        ListAllPages,
+        ssoadminclient.list_managed_policies_in_permission_set,
+        "AttachedManagedPolicies",
+        InstanceArn=InstanceARN,
+        PermissionSetArn=PermissionSetArn,
+    )
+    customerManagedPolicies = DetailsExecutor.submit(
+        ListAllPages,
+        ssoadminclient.list_customer_managed_policy_references_in_permission_set,
+        "CustomerManagedPolicyReferences",
+        InstanceArn=InstanceARN,
+        PermissionSetArn=PermissionSetArn,
+    )
+    inlinePolicy = DetailsExecutor.submit(GetInlinePolicy, Instance, PermissionSetArn)
+    permissionsBoundary = DetailsExecutor.submit(
+        GetPermissionsBoundary, Instance, PermissionSetArn
+    )
+    tags = DetailsExecutor.submit(
+        ListAllPages,
+        ssoadminclient.list_tags_for_resource,
+        "Tags",
+        InstanceArn=InstanceARN,
+        ResourceArn=PermissionSetArn,
+    )
+
+    inlineDocument = inlinePolicy.result()
+    permissionSet = {
+        "Id": PermissionSetArn.split("/")[-1],
+        "Description": GetDescription(permissionSet=permissionSetDetails),
+        "PermissionSetArn": permissionSetDetails.get("PermissionSetArn"),
+        "SessionDuration": permissionSetDetails.get("SessionDuration"),
+        "RelayState": permissionSetDetails.get("RelayState"),
+        "ManagedPolicies": managedPolicies.result(),
+        "CustomerManagedPolicies": customerManagedPolicies.result(),
+        "InlinePolicyHash": (
+            Instance["PolicyStore"].put(inlineDocument) if inlineDocument else None
+        ),
+        "PermissionsBoundary": permissionsBoundary.result(),
+        "Tags": tags.result(),
+    }
+    if store:
+        content = {"Name": permissionSetDetails["Name"], "Data": permissionSet}
+        store.Put(snapshot_store.PERMISSION_SET, PermissionSetArn, content, content)
+    return permissionSetDetails, permissionSet
+
+
+def mapPermissionSetArns(Instance):
+    """
+    List the permission set ARNs only, for an account assignment shard: the
+    permission sets are described and exported once, by the ACCOUNT_WIDE_SHARD.
+
+    The 'PermissionSets' dictionary of the instance maps each ARN to itself, so the
+    report rows of the shard hold ARNs.
+    """
+    permissionSets = Instance["PermissionSets"]
+    for PermissionSetArn in ListAllPages(
+        Instance["SSOAdminClient"].list_permission_sets,
+        "PermissionSets",
+        InstanceArn=Instance["InstanceArn"],
+    ):
+        permissionSets.update({PermissionSetArn: PermissionSetArn})
+
+
+def mapPermissionSetIDs(Instance):
     """
     Create dictionaries mapping permission set ARNs to names and detailed information.
 
     This function retrieves all permission sets from AWS SSO, and for each:
-    1. Creates a mapping of permission set ARNs to names in the global 'permissionSets' dictionary.
-    2. Creates a detailed information dictionary in the global 'permissionSetsData' dictionary.
+    1. Creates a mapping of permission set ARNs to names in the instance's 'PermissionSets' dictionary.
+    2. Creates a detailed information dictionary in the instance's 'PermissionSetsData' dictionary.
 
     The detailed information includes:
     - ID
     - Description
     - Permission Set ARN
+    - Session duration and relay state
     - Managed Policies
     - Customer Managed Policies
+    - The hash of the inline policy in the policy store ('<output>/policies')
+    - Permissions boundary
+    - Tags
 
     Note:
-        This function uses pagination to handle large numbers of permission sets.
-        TODO: Implement pagination for managed policies and customer managed policies.
+        EXPORT_WORKERS permission sets are exported in parallel, see
+        ExportPermissionSet.
     """
-    ListPermissionSets = ssoadminclient.list_permission_sets(InstanceArn=InstanceARN)
-    ListOfPermissionSets = ListPermissionSets["PermissionSets"]
-    while "NextToken" in ListPermissionSets.keys():
-        ListPermissionSets = ssoadminclient.list_permission_sets(
-            InstanceArn=InstanceARN, NextToken=ListPermissionSets["NextToken"]
-        )
-        ListOfPermissionSets.extend(ListPermissionSets["PermissionSets"])
-    for eachPermissionSet in ListOfPermissionSets:
-        permissionSetDescription = ssoadminclient.describe_permission_set(
-            InstanceArn=InstanceARN, PermissionSetArn=eachPermissionSet
-        )
-        permissionSetDetails = permissionSetDescription.get("PermissionSet")
-
-        # Get Managed policies --> TODO: Deal with pagination
-        managedPolicies = ssoadminclient.list_managed_policies_in_permission_set(
-            InstanceArn=InstanceARN, PermissionSetArn=eachPermissionSet
-        )
-
-        # Get Customer Managed Policies --> TODO: Deal with pagination
-        customerManagedPolicies = (
-            ssoadminclient.list_customer_managed_policy_references_in_permission_set(
-                InstanceArn=InstanceARN, PermissionSetArn=eachPermissionSet
-            )
-        )
-
-        permissionSet = {
-            "Id": eachPermissionSet.split("/")[-1],
-            "Description": GetDescription(permissionSet=permissionSetDetails),
-            "PermissionSetArn": permissionSetDetails.get("PermissionSetArn"),
-            "ManagedPolicies": managedPolicies.get("AttachedManagedPolicies"),
-            "CustomerManagedPolicies": customerManagedPolicies.get(
-                "CustomerManagedPolicyReferences"
+    ssoadminclient = Instance["SSOAdminClient"]
+    permissionSets = Instance["PermissionSets"]
+    permissionSetsData = Instance["PermissionSetsData"]
+    policies = Instance["PolicyStore"]
+    ListOfPermissionSets = ListAllPages(
+        ssoadminclient.list_permission_sets,
+        "PermissionSets",
+        InstanceArn=Instance["InstanceArn"],
+    )
+    with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor, ThreadPoolExecutor(
+        max_workers=EXPORT_WORKERS
+    ) as DetailsExecutor:
+        # map() keeps the order of list_permission_sets in OldPermissionSets.json
+        for permissionSetDetails, permissionSet in executor.map(
+            lambda PermissionSetArn: ExportPermissionSet(
+                Instance, DetailsExecutor, PermissionSetArn
             ),
-        }
-        permissionSetsData.update({permissionSetDetails["Name"]: permissionSet})
-
-        permissionSets.update(
-            {
-                permissionSetDetails.get("PermissionSetArn"): permissionSetDetails.get(
-                    "Name"
-                )
-            }
-        )
+            ListOfPermissionSets,
+        ):
+            permissionSets.update(
+                {
+                    permissionSetDetails.get("PermissionSetArn"): permissionSetDetails.get(
+                        "Name"
+                    )
+                }
+            )
+            permissionSetsData.update({permissionSetDetails["Name"]: permissionSet})
+    print(
+        f"{Instance['LogPrefix']}Inline policies: {policies.written} documents written, "
+        f"{policies.unchanged} already in '{policies.path}'"
+    )
 
 
 def ListAccountsInOrganization():
@@ -165,11 +496,52 @@ def ListAccountsInOrganization():
         Accounts.update({eachAccount.get("Id"): eachAccount.get("Name")})
 
 
-def GetPermissionSetsProvisionedToAccount(AccountID):
+def ListAccountsInShard():
+    """
+    Store in 'Accounts' only the accounts of SHARD.
+
+    An OU shard is listed with list_accounts_for_parent, walking down its child
+    OUs; an account ID range is taken from the full organization listing. The
+    ACCOUNT_WIDE_SHARD has no accounts.
+    """
+    if SHARD == ACCOUNT_WIDE_SHARD:
+        return
+    if SHARD.startswith(("ou-", "r-")):
+        parents = [SHARD]
+        while parents:
+            parent = parents.pop()
+            AccountsList = orgsclient.list_accounts_for_parent(ParentId=parent)
+            ListOfAccounts = AccountsList["Accounts"]
+            while "NextToken" in AccountsList.keys():
+                AccountsList = orgsclient.list_accounts_for_parent(
+                    ParentId=parent, NextToken=AccountsList["NextToken"]
+                )
+                ListOfAccounts.extend(AccountsList["Accounts"])
+            for eachAccount in ListOfAccounts:
+                Accounts.update({eachAccount.get("Id"): eachAccount.get("Name")})
+            UnitsList = orgsclient.list_organizational_units_for_parent(ParentId=parent)
+            ListOfUnits = UnitsList["OrganizationalUnits"]
+            while "NextToken" in UnitsList.keys():
+                UnitsList = orgsclient.list_organizational_units_for_parent(
+                    ParentId=parent, NextToken=UnitsList["NextToken"]
+                )
+                ListOfUnits.extend(UnitsList["OrganizationalUnits"])
+            parents.extend(unit["Id"] for unit in ListOfUnits)
+        return
+    firstAccountID, lastAccountID = SHARD.split("-")
+    ListAccountsInOrganization()
+    for AccountID in list(Accounts):
+        # Account IDs are 12 digits, so they compare as strings
+        if not firstAccountID <= AccountID <= lastAccountID:
+            del Accounts[AccountID]
+
+
+def GetPermissionSetsProvisionedToAccount(Instance, AccountID):
     """
     Retrieve the list of permission sets provisioned to a specific AWS account.
 
     Args:
+        Instance (dict): The instance being exported, from DiscoverInstances.
         AccountID (str): The ID of the AWS account to check.
 
     Returns:
@@ -178,6 +550,8 @@ def GetPermissionSetsProvisionedToAccount(AccountID):
     Note:
         This function uses pagination to handle large numbers of permission sets.
     """
+    ssoadminclient = Instance["SSOAdminClient"]
+    InstanceARN = Instance["InstanceArn"]
     ListOfPermissionSetsProvisionedToAccount = []
     PermissionSetsProvisionedToAccount = (
         ssoadminclient.list_permission_sets_provisioned_to_account(
@@ -204,7 +578,7 @@ def GetPermissionSetsProvisionedToAccount(AccountID):
         return ListOfPermissionSetsProvisionedToAccount
 
 
-def ListAccountAssignments(AccountID):
+def ListAccountAssignments(Instance, AccountID, PermissionSetsList=None):
     """
     Retrieve all permission set assignments for a specific AWS account.
 
@@ -212,7 +586,10 @@ def ListAccountAssignments(AccountID):
     retrieves the assignments (user or group) for each permission set.
 
     Args:
+        Instance (dict): The instance being exported, from DiscoverInstances.
         AccountID (str): The ID of the AWS account to check.
+        PermissionSetsList (list, optional): Permission set ARNs already known to be
+            provisioned to the account. If omitted they are listed from the account.
 
     Returns:
         list: A list of dictionaries, each containing details of an assignment.
@@ -220,7 +597,10 @@ def ListAccountAssignments(AccountID):
     Note:
         This function uses pagination to handle large numbers of assignments.
     """
-    PermissionSetsList = GetPermissionSetsProvisionedToAccount(AccountID)
+    ssoadminclient = Instance["SSOAdminClient"]
+    InstanceARN = Instance["InstanceArn"]
+    if PermissionSetsList is None:
+        PermissionSetsList = GetPermissionSetsProvisionedToAccount(Instance, AccountID)
     Assignments = []
     for permissionSet in PermissionSetsList:
         AccountAssignments = ssoadminclient.list_account_assignments(
@@ -228,7 +608,7 @@ def ListAccountAssignments(AccountID):
         )
         Assignments.extend(AccountAssignments["AccountAssignments"])
         while "NextToken" in AccountAssignments.keys():
-            AccountAssignments = ssoadminclient.list_aaccount_assignments(
+            AccountAssignments = ssoadminclient.list_account_assignments(
                 InstanceArn=InstanceARN,
                 AccountId=AccountID,
                 PermissionSetArn=permissionSet,
@@ -238,10 +618,340 @@ def ListAccountAssignments(AccountID):
     return Assignments
 
 
-def ListApplications():
+def GetAccountsForProvisionedPermissionSet(Instance, PermissionSetArn):
+    """
+    Retrieve the list of accounts a specific permission set is provisioned to.
+
+    Args:
+        Instance (dict): The instance being exported, from DiscoverInstances.
+        PermissionSetArn (str): The ARN of the permission set to check.
+
+    Returns:
+        list: A list of account IDs the permission set is provisioned to.
+
+    Note:
+        This function uses pagination to handle large numbers of accounts.
+    """
+    ssoadminclient = Instance["SSOAdminClient"]
+    InstanceARN = Instance["InstanceArn"]
+    AccountsForPermissionSet = (
+        ssoadminclient.list_accounts_for_provisioned_permission_set(
+            InstanceArn=InstanceARN, PermissionSetArn=PermissionSetArn
+        )
+    )
+    ListOfAccountIDs = AccountsForPermissionSet["AccountIds"]
+    while "NextToken" in AccountsForPermissionSet.keys():
+        AccountsForPermissionSet = (
+            ssoadminclient.list_accounts_for_provisioned_permission_set(
+                InstanceArn=InstanceARN,
+                PermissionSetArn=PermissionSetArn,
+                NextToken=AccountsForPermissionSet["NextToken"],
+            )
+        )
+        ListOfAccountIDs.extend(AccountsForPermissionSet["AccountIds"])
+    return ListOfAccountIDs
+
+
+def MapPermissionSetsByAccount(Instance):
+    """
+    Build the permission sets provisioned to each account, walking permission sets.
+
+    This is the "permission-set" plan: one listing per permission set instead of one
+    per account. Permission sets keep the order of the instance's 'PermissionSets'
+    dictionary so the report order does not depend on thread scheduling.
+
+    A permission set whose listing fails is reported and the export goes on. As
+    any account may be missing that permission set, every account then discovers
+    its own permission sets, as with the "account" plan.
+
+    Returns:
+        dict: Account ID -> list of permission set ARNs provisioned to it, or None
+        when a listing failed. Only accounts of the organization are included.
+    """
+    permissionSets = Instance["PermissionSets"]
+    ListOfPermissionSetArns = list(permissionSets.keys())
+    PermissionSetsByAccount = {eachAccountID: [] for eachAccountID in Accounts}
+
+    def GetAccounts(PermissionSetArn):
+        try:
+            return GetAccountsForProvisionedPermissionSet(Instance, PermissionSetArn)
+        except Exception as e:
+            print(
+                Instance["LogPrefix"]
+                + "Error in Permission Set: "
+                + str(permissionSets.get(PermissionSetArn))
+                + " "
+                + str(e)
+            )
+            return None
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+        for permissionSetArn, accountIDs in zip(
+            ListOfPermissionSetArns, executor.map(GetAccounts, ListOfPermissionSetArns)
+        ):
+            if accountIDs is None:
+                failed += 1
+                continue
+            for eachAccountID in accountIDs:
+                if eachAccountID in PermissionSetsByAccount:
+                    PermissionSetsByAccount[eachAccountID].append(permissionSetArn)
+    if failed:
+        print(
+            f"{Instance['LogPrefix']}{failed} permission sets could not be listed, "
+            "falling back to listing the permission sets of each account"
+        )
+        return None
+    return PermissionSetsByAccount
+
+
+def ChooseAssignmentPlan(Instance):
+    """
+    Pick the traversal used to discover account assignments.
+
+    Both plans end with one list_account_assignments call per provisioned
+    (account, permission set) pair; they only differ in how those pairs are
+    listed: one call per account, or one call per permission set. Both counts are
+    already known from ListAccountsInOrganization and mapPermissionSetIDs.
+
+    Returns:
+        str: "account" or "permission-set".
+    """
+    permissionSets = Instance["PermissionSets"]
+    if not permissionSets:
+        # Account instances have no permission sets, so no account assignments either
+        return "permission-set"
+    print(
+        f"{Instance['LogPrefix']}Planned listing calls: {len(Accounts)} for the 'account' plan, "
+        f"{len(permissionSets)} for the 'permission-set' plan "
+        "(plus one list_account_assignments call per provisioned pair in both)"
+    )
+    if ASSIGNMENT_PLAN != "auto":
+        return ASSIGNMENT_PLAN
+    return "permission-set" if len(permissionSets) < len(Accounts) else "account"
+
+
+def GetChangedAccounts(Instance):
+    """
+    Find the accounts whose assignments may have changed since the previous snapshot.
+
+    Every account assignment is created or deleted through an asynchronous
+    request, and the instance lists these requests newest first. The requests made
+    since the previous snapshot, less SNAPSHOT_CHANGE_MARGIN_MINUTES, are described
+    to get their target accounts: a few calls when few assignments changed,
+    instead of listing the assignments of every account.
+
+    Returns:
+        set: The IDs of the accounts with assignment requests since the previous
+        snapshot, or None when there is no previous snapshot or the requests
+        could not be listed, in which case no account is kept.
+    """
+    ssoadminclient = Instance["SSOAdminClient"]
+    InstanceARN = Instance["InstanceArn"]
+    store = Instance["Store"]
+    if store is None or store.previous is None:
+        return None
+    since = datetime.fromisoformat(store.previous["CreatedAt"]) - timedelta(
+        minutes=SNAPSHOT_CHANGE_MARGIN_MINUTES
+    )
+    requests = [
+        (
+            ssoadminclient.list_account_assignment_creation_status,
+            "AccountAssignmentsCreationStatus",
+            ssoadminclient.describe_account_assignment_creation_status,
+            "AccountAssignmentCreationRequestId",
+            "AccountAssignmentCreationStatus",
+        ),
+        (
+            ssoadminclient.list_account_assignment_deletion_status,
+            "AccountAssignmentsDeletionStatus",
+            ssoadminclient.describe_account_assignment_deletion_status,
+            "AccountAssignmentDeletionRequestId",
+            "AccountAssignmentDeletionStatus",
+        ),
+    ]
+    ChangedAccounts = set()
+    try:
+        for listRequests, listKey, describeRequest, requestIdKey, statusKey in requests:
+            RequestIDs = []
+            kwargs = {"InstanceArn": InstanceARN}
+            while True:
+                response = listRequests(**kwargs)
+                statuses = response[listKey]
+                RequestIDs.extend(
+                    status["RequestId"] for status in statuses if status["CreatedDate"] >= since
+                )
+                if (
+                    "NextToken" not in response
+                    or not statuses
+                    or statuses[-1]["CreatedDate"] < since
+                ):
+                    break
+                kwargs["NextToken"] = response["NextToken"]
+            with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+                ChangedAccounts.update(
+                    executor.map(
+                        lambda RequestID: describeRequest(
+                            InstanceArn=InstanceARN, **{requestIdKey: RequestID}
+                        )[statusKey]["TargetId"],
+                        RequestIDs,
+                    )
+                )
+    except Exception as e:
+        print(
+            Instance["LogPrefix"]
+            + "Error listing the account assignment requests, every account is listed again: "
+            + str(e)
+        )
+        return None
+    print(
+        f"{Instance['LogPrefix']}{len(ChangedAccounts)} accounts with assignment changes "
+        "since the previous snapshot"
+    )
+    return ChangedAccounts
+
+
+def GetAccountEntries(Instance, AccountID, PermissionSetsList=None):
+    """
+    Build the report rows for every assignment in a specific AWS account.
+
+    This function is run concurrently by GenerateFiles, one call per account.
+
+    Args:
+        Instance (dict): The instance being exported, from DiscoverInstances.
+        AccountID (str): The ID of the AWS account to check.
+        PermissionSetsList (list, optional): Permission set ARNs provisioned to the
+            account, when already discovered by the "permission-set" plan.
+
+    Returns:
+        list: A list of rows (Account ID, Account Name, Permission Set,
+        Principal Type, Principal), or an empty list if the account fails.
+
+    Note:
+        With INCREMENTAL_BACKUP the rows are also stored in the snapshot store, and
+        accounts whose name and provisioned permission sets are unchanged, and
+        with no assignment request since the previous snapshot (see
+        GetChangedAccounts), are kept from it without listing their assignments.
+    """
+    users = Instance["Users"]
+    groups = Instance["Groups"]
+    permissionSets = Instance["PermissionSets"]
+    store = Instance["Store"]
+    entries = []
+    try:
+        if store:
+            if PermissionSetsList is None:
+                PermissionSetsList = GetPermissionSetsProvisionedToAccount(Instance, AccountID)
+            fingerprint = [Accounts.get(AccountID), PermissionSetsList]
+            ChangedAccounts = Instance["ChangedAccounts"]
+            if (
+                ChangedAccounts is not None
+                and AccountID not in ChangedAccounts
+                and store.IsFresh(snapshot_store.ACCOUNT_ASSIGNMENTS, AccountID, fingerprint)
+            ):
+                store.Keep(snapshot_store.ACCOUNT_ASSIGNMENTS, AccountID)
+                return []
+        GetAccountAssignments = ListAccountAssignments(
+            Instance, AccountID, PermissionSetsList
+        )
+        for eachAssignment in GetAccountAssignments:
+            entry = []
+            entry.append(eachAssignment.get("AccountId"))
+            entry.append(Accounts.get(eachAssignment.get("AccountId")))
+            entry.append(permissionSets.get(eachAssignment.get("PermissionSetArn")))
+            entry.append(eachAssignment.get("PrincipalType"))
+            if IsAssignmentShard():
+                # Named by export_shards.py from the ACCOUNT_WIDE_SHARD export
+                entry.append(eachAssignment.get("PrincipalId"))
+            elif eachAssignment.get("PrincipalType") == "GROUP":
+                entry.append(groups.get(eachAssignment.get("PrincipalId")))
+            else:
+                entry.append(users.get(eachAssignment.get("PrincipalId")))
+            entries.append(entry)
+        if store:
+            store.Put(
+                snapshot_store.ACCOUNT_ASSIGNMENTS, AccountID, fingerprint, entries
+            )
+    except Exception as e:
+        print(Instance["LogPrefix"] + "Error in Account ID: " + AccountID + " " + str(e))
+        if store:
+            # Keep the last good backup of the account rather than dropping it
+            store.Keep(snapshot_store.ACCOUNT_ASSIGNMENTS, AccountID)
+        return []
+    return entries
+
+
+def GetApplicationDetails(Instance, AppARN):
+    AppDetails = Instance["SSOAdminClient"].describe_application(ApplicationArn=AppARN)
+    AppDetails.pop("ResponseMetadata", None)
+    # Substitute datetime by string
+    AppDetails["CreatedDate"] = AppDetails["CreatedDate"].strftime("%Y-%m-%d %H:%M:%S")
+    return AppDetails
+
+
+def GetApplicationAssignmentConfiguration(Instance, AppARN):
+    AppAssignment = Instance["SSOAdminClient"].get_application_assignment_configuration(
+        ApplicationArn=AppARN
+    )
+    AppAssignment.pop("ResponseMetadata", None)
+    return AppAssignment
+
+
+def GetApplicationAuthenticationMethod(Instance, AppARN):
+    """
+    Retrieve the IAM authentication method of an application.
+
+    Returns:
+        dict: {"AuthenticationMethodType": "IAM", "AuthenticationMethod": ...}, or an
+        empty dictionary if the application has none.
+    """
+    try:
+        AppAuthMethod = Instance["SSOAdminClient"].get_application_authentication_method(
+            ApplicationArn=AppARN, AuthenticationMethodType="IAM"
+        )
+    except:
+        return {}
+    return {
+        "AuthenticationMethodType": "IAM",
+        "AuthenticationMethod": AppAuthMethod["AuthenticationMethod"],
+    }
+
+
+def ListApplicationAssignments(Instance, AppARN):
+    ssoadminclient = Instance["SSOAdminClient"]
+    AppAssignments = []
+    assignments = ssoadminclient.list_application_assignments(ApplicationArn=AppARN)
+    AppAssignments.extend(assignments["ApplicationAssignments"])
+
+    # Handle pagination for assignments
+    while "NextToken" in assignments:
+        assignments = ssoadminclient.list_application_assignments(
+            ApplicationArn=AppARN, NextToken=assignments["NextToken"]
+        )
+        AppAssignments.extend(assignments["ApplicationAssignments"])
+    return AppAssignments
+
+
+def ListApplications(Instance):
     """
     Create a report of all the applications configured in IdC.
+
+    The four lookups of every application (details, assignment configuration,
+    authentication method and assignments) are submitted at once for all the
+    applications, and run EXPORT_WORKERS at a time. The report keeps the order of
+    list_applications.
+
+    Everything is fetched even with INCREMENTAL_BACKUP: the list_applications
+    entry does not change when an assignment, the assignment configuration or the
+    authentication method does. The whole exported application is the fingerprint
+    instead, and the snapshot store only writes it when it changed.
     """
+    ssoadminclient = Instance["SSOAdminClient"]
+    InstanceARN = Instance["InstanceArn"]
+    users = Instance["Users"]
+    groups = Instance["Groups"]
+    applications = Instance["Applications"]
+    store = Instance["Store"]
     ListOfApplications = []
     Applications = ssoadminclient.list_applications(InstanceArn=InstanceARN)
     ListOfApplications.extend(Applications["Applications"])
@@ -250,60 +960,46 @@ def ListApplications():
             InstanceArn=InstanceARN, NextToken=Applications["NextToken"]
         )
         ListOfApplications.extend(Applications["Applications"])
-    # For each app add scope, assignment and auth information
-    for app in ListOfApplications:
-        AppARN = app["ApplicationArn"]
-        # Get application details
-        AppDetails = ssoadminclient.describe_application(ApplicationArn=AppARN)
-        # Substitute datetime by string
-        AppDetails["CreatedDate"] = AppDetails["CreatedDate"].strftime(
-            "%Y-%m-%d %H:%M:%S"
-        )
-
-        # Get assignment configuration
-        AppAssignment = ssoadminclient.get_application_assignment_configuration(
-            ApplicationArn=AppARN
-        )
 
-        # Get authentication method configuration
-        try:
-            AppAuthMethod = ssoadminclient.get_application_authentication_method(
-                ApplicationArn=AppARN
+    # For each app add scope, assignment and auth information
+    with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+        lookups = []
+        for app in ListOfApplications:
+            AppARN = app["ApplicationArn"]
+            lookups.append(
+                (
+                    app,
+                    executor.submit(GetApplicationDetails, Instance, AppARN),
+                    executor.submit(GetApplicationAssignmentConfiguration, Instance, AppARN),
+                    executor.submit(GetApplicationAuthenticationMethod, Instance, AppARN),
+                    executor.submit(ListApplicationAssignments, Instance, AppARN),
+                )
             )
-        except:
-            AppAuthMethod = {}
-
-        # Get application assignments
-        AppAssignments = []
-        assignments = ssoadminclient.list_application_assignments(ApplicationArn=AppARN)
-        AppAssignments.extend(assignments["ApplicationAssignments"])
 
-        # Handle pagination for assignments
-        while "NextToken" in assignments:
-            assignments = ssoadminclient.list_application_assignments(
-                ApplicationArn=AppARN, NextToken=assignments["NextToken"]
-            )
-            AppAssignments.extend(assignments["ApplicationAssignments"])
-
-        # Build application configuration object
-        AppConfig = {
-            "ApplicationDetails": AppDetails,
-            "AssignmentConfiguration": AppAssignment,
-            "AuthenticationMethod": AppAuthMethod,
-            "Assignments": [
-                {
-                    "PrincipalId": assignment.get("PrincipalId"),
-                    "PrincipalType": assignment.get("PrincipalType"),
-                    "PrincipalName": (
-                        users.get(assignment.get("PrincipalId"))
-                        if assignment.get("PrincipalType") == "USER"
-                        else groups.get(assignment.get("PrincipalId"))
-                    ),
-                }
-                for assignment in AppAssignments
-            ],
-        }
-        applications.append(AppConfig)
+        for app, AppDetails, AppAssignment, AppAuthMethod, AppAssignments in lookups:
+            # Build application configuration object
+            AppConfig = {
+                "ApplicationDetails": AppDetails.result(),
+                "AssignmentConfiguration": AppAssignment.result(),
+                "AuthenticationMethod": AppAuthMethod.result(),
+                "Assignments": [
+                    {
+                        "PrincipalId": assignment.get("PrincipalId"),
+                        "PrincipalType": assignment.get("PrincipalType"),
+                        "PrincipalName": (
+                            users.get(assignment.get("PrincipalId"))
+                            if assignment.get("PrincipalType") == "USER"
+                            else groups.get(assignment.get("PrincipalId"))
+                        ),
+                    }
+                    for assignment in AppAssignments.result()
+                ],
+            }
+            applications.append(AppConfig)
+            if store:
+                store.Put(
+                    snapshot_store.APPLICATION, app["ApplicationArn"], AppConfig, AppConfig
+                )
 
 
 class SetEncoder(json.JSONEncoder):
@@ -320,15 +1016,50 @@ class SetEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-def GenerateFiles():
+def WriteSnapshot(Instance, ListOfAccountIDs):
+    """
+    Commit the snapshot store manifest and print what changed since the last run.
+
+    Args:
+        Instance (dict): The instance being exported, from DiscoverInstances.
+        ListOfAccountIDs (list): Account IDs in report order, so that materialized
+            reports keep the same row order as a full run.
+    """
+    store = Instance["Store"]
+    store.Reorder(snapshot_store.ACCOUNT_ASSIGNMENTS, ListOfAccountIDs)
+    manifestPath = store.Commit()
+    for kind, changes in store.Delta().items():
+        print(
+            f"{Instance['LogPrefix']}\t-> {kind}: {len(changes['Added'])} added, "
+            f"{len(changes['Changed'])} changed, {len(changes['Removed'])} removed"
+        )
+    print(
+        f"{Instance['LogPrefix']}Done! Snapshot manifest '{manifestPath}' "
+        f"({store.written} new objects)"
+    )
+    print(
+        f"Run 'python snapshot_store.py {Instance['OutputDir']}' to rebuild the report "
+        "files from it"
+    )
+
+
+def GenerateFiles(Instance, ApplicationsExport=None):
     """
     Generate CSV and JSON reports based on AWS IAM Identity Center (formerly AWS SSO) assignments.
 
     This function performs the following tasks:
-    1. Retrieves account assignments for each account in the organization.
-    2. Generates a CSV report ('OldIdentityStoreReport.csv') containing account assignments.
+    1. Retrieves account assignments for each account in the organization, using
+       EXPORT_WORKERS accounts in parallel and the plan chosen by ChooseAssignmentPlan.
+    2. Generates a CSV report ('OldIdentityStoreReport.csv') containing account assignments,
+       and its index by account, permission set and principal (see restore_index).
+       With COMPACT_REPORT, the compact 'OldIdentityStoreReport.idc.gz' is written
+       instead, as the accounts are listed (see compact_report).
     3. Creates a JSON file ('OldPermissionSets.json') with detailed permission set information.
     4. Creates a JSON file ('OldApps.json) with detailed application information.
+    5. Creates a JSON file ('OldGroupMemberships.json') mapping each group name to
+       the user names of its members.
+    6. With QUERY_DATABASE, builds the SQLite database of all these files (see
+       backup_db).
 
     The CSV report includes the following columns:
     - Account ID
@@ -341,8 +1072,10 @@ def GenerateFiles():
     - ID
     - Description
     - Permission Set ARN
+    - Session duration and relay state
     - Managed Policies
     - Customer Managed Policies
+    - Inline policy hash, permissions boundary and tags
 
     The application file contains detailed information about each application, including:
     - Application details
@@ -351,32 +1084,93 @@ def GenerateFiles():
     - Assignments (users and groups)
     ...
 
+    With INCREMENTAL_BACKUP, only the changed entities and a manifest are written to
+    the snapshot store instead (see WriteSnapshot).
+
+    Args:
+        Instance (dict): The instance being exported, from DiscoverInstances.
+        ApplicationsExport (Future, optional): ListApplications running in the
+            background, waited for once the account assignments are listed.
+
     Raises:
         Exception: If there's an error processing a specific account ID.
 
+    Files are written to the output directory of the instance, and the report rows
+    are also kept in its 'Entries' list (a compact_report.CompactReport with
+    COMPACT_REPORT).
+
     Note:
-        This function relies on several global variables and helper functions
-        that should be initialized and defined before calling this function.
+        This function relies on the global 'Accounts' listing and on the maps
+        filled in the instance by the earlier export functions.
     """
+    apiCalls = Instance["APICalls"]
+    store = Instance["Store"]
+    outputDir = Instance["OutputDir"]
     ListOfAccountIDs = list(Accounts.keys())
+    callsBefore = Counter(apiCalls)
+    plan = ChooseAssignmentPlan(Instance)
+    print(f"{Instance['LogPrefix']}Using the '{plan}' assignment plan")
+    PermissionSetsByAccount = None
+    if plan == "permission-set":
+        PermissionSetsByAccount = MapPermissionSetsByAccount(Instance)
+    if PermissionSetsByAccount is not None:
+        PermissionSetsLists = [PermissionSetsByAccount[a] for a in ListOfAccountIDs]
+    else:
+        PermissionSetsLists = [None] * len(ListOfAccountIDs)
+
+    if store:
+        Instance["ChangedAccounts"] = GetChangedAccounts(Instance)
+
+    reportPath = os.path.join(outputDir, "OldIdentityStoreReport.csv")
+    compactWriter = None
+    if COMPACT_REPORT and not store:
+        compactWriter = compact_report.CompactReportWriter(
+            compact_report.compact_path(reportPath)
+        )
     entries = []
-    for eachAccountID in ListOfAccountIDs:
-        try:
-            GetAccountAssignments = ListAccountAssignments(eachAccountID)
-            for eachAssignment in GetAccountAssignments:
-                entry = []
-                entry.append(eachAssignment.get("AccountId"))
-                entry.append(Accounts.get(eachAssignment.get("AccountId")))
-                entry.append(permissionSets.get(eachAssignment.get("PermissionSetArn")))
-                entry.append(eachAssignment.get("PrincipalType"))
-                if eachAssignment.get("PrincipalType") == "GROUP":
-                    entry.append(groups.get(eachAssignment.get("PrincipalId")))
-                else:
-                    entry.append(users.get(eachAssignment.get("PrincipalId")))
-                entries.append(entry)
-        except Exception as e:
-            print("Error in Account ID: " + eachAccountID + " " + str(e))
-            continue
+    with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+        # map() yields in submission order, so the report keeps the account order
+        for accountEntries in executor.map(
+            lambda AccountID, PermissionSetsList: GetAccountEntries(
+                Instance, AccountID, PermissionSetsList
+            ),
+            ListOfAccountIDs,
+            PermissionSetsLists,
+        ):
+            if compactWriter:
+                compactWriter.write_rows(accountEntries)
+            else:
+                entries.extend(accountEntries)
+    if compactWriter:
+        compactWriter.close()
+        Instance["Entries"] = compactWriter.report
+        print(f"Done! '{compactWriter.path}' report is generated successfully!")
+    else:
+        Instance["Entries"] = entries
+    callsMade = Counter(apiCalls)
+    callsMade.subtract(callsBefore)
+    if ApplicationsExport:
+        ApplicationsExport.result()
+    # Leave out the application calls made at the same time
+    callsMade = Counter(
+        {
+            operation: count
+            for operation, count in callsMade.items()
+            if operation in ASSIGNMENT_OPERATIONS
+        }
+    )
+    print(
+        f"{Instance['LogPrefix']}Actual API calls for account assignments: "
+        f"{sum(callsMade.values())}"
+    )
+    for operation, count in sorted(callsMade.items()):
+        if count:
+            print(f"{Instance['LogPrefix']}\t-> {operation}: {count}")
+
+    if store:
+        WriteGroupMemberships(Instance)
+        WriteSnapshot(Instance, ListOfAccountIDs)
+        return
 
     headers = [
         "Account ID",
@@ -386,25 +1180,143 @@ def GenerateFiles():
         "Principal",
     ]
 
-    with open("output/OldIdentityStoreReport.csv", "x") as report:
-        csvwriter = csv.writer(report)
-        csvwriter.writerow(headers)
-        csvwriter.writerows(entries)
-    print("Done! 'OldIdentityStoreReport.csv' report is generated successfully!")
+    if not compactWriter:
+        with open(reportPath, "w") as report:
+            csvwriter = csv.writer(report)
+            csvwriter.writerow(headers)
+            csvwriter.writerows(entries)
+        print(f"Done! '{reportPath}' report is generated successfully!")
+        if not IsAssignmentShard():
+            # Prebuilt for the selective restore of 6_idc_remap.py
+            restore_index.build_index(reportPath)
+
+    if IsAssignmentShard():
+        # The other files come from the ACCOUNT_WIDE_SHARD export, see export_shards.py
+        return
+    WriteAccountWideFiles(Instance)
+
+    if QUERY_DATABASE:
+        databasePath = backup_db.build_database(outputDir)
+        print(f"Done! '{databasePath}' has been generated successfully!")
+
+
+def WriteGroupMemberships(Instance):
+    # Memberships have no cheap fingerprint, they are written in full on every run
+    membershipsPath = os.path.join(Instance["OutputDir"], "OldGroupMemberships.json")
+    with open(membershipsPath, "w") as fp:
+        json.dump(Instance["GroupMemberships"], fp)
+    print(f"Done! '{membershipsPath}' has been generated successfully!")
+
+
+def WriteAccountWideFiles(Instance):
+    """
+    Write the backup files that do not depend on the accounts: the group
+    memberships, the permission sets and the applications. The ACCOUNT_WIDE_SHARD
+    also writes PRINCIPALS_FILE, the user and group names of the principal IDs.
+    """
+    outputDir = Instance["OutputDir"]
+    WriteGroupMemberships(Instance)
+
+    permissionSetsPath = os.path.join(outputDir, "OldPermissionSets.json")
+    with open(permissionSetsPath, "w") as fp:
+        json.dump(Instance["PermissionSetsData"], fp, cls=SetEncoder)
+    print(f"Done! '{permissionSetsPath}' has been generated successfully!")
+
+    if JSON_LINES:
+        applicationsPath = os.path.join(outputDir, "OldApplications.jsonl")
+        json_stream.write_json_lines(applicationsPath, Instance["Applications"])
+    else:
+        applicationsPath = os.path.join(outputDir, "OldApplications.json")
+        with open(applicationsPath, "w") as fp:
+            json.dump(Instance["Applications"], fp, cls=SetEncoder, indent=2)
+    print(f"Done! '{applicationsPath}' has been generated successfully!")
+
+    if SHARD == ACCOUNT_WIDE_SHARD:
+        principalsPath = os.path.join(outputDir, PRINCIPALS_FILE)
+        with open(principalsPath, "w") as fp:
+            json.dump({"USER": Instance["Users"], "GROUP": Instance["Groups"]}, fp)
+        print(f"Done! '{principalsPath}' has been generated successfully!")
 
-    with open("output/OldPermissionSets.json", "x") as fp:
-        json.dump(permissionSetsData, fp, cls=SetEncoder)
-    print("Done! 'OldPermissionSets.json' has been generated successfully!")
 
-    with open("output/OldApplications.json", "x") as fp:
-        json.dump(applications, fp, cls=SetEncoder, indent=2)
-    print("Done! 'OldApplications.json' has been generated successfully!")
+def RunPhase(phase, *args):
+    with idc_metrics.phase(phase.__name__):
+        return phase(*args)
+
+
+def ExportInstance(Instance, AccountsListing):
+    """
+    Run the whole export pipeline of one instance.
+
+    The identity store and permission sets of the instance are exported while the
+    shared organization account listing may still be running; the account
+    assignments wait for it. The applications are exported in the background,
+    at the same time as the account assignments.
+
+    The ACCOUNT_WIDE_SHARD exports everything but the account assignments, and
+    the other shards only list the permission set ARNs before their accounts.
+
+    Args:
+        Instance (dict): An instance from DiscoverInstances.
+        AccountsListing (Future): The ListAccountsInOrganization call.
+    """
+    if IsAssignmentShard():
+        RunPhase(mapPermissionSetArns, Instance)
+        AccountsListing.result()
+        RunPhase(GenerateFiles, Instance)
+        return
+    for phase in [mapUserIDs, mapGroupIDs, mapGroupMemberships, mapPermissionSetIDs]:
+        RunPhase(phase, Instance)
+    if SHARD == ACCOUNT_WIDE_SHARD:
+        RunPhase(ListApplications, Instance)
+        WriteAccountWideFiles(Instance)
+        return
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        ApplicationsExport = executor.submit(RunPhase, ListApplications, Instance)
+        AccountsListing.result()
+        RunPhase(GenerateFiles, Instance, ApplicationsExport)
+
+
+def ExportAllInstances(Instances=None):
+    """
+    Discover the instances and export them, INSTANCE_WORKERS at a time.
+
+    Args:
+        Instances (list, optional): Instances from DiscoverInstances to export
+            instead of every instance found.
+
+    Returns:
+        list: The exported instances, with their data in memory (see DiscoverInstances).
+
+    Raises:
+        SystemExit: If any instance failed to export.
+    """
+    if Instances is None:
+        Instances = RunPhase(DiscoverInstances)
+    with ThreadPoolExecutor(max_workers=INSTANCE_WORKERS + 1) as executor:
+        AccountsListing = executor.submit(
+            RunPhase, ListAccountsInShard if SHARD else ListAccountsInOrganization
+        )
+        exports = {
+            Instance["InstanceArn"]: executor.submit(
+                ExportInstance, Instance, AccountsListing
+            )
+            for Instance in Instances
+        }
+    failed = []
+    for instanceArn, export in exports.items():
+        if export.exception():
+            print(f"Error exporting instance {instanceArn}: {export.exception()}")
+            failed.append(instanceArn)
+    if failed:
+        raise SystemExit(f"{len(failed)} of {len(Instances)} instances failed to export")
+    return Instances
 
 
 # MAIN
-mapUserIDs()
-mapGroupIDs()
-ListAccountsInOrganization()
-mapPermissionSetIDs()
-ListApplications()
-GenerateFiles()
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        SHARD = sys.argv[1]
+    if SHARD and INCREMENTAL_BACKUP:
+        raise SystemExit("A shard is a full partial export, unset INCREMENTAL_BACKUP")
+    idc_metrics.enable(f"1_old_idc_report-{SHARD}" if SHARD else "1_old_idc_report")
+    ExportAllInstances()
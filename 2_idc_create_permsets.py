@@ -1,17 +1,52 @@
 import boto3
-import json
+import json, sys, time
+import compact_report
+import dead_letter
+import idc_clients
+import idc_metrics
+import operation_log
+import policy_store
+import request_status
+import restore_journal
+from concurrent.futures import ThreadPoolExecutor
 
 DEFAULT_REGION = "eu-west-1"
+# Permission sets created in parallel, each with all its policies (1 = serial)
+CREATE_WORKERS = 8
+# Provision every permission set to the accounts it is assigned to in the backup,
+# so 6_idc_remap.py does not trigger implicit provisioning one account at a time
+PROVISION_PERMISSION_SETS = True
+# Provisioning requests kept in flight at once, resolved in bulk with
+# list_permission_set_provisioning_status
+PROVISION_IN_FLIGHT = 50
+# Seconds between two bulk status polls of the in-flight provisioning requests
+STATUS_POLL_INTERVAL = 2
+# Seconds after which an unresolved provisioning request is described individually
+STATUS_TIMEOUT = 60
+# Seconds after which a provisioning request still unresolved is given up on,
+# reported as failed and dead-lettered
+STATUS_MAX_WAIT = 600
+# Failed creations and provisionings, retried at the end of the run or with
+# "python 2_idc_create_permsets.py replay"
+DEAD_LETTER_PATH = dead_letter.dead_letter_path("2_idc_create_permsets")
 
 session = boto3.Session(
     aws_access_key_id="",
     aws_secret_access_key="",
 )
 
-ssoadminclient = session.client(service_name="sso-admin", region_name=DEFAULT_REGION)
+ssoadminclient = idc_clients.create_client(
+    session, "sso-admin", DEFAULT_REGION, workers=CREATE_WORKERS
+)
+
+# Inline policy documents of OldPermissionSets.json, stored by hash (see policy_store)
+policyStore = policy_store.PolicyStore("output")
 
-Instances = (ssoadminclient.list_instances()).get("Instances")
-newIdCInstanceARN = Instances[0].get("InstanceArn")
+# Set from list_instances() when the script runs
+newIdCInstanceARN = None
+deadLetters = None
+# Every create is logged to operation_log.OPERATION_LOG_PATH, for rollback.py
+operationLog = None
 
 
 def getDescription(permissionSet):
@@ -30,78 +65,310 @@ class SetEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-# MAIN
-print("\n -------------------------------------- \n")
-with open("output/OldPermissionSets.json") as json_file:
-    permissionSets = json.load(json_file)
-    newPermissionSets = {}
+# Create an empty permission set, its policies are attached by attachPolicies.
+# Session duration, relay state and tags are only in the newer backups
+def createEmptyPermissionSet(permissionSetName, eachPermissionSet):
+    optional = {
+        key: eachPermissionSet[key]
+        for key in ["SessionDuration", "RelayState", "Tags"]
+        if eachPermissionSet.get(key)
+    }
+    newPermissionSet = ssoadminclient.create_permission_set(
+        InstanceArn=newIdCInstanceARN,
+        Name=permissionSetName,
+        Description=getDescription(permissionSet=eachPermissionSet),
+        **optional,
+    )
+    operationLog.record(
+        operation_log.PERMISSION_SET,
+        InstanceArn=newIdCInstanceARN,
+        PermissionSetArn=newPermissionSet["PermissionSet"]["PermissionSetArn"],
+        Name=permissionSetName,
+    )
+    return newPermissionSet["PermissionSet"]["PermissionSetArn"]
 
-    for permissionSetName, eachPermissionSet in permissionSets.items():
-        print(f" -> Creating permission set: {permissionSetName}")
 
+# Attach all the policies of a permission set, with its inline policy and permissions
+# boundary; policies already attached are kept
+def attachPolicies(permissionSetArn, eachPermissionSet):
+    managedPolicies, customerManagedPolicies = [], []
+
+    # Add Managed Policies
+    for eachManagedPolicy in eachPermissionSet["ManagedPolicies"]:
         try:
-            newPermissionSet = ssoadminclient.create_permission_set(
+            ssoadminclient.attach_managed_policy_to_permission_set(
                 InstanceArn=newIdCInstanceARN,
-                Name=permissionSetName,
-                Description=getDescription(permissionSet=eachPermissionSet),
+                PermissionSetArn=permissionSetArn,
+                ManagedPolicyArn=eachManagedPolicy["Arn"],
             )
-        except Exception as e:
-            print(f"(E!) -> Error creating permission set {permissionSetName}: {e}")
-            print("\n Skipping to the next permission set... \n")
-            continue
-
-        managedPolicies, customerManagedPolicies = [], []
+        except ssoadminclient.exceptions.ConflictException:
+            pass
+        managedPolicies.append(eachManagedPolicy)
+        print(f"\t-> Managed Policy {eachManagedPolicy['Name']} added")
 
+    # Add Customer Managed Policies
+    for eachCustomerManagedPolicy in eachPermissionSet["CustomerManagedPolicies"]:
         try:
-            # Add Managed Policies
-            for eachManagedPolicy in eachPermissionSet["ManagedPolicies"]:
-                managedPolicy = ssoadminclient.attach_managed_policy_to_permission_set(
-                    InstanceArn=newIdCInstanceARN,
-                    PermissionSetArn=newPermissionSet["PermissionSet"][
-                        "PermissionSetArn"
-                    ],
-                    ManagedPolicyArn=eachManagedPolicy["Arn"],
-                )
-                managedPolicies.append(eachManagedPolicy)
-                print(f"\t-> Managed Policy {eachManagedPolicy['Name']} added")
-
-            # Add Customer Managed Policies
-            for eachCustomerManagedPolicy in eachPermissionSet[
-                "CustomerManagedPolicies"
-            ]:
-                customerManagedPolicy = ssoadminclient.attach_customer_managed_policy_reference_to_permission_set(
-                    InstanceArn=newIdCInstanceARN,
-                    PermissionSetArn=newPermissionSet["PermissionSet"][
-                        "PermissionSetArn"
-                    ],
-                    CustomerManagedPolicyReference={
-                        "Name": eachCustomerManagedPolicy["Name"],
-                        "Path": eachCustomerManagedPolicy["Path"],
-                    },
+            ssoadminclient.attach_customer_managed_policy_reference_to_permission_set(
+                InstanceArn=newIdCInstanceARN,
+                PermissionSetArn=permissionSetArn,
+                CustomerManagedPolicyReference={
+                    "Name": eachCustomerManagedPolicy["Name"],
+                    "Path": eachCustomerManagedPolicy["Path"],
+                },
+            )
+        except ssoadminclient.exceptions.ConflictException:
+            pass
+        customerManagedPolicies.append(eachCustomerManagedPolicy)
+        print(f"\t-> Customer Managed Policy {eachCustomerManagedPolicy['Name']} added")
+
+    # Putting them again replaces them, so a replay can redo it
+    if eachPermissionSet.get("InlinePolicyHash"):
+        ssoadminclient.put_inline_policy_to_permission_set(
+            InstanceArn=newIdCInstanceARN,
+            PermissionSetArn=permissionSetArn,
+            InlinePolicy=policyStore.get(eachPermissionSet["InlinePolicyHash"]),
+        )
+        print("\t-> Inline Policy added")
+    if eachPermissionSet.get("PermissionsBoundary"):
+        ssoadminclient.put_permissions_boundary_to_permission_set(
+            InstanceArn=newIdCInstanceARN,
+            PermissionSetArn=permissionSetArn,
+            PermissionsBoundary=eachPermissionSet["PermissionsBoundary"],
+        )
+        print("\t-> Permissions Boundary added")
+
+    return {
+        "Description": getDescription(permissionSet=eachPermissionSet),
+        "PermissionSetArn": permissionSetArn,
+        "ManagedPolicies": managedPolicies,
+        "CustomerManagedPolicies": customerManagedPolicies,
+    }
+
+
+# Create one permission set with all its policies, run by the creation workers.
+# Failures go to the dead-letter queue, with the ARN if the permission set exists
+def createPermissionSet(permissionSetName, eachPermissionSet):
+    print(f" -> Creating permission set: {permissionSetName}")
+    inputs = {"Name": permissionSetName, "PermissionSet": eachPermissionSet}
+
+    try:
+        permissionSetArn = createEmptyPermissionSet(permissionSetName, eachPermissionSet)
+    except Exception as e:
+        print(f"(E!) -> Error creating permission set {permissionSetName}: {e}")
+        deadLetters.add("createPermissionSet", inputs, e)
+        return None
+
+    try:
+        permissionSet = attachPolicies(permissionSetArn, eachPermissionSet)
+    except Exception as e:
+        print(f"(E!) -> There is an error with the policy: {e}")
+        inputs["PermissionSetArn"] = permissionSetArn
+        deadLetters.add("createPermissionSet", inputs, e)
+        return None
+
+    print("\n -------------------------------------- \n")
+    return permissionSetName, permissionSet
+
+
+# Accounts each permission set is assigned to in the backup rows, in report order
+def getAccountsByPermissionSet(assignments):
+    accountsByPermissionSet = {}
+    for assignment in assignments:
+        accounts = accountsByPermissionSet.setdefault(assignment["Permission Set"], {})
+        accounts[assignment["Account ID"]] = True
+    return {name: list(accounts) for name, accounts in accountsByPermissionSet.items()}
+
+
+# Provisioning requests of the target instance, resolved with the STATUS_ settings
+def provisioningPoller():
+    return request_status.RequestPoller(
+        ssoadminclient,
+        newIdCInstanceARN,
+        request_status.PERMISSION_SET_PROVISIONING,
+        STATUS_TIMEOUT,
+        STATUS_MAX_WAIT,
+        STATUS_POLL_INTERVAL,
+    )
+
+
+def provisioningInputs(newPermissionSets, permissionSetName, accountID):
+    return {
+        "Name": permissionSetName,
+        "PermissionSetArn": newPermissionSets[permissionSetName]["PermissionSetArn"],
+        "AccountId": accountID,
+    }
+
+
+# Start provisioning a permission set to an account, returns the request status
+def startProvisioning(permissionSetArn, accountID):
+    status = ssoadminclient.provision_permission_set(
+        InstanceArn=newIdCInstanceARN,
+        PermissionSetArn=permissionSetArn,
+        TargetId=accountID,
+        TargetType="AWS_ACCOUNT",
+    )["PermissionSetProvisioningStatus"]
+    operationLog.record(
+        operation_log.PERMISSION_SET_PROVISIONING,
+        InstanceArn=newIdCInstanceARN,
+        PermissionSetArn=permissionSetArn,
+        AccountId=accountID,
+        RequestId=status["RequestId"],
+    )
+    return status
+
+
+# Provision one permission set to one account and wait for the result, for replays
+def provisionPermissionSet(inputs):
+    requestID = startProvisioning(inputs["PermissionSetArn"], inputs["AccountId"])["RequestId"]
+    status, failureReason = provisioningPoller().wait(requestID)
+    if status == "FAILED":
+        raise dead_letter.OperationFailed(failureReason)
+
+
+# Provision each permission set to its accounts, keeping PROVISION_IN_FLIGHT requests
+# in flight, and give up on a request still unresolved after STATUS_MAX_WAIT seconds
+def provisionPermissionSets(newPermissionSets, accountsByPermissionSet):
+    pending = iter(
+        [
+            (permissionSetName, accountID)
+            for permissionSetName in newPermissionSets
+            for accountID in accountsByPermissionSet.get(permissionSetName, [])
+        ]
+    )
+    inFlight, succeeded, failures = provisioningPoller(), 0, []
+    exhausted = False
+
+    while True:
+        while not exhausted and len(inFlight) < PROVISION_IN_FLIGHT:
+            target = next(pending, None)
+            if target is None:
+                exhausted = True
+                break
+            permissionSetName, accountID = target
+            try:
+                inFlight.add(
+                    startProvisioning(
+                        newPermissionSets[permissionSetName]["PermissionSetArn"], accountID
+                    ),
+                    target,
                 )
-                customerManagedPolicies.append(eachCustomerManagedPolicy)
-                print(
-                    f"\t-> Customer Managed Policy {eachCustomerManagedPolicy['Name']} added"
+            except Exception as e:
+                print(f"(E!) -> Error provisioning {permissionSetName} to {accountID}: {e}")
+                failures.append((target, str(e)))
+                deadLetters.add(
+                    "provisionPermissionSet",
+                    provisioningInputs(newPermissionSets, permissionSetName, accountID),
+                    e,
                 )
+        if not inFlight:
+            break
 
-            permissionSet = {
-                "Description": getDescription(
-                    permissionSet=newPermissionSet["PermissionSet"]
-                ),
-                "PermissionSetArn": newPermissionSet["PermissionSet"][
-                    "PermissionSetArn"
-                ],
-                "ManagedPolicies": managedPolicies,
-                "CustomerManagedPolicies": customerManagedPolicies,
-            }
-            newPermissionSets.update(
-                {newPermissionSet["PermissionSet"]["Name"]: permissionSet}
+        with idc_metrics.phase("status_poll_sleep"):
+            time.sleep(STATUS_POLL_INTERVAL)
+        for target, status, failureReason in inFlight.poll():
+            if status == "SUCCEEDED":
+                succeeded += 1
+                continue
+            print(f"(E!) -> Error provisioning {target[0]} to {target[1]}: {failureReason}")
+            failures.append((target, failureReason))
+            deadLetters.add(
+                "provisionPermissionSet",
+                provisioningInputs(newPermissionSets, *target),
+                dead_letter.OperationFailed(failureReason),
             )
 
-            print("\n -------------------------------------- \n")
+    print(f" -> Provisioned {succeeded} permission set/account pairs, {len(failures)} failed")
+
 
-        except Exception as e:
-            print(f"(E!) -> There is an error with the policy: {e}")
+# Create every permission set of the backup, CREATE_WORKERS at a time
+def createPermissionSets(permissionSets):
+    newPermissionSets = {}
+    stageStart = time.monotonic()
+    with idc_metrics.phase("createPermissionSets"), ThreadPoolExecutor(
+        max_workers=CREATE_WORKERS
+    ) as executor:
+        # map() keeps the order of OldPermissionSets.json in NewPermissionSets.json
+        for created in executor.map(
+            createPermissionSet, permissionSets.keys(), permissionSets.values()
+        ):
+            if created:
+                newPermissionSets.update({created[0]: created[1]})
+    print("\n -------------------------------------- \n")
+    print(
+        f" -> Created {len(newPermissionSets)}/{len(permissionSets)} permission sets "
+        f"in {time.monotonic() - stageStart:.1f}s"
+    )
+    return newPermissionSets
+
+
+# Retry the failures of the dead-letter queue, see dead_letter.DeadLetterQueue.replay.
+# Recovered permission sets are added to newPermissionSets
+def replayDeadLetters(newPermissionSets, retryAll=False):
+    def replayPermissionSet(inputs):
+        if "PermissionSetArn" not in inputs:
+            # Kept in the entry, so a failure of the policies is not created twice
+            inputs["PermissionSetArn"] = createEmptyPermissionSet(
+                inputs["Name"], inputs["PermissionSet"]
+            )
+        newPermissionSets[inputs["Name"]] = attachPolicies(
+            inputs["PermissionSetArn"], inputs["PermissionSet"]
+        )
+
+    with idc_metrics.phase("replayDeadLetters"):
+        return deadLetters.replay(
+            {
+                "createPermissionSet": replayPermissionSet,
+                "provisionPermissionSet": provisionPermissionSet,
+            },
+            retry_all=retryAll,
+        )[0]
+
+
+# MAIN
+if __name__ == "__main__":
+    idc_metrics.enable("2_idc_create_permsets")
+    Instances = (ssoadminclient.list_instances()).get("Instances")
+    newIdCInstanceARN = Instances[0].get("InstanceArn")
+    print("\n -------------------------------------- \n")
+    # "python 2_idc_create_permsets.py replay [--all]" only retries the failures
+    # of the earlier runs, "--all" including those whose error is not retryable
+    replayOnly = len(sys.argv) > 1 and sys.argv[1] == "replay"
+    try:
+        deadLetters = dead_letter.DeadLetterQueue(
+            DEAD_LETTER_PATH,
+            resume=replayOnly,
+            target={
+                "InstanceArn": newIdCInstanceARN,
+                "IdentityStoreId": Instances[0].get("IdentityStoreId"),
+            },
+            new_target=restore_journal.NEW_TARGET_FLAG in sys.argv,
+        )
+    except restore_journal.TargetMismatch as e:
+        raise SystemExit(str(e))
+    operationLog = operation_log.OperationLog()
+    if replayOnly:
+        with open("output/NewPermissionSets.json") as json_file:
+            newPermissionSets = json.load(json_file)
+    else:
+        with open("output/OldPermissionSets.json") as json_file:
+            newPermissionSets = createPermissionSets(json.load(json_file))
+
+        with open("output/NewPermissionSets.json", "w") as outfile:
+            json.dump(newPermissionSets, outfile, cls=SetEncoder)
+
+        if PROVISION_PERMISSION_SETS:
+            accountsByPermissionSet = getAccountsByPermissionSet(
+                compact_report.iter_report("output/OldIdentityStoreReport.csv")
+            )
+            stageStart = time.monotonic()
+            with idc_metrics.phase("provisionPermissionSets"):
+                provisionPermissionSets(newPermissionSets, accountsByPermissionSet)
+            print(f" -> Provisioning took {time.monotonic() - stageStart:.1f}s")
 
-with open("output/NewPermissionSets.json", "w") as outfile:
-    json.dump(newPermissionSets, outfile, cls=SetEncoder)
+    if len(deadLetters) and replayDeadLetters(
+        newPermissionSets, retryAll=replayOnly and "--all" in sys.argv
+    ):
+        with open("output/NewPermissionSets.json", "w") as outfile:
+            json.dump(newPermissionSets, outfile, cls=SetEncoder)
+    operationLog.close()
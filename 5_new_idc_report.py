@@ -1,21 +1,38 @@
-import boto3, json
+import boto3, json, os, time
+import compact_report
+import idc_clients
+import idc_metrics
+import json_stream
+from concurrent.futures import ThreadPoolExecutor
 
 DEFAULT_REGION = "eu-west-1"
+# "backup" only looks up the principals referenced in the backup files,
+# "all" lists every user and group in the identity store
+PRINCIPAL_RESOLUTION = "backup"
+# Principal lookups run in parallel by the "backup" resolution
+RESOLVE_WORKERS = 16
+# Resolved principals are cached on disk and reused across runs for this long
+PRINCIPAL_CACHE_PATH = "output/PrincipalCache.json"
+PRINCIPAL_CACHE_TTL_HOURS = 24
+# Write IdentityReport.jsonl, one principal per line, instead of IdentityReport.json
+JSON_LINES = False
 
 session = boto3.Session(
     aws_access_key_id="",
     aws_secret_access_key="",
 )
 
-idstoreclient = session.client("identitystore", region_name=DEFAULT_REGION)
-ssoadminclient = session.client("sso-admin", region_name=DEFAULT_REGION)
-orgsclient = session.client("organizations")
+idstoreclient = idc_clients.create_client(
+    session, "identitystore", DEFAULT_REGION, workers=RESOLVE_WORKERS
+)
+ssoadminclient = idc_clients.create_client(session, "sso-admin", DEFAULT_REGION)
+orgsclient = idc_clients.create_client(session, "organizations")
 
 report = {}
 
-Instances = (ssoadminclient.list_instances()).get("Instances")
-InstanceARN = Instances[0].get("InstanceArn")
-IdentityStoreId = Instances[0].get("IdentityStoreId")
+# Set from list_instances() when the script runs
+InstanceARN = None
+IdentityStoreId = None
 
 
 # Dictionary mapping User IDs to usernames
@@ -53,6 +70,132 @@ def mapGroupIDs():
         )
 
 
+# Principals (type, name) referenced by assignment rows, applications and
+# (group name, user names) memberships
+def getPrincipals(assignments, applications, groupMemberships):
+    principals = {}
+    for assignment in assignments:
+        principals[(assignment["Principal Type"], assignment["Principal"])] = True
+    for application in applications:
+        for assignment in application["Assignments"]:
+            if assignment.get("PrincipalName"):
+                principals[
+                    (assignment["PrincipalType"], assignment["PrincipalName"])
+                ] = True
+    for groupName, userNames in groupMemberships:
+        principals[("GROUP", groupName)] = True
+        for userName in userNames:
+            principals[("USER", userName)] = True
+    return list(principals)
+
+
+# Principals referenced by the backup files
+def getBackupPrincipals():
+    groupMemberships = []
+    # Backups taken before group memberships were exported have no such file
+    if os.path.exists("output/OldGroupMemberships.json"):
+        groupMemberships = json_stream.iter_json("output/OldGroupMemberships.json")
+    return getPrincipals(
+        compact_report.iter_report("output/OldIdentityStoreReport.csv"),
+        json_stream.iter_entries("output/OldApplications.json"),
+        groupMemberships,
+    )
+
+
+# Cache key of a principal: names are only unique within one identity store, so
+# a cache shared by several instances must not mix them up
+def principalCacheKey(principal):
+    return f"{IdentityStoreId}:{principal[0]}:{principal[1]}"
+
+
+# Cached principals still within PRINCIPAL_CACHE_TTL_HOURS, keyed by
+# "IdentityStoreId:TYPE:name"
+def loadPrincipalCache():
+    if not os.path.exists(PRINCIPAL_CACHE_PATH):
+        return {}
+    with open(PRINCIPAL_CACHE_PATH, "r") as cacheFile:
+        cache = json.load(cacheFile)
+    oldest = time.time() - PRINCIPAL_CACHE_TTL_HOURS * 3600
+    return {key: entry for key, entry in cache.items() if entry["CachedAt"] >= oldest}
+
+
+# Look up one principal by its unique name, returns (its ID or None if not found,
+# the error message if the lookup failed)
+def resolvePrincipal(principal):
+    principalType, principalName = principal
+    try:
+        if principalType == "USER":
+            return idstoreclient.get_user_id(
+                IdentityStoreId=IdentityStoreId,
+                AlternateIdentifier={
+                    "UniqueAttribute": {
+                        "AttributePath": "userName",
+                        "AttributeValue": principalName,
+                    }
+                },
+            )["UserId"], None
+        return idstoreclient.get_group_id(
+            IdentityStoreId=IdentityStoreId,
+            AlternateIdentifier={
+                "UniqueAttribute": {
+                    "AttributePath": "displayName",
+                    "AttributeValue": principalName,
+                }
+            },
+        )["GroupId"], None
+    except idstoreclient.exceptions.ResourceNotFoundException:
+        return None, None
+    except Exception as e:
+        return None, str(e)
+
+
+# Resolve only the principals referenced in the backup, reusing the on-disk cache.
+# The principals are read from the backup files unless given
+def mapBackupPrincipals(principals=None):
+    cache = loadPrincipalCache()
+    if principals is None:
+        principals = getBackupPrincipals()
+    missing = [
+        principal for principal in principals if principalCacheKey(principal) not in cache
+    ]
+    print(
+        f" -> {len(principals)} principals in the backup, "
+        f"{len(principals) - len(missing)} cached, {len(missing)} to look up"
+    )
+
+    unresolved = []
+    with ThreadPoolExecutor(max_workers=RESOLVE_WORKERS) as executor:
+        for principal, (principalId, error) in zip(
+            missing, executor.map(resolvePrincipal, missing)
+        ):
+            if error:
+                print(f"(E!) -> {principal[0]} {principal[1]} could not be looked up: {error}")
+                unresolved.append(principal)
+                continue
+            if principalId is None:
+                print(f"(E!) -> {principal[0]} {principal[1]} not found")
+                continue
+            cache[principalCacheKey(principal)] = {
+                "id": principalId,
+                "type": principal[0],
+                "CachedAt": time.time(),
+            }
+
+    # Saved even when some lookups failed, so a re-run only looks those up again
+    with open(PRINCIPAL_CACHE_PATH, "w") as cacheFile:
+        json.dump(cache, cacheFile)
+    if unresolved:
+        print(
+            f"(E!) -> {len(unresolved)} principals could not be looked up and are "
+            "missing from the report, run the script again to retry them: "
+            + ", ".join(f"{principal[0]} {principal[1]}" for principal in unresolved)
+        )
+    for principal in principals:
+        entry = cache.get(principalCacheKey(principal))
+        if entry:
+            report.update({principal[1]: {"id": entry["id"], "type": entry["type"]}})
+
+
 # To translate set datatype to json
 class SetEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -61,10 +204,31 @@ class SetEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-# MAIN
-mapUserIDs()
-mapGroupIDs()
+def writeIdentityReport():
+    if JSON_LINES:
+        json_stream.write_json_lines(
+            "output/IdentityReport.jsonl",
+            ({"Name": name, **entity} for name, entity in report.items()),
+        )
+        print("Done! IdentityReport.jsonl generated successfully!")
+    else:
+        with open("output/IdentityReport.json", "w") as outfile:
+            json.dump(report, outfile, cls=SetEncoder)
+        print("Done! IdentityReport.json generated successfully!")
 
-with open("output/IdentityReport.json", "w") as outfile:
-    json.dump(report, outfile, cls=SetEncoder)
-print("Done! IdentityReport.json generated successfully!")
+
+# MAIN
+if __name__ == "__main__":
+    idc_metrics.enable("5_new_idc_report")
+    Instances = (ssoadminclient.list_instances()).get("Instances")
+    InstanceARN = Instances[0].get("InstanceArn")
+    IdentityStoreId = Instances[0].get("IdentityStoreId")
+    if PRINCIPAL_RESOLUTION == "backup":
+        with idc_metrics.phase("mapBackupPrincipals"):
+            mapBackupPrincipals()
+    else:
+        with idc_metrics.phase("mapUserIDs"):
+            mapUserIDs()
+        with idc_metrics.phase("mapGroupIDs"):
+            mapGroupIDs()
+    writeIdentityReport()
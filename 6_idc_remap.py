@@ -1,17 +1,85 @@
-import boto3, csv, json
+import boto3, importlib, json, os, sys, threading, time
 import backoff
+import compact_report
+import dead_letter
+import idc_clients
+import idc_metrics
+import json_stream
+import operation_log
+import restore_index
+import restore_journal
+import restore_plan
+import request_status
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# The "apply" mode creates missing permission sets the way 2_idc_create_permsets.py does
+createPermSets = importlib.import_module("2_idc_create_permsets")
 
 DEFAULT_REGION = "eu-west-1"
+# "restore" replays the whole backup, "plan" writes the difference between the
+# backup and the target instance to output/RestorePlan.json, "apply" executes it,
+# "selective" restores only the account assignments matching the SELECT_ filters,
+# "replay" only retries the failures of the earlier runs (add "--all" on the command
+# line for those whose error is not retryable). Also read from the command line
+RESTORE_MODE = "restore"
+# Filters of the "selective" mode: a row must match every non-empty filter.
+# Accounts of the OUs, and of their child OUs, are added to SELECT_ACCOUNT_IDS
+SELECT_ACCOUNT_IDS = []
+SELECT_OU_IDS = []
+SELECT_PERMISSION_SETS = []
+SELECT_PRINCIPALS = []
+# Let "apply" delete what exists in the target but not in the backup
+APPLY_DELETES = False
+# Permission sets fetched in parallel when building the plan
+PLAN_WORKERS = 16
+# Account assignment creation requests kept in flight at once, resolved in bulk
+# with list_account_assignment_creation_status (1 = wait for each assignment)
+ASSIGNMENTS_IN_FLIGHT = 50
+# Seconds between two bulk status polls of the in-flight requests
+STATUS_POLL_INTERVAL = 2
+# Seconds after which an unresolved request is described individually
+STATUS_TIMEOUT = 60
+# Seconds after which a request still unresolved is given up on, reported as
+# failed and dead-lettered
+STATUS_MAX_WAIT = 600
+# Group memberships created in parallel
+MEMBERSHIP_WORKERS = 32
+# Applications created in parallel, and application assignments created in
+# parallel across all applications
+APPLICATION_WORKERS = 8
+APPLICATION_ASSIGNMENT_WORKERS = 16
+# Append-only journal of completed work, rows already in it are skipped on re-run
+JOURNAL_PATH = "output/RestoreJournal.jsonl"
+# Failed operations, with their inputs, retried at the end of the run
+DEAD_LETTER_PATH = dead_letter.dead_letter_path("6_idc_remap")
 
 session = boto3.Session(
     aws_access_key_id="",
     aws_secret_access_key="",
 )
 
-ssoadminclient = session.client("sso-admin", region_name=DEFAULT_REGION)
+# Shared by the account assignments and the applications, restored at the same time
+ssoadminclient = idc_clients.create_client(
+    session,
+    "sso-admin",
+    DEFAULT_REGION,
+    workers=max(PLAN_WORKERS, 1 + APPLICATION_WORKERS + APPLICATION_ASSIGNMENT_WORKERS),
+)
+idstoreclient = idc_clients.create_client(
+    session, "identitystore", DEFAULT_REGION, workers=MEMBERSHIP_WORKERS
+)
 
-instances = (ssoadminclient.list_instances()).get("Instances")
-instanceARN = instances[0].get("InstanceArn")
+# Set from list_instances() when the script runs
+instanceARN = None
+identityStoreId = None
+dead_letters = None
+# Every create is logged to operation_log.OPERATION_LOG_PATH, for rollback.py
+operations = None
+# Account assignments of the target from before the restore, listed on the first
+# create, see preexisting_account_assignments()
+preexisting_assignments = None
+preexisting_lock = threading.Lock()
 
 
 # wait for account assignment creation status, usually takes <5 seconds
@@ -44,32 +112,128 @@ def read_large_json(file_path):
         print(f"An error occurred: {e}")
 
 
-entities = read_large_json("output/IdentityReport.json")
-newPermissionSets = read_large_json("output/NewPermissionSets.json")
+def load_identity_index(file_path):
+    """
+    Build the principal name -> {"id", "type"} index of IdentityReport.json.
+
+    Entries are streamed one at a time from either IdentityReport.json or its
+    line-delimited IdentityReport.jsonl variant, so peak memory is the index
+    itself rather than two or three copies of the whole file.
+    """
+    index = {}
+    try:
+        for entry in json_stream.iter_entries(file_path):
+            if isinstance(entry, tuple):
+                index[entry[0]] = entry[1]
+            else:
+                index[entry["Name"]] = {"id": entry["id"], "type": entry["type"]}
+    except FileNotFoundError:
+        print("The file was not found.")
+    except json.JSONDecodeError:
+        print("The file does not contain valid JSON.")
+    return index
+
+
+def iter_applications(file_path):
+    # OldApplications.json is streamed one application at a time
+    return json_stream.iter_entries(file_path)
+
+
+def account_assignment_key(assignment):
+    return (
+        restore_journal.ACCOUNT_ASSIGNMENT,
+        assignment["Account ID"],
+        assignment["Permission Set"],
+        assignment["Principal Type"],
+        assignment["Principal"],
+    )
+
+
+def preexisting_account_assignments():
+    """
+    The account assignments the target had before the restore.
+
+    create_account_assignment succeeds for an assignment that already exists, so
+    those must not be logged as created, or a rollback would delete them. Only
+    the permission sets the restore did not create can have any (see
+    OperationLog.permission_sets): their assignments are listed once, as the plan
+    mode does, and usually there is none to list.
+
+    Returns:
+        set: (account ID, permission set ARN, principal type, principal ID) tuples.
+    """
+    global preexisting_assignments
+    with preexisting_lock:
+        if preexisting_assignments is None:
+            permission_set_arns = [
+                permission_set["PermissionSetArn"]
+                for permission_set in newPermissionSets.values()
+                if permission_set["PermissionSetArn"] not in operations.permission_sets
+            ]
+            with ThreadPoolExecutor(max_workers=PLAN_WORKERS) as executor:
+                listings = executor.map(
+                    lambda arn: restore_plan.fetch_permission_set_assignments(
+                        ssoadminclient, instanceARN, arn
+                    ),
+                    permission_set_arns,
+                )
+                preexisting_assignments = {
+                    (
+                        assignment["AccountId"],
+                        assignment["PermissionSetArn"],
+                        assignment["PrincipalType"],
+                        assignment["PrincipalId"],
+                    )
+                    for listing in listings
+                    for assignment in listing
+                }
+            if permission_set_arns:
+                print(
+                    f" -> {len(preexisting_assignments)} account assignments already in the "
+                    f"{len(permission_set_arns)} permission sets this restore did not create"
+                )
+        return preexisting_assignments
+
 
-with open("output/OldIdentityStoreReport.csv", "r") as oldIdCReport:
-    reader = csv.DictReader(oldIdCReport)
-    oldAssignments = list(reader)
+def create_account_assignment(assignment):
     # CSV Columns: Account ID,Account Name,Permission Set,Principal Type,Principal
+    target = {
+        "InstanceArn": instanceARN,
+        "PermissionSetArn": newPermissionSets[assignment["Permission Set"]][
+            "PermissionSetArn"
+        ],
+        "PrincipalType": assignment["Principal Type"],
+        "PrincipalId": entities[assignment["Principal"]]["id"],  # --> ID from new IdC Report
+        "TargetId": assignment["Account ID"],
+        "TargetType": "AWS_ACCOUNT",
+    }
+    preexisting = (
+        target["TargetId"],
+        target["PermissionSetArn"],
+        target["PrincipalType"],
+        target["PrincipalId"],
+    ) in preexisting_account_assignments()
+    response = ssoadminclient.create_account_assignment(**target)
+    if not preexisting:
+        operations.record(
+            operation_log.ACCOUNT_ASSIGNMENT,
+            RequestId=response["AccountAssignmentCreationStatus"]["RequestId"],
+            **target,
+        )
+    return response
+
+
+def restore_account_assignments(oldAssignments):
     for assignment in oldAssignments:
         try:
-            response = ssoadminclient.create_account_assignment(
-                InstanceArn=instanceARN,
-                PermissionSetArn=newPermissionSets[assignment["Permission Set"]][
-                    "PermissionSetArn"
-                ],
-                PrincipalType=assignment["Principal Type"],
-                PrincipalId=entities[assignment["Principal"]][
-                    "id"
-                ],  # --> ID from new IdC Report
-                TargetId=assignment["Account ID"],
-                TargetType="AWS_ACCOUNT",
-            )
+            response = create_account_assignment(assignment)
 
             # wait for the association to be created
-            if not wait_for_account_assignment_creation_status(
-                instanceARN, response["AccountAssignmentCreationStatus"]["RequestId"]
-            ):
+            with idc_metrics.phase("wait_for_account_assignment_creation_status"):
+                created = wait_for_account_assignment_creation_status(
+                    instanceARN, response["AccountAssignmentCreationStatus"]["RequestId"]
+                )
+            if not created:
                 failure_reason = (
                     ssoadminclient.describe_account_assignment_creation_status(
                         InstanceArn=instanceARN,
@@ -80,74 +244,839 @@ with open("output/OldIdentityStoreReport.csv", "r") as oldIdCReport:
                 )
                 raise ValueError(f"Timeout - reason {failure_reason}")
 
+            journal.record(account_assignment_key(assignment))
             print(
                 f"Successfully created assignment for {assignment['Permission Set']} and {assignment['Principal']}\n"
             )
         except Exception as e:
             print(f"Error in {assignment['Permission Set']} for {assignment['Principal']}: {e}")
-            print("\n Skipping to the next assignment... \n")
+            dead_letters.add("account_assignment", dict(assignment), e)
             continue
 
-    # Remap applications and assignments from OldApplications to new IdC
-    applications = read_large_json("output/OldApplications.json")
+
+def request_poller(kind):
+    """A request_status.RequestPoller of the target instance, with the STATUS_ settings."""
+    return request_status.RequestPoller(
+        ssoadminclient, instanceARN, kind, STATUS_TIMEOUT, STATUS_MAX_WAIT, STATUS_POLL_INTERVAL
+    )
+
+
+def replay_account_assignment(assignment):
+    """Create one account assignment and wait for it, raising if it fails."""
+    request_id = create_account_assignment(assignment)["AccountAssignmentCreationStatus"][
+        "RequestId"
+    ]
+    status, failure_reason = request_poller(request_status.ACCOUNT_ASSIGNMENT_CREATION).wait(
+        request_id
+    )
+    if status == "FAILED":
+        raise dead_letter.OperationFailed(failure_reason)
+    journal.record(account_assignment_key(assignment))
+
+
+def restore_account_assignments_pipelined(oldAssignments):
+    """
+    Create account assignments keeping ASSIGNMENTS_IN_FLIGHT requests in flight.
+
+    Creation requests are queued by request ID and resolved in bulk every
+    STATUS_POLL_INTERVAL seconds. Only failed requests, and requests still
+    unresolved after STATUS_TIMEOUT seconds, are described one by one; a request
+    still unresolved after STATUS_MAX_WAIT seconds is given up on and
+    dead-lettered. A summary with failure reasons and throughput is printed at
+    the end.
+    """
+    in_flight = request_poller(request_status.ACCOUNT_ASSIGNMENT_CREATION)
+    succeeded, failures = 0, []
+    pending = iter(oldAssignments)
+    exhausted = False
+    start = time.monotonic()
+
+    while True:
+        while not exhausted and len(in_flight) < ASSIGNMENTS_IN_FLIGHT:
+            assignment = next(pending, None)
+            if assignment is None:
+                exhausted = True
+                break
+            try:
+                in_flight.add(
+                    create_account_assignment(assignment)["AccountAssignmentCreationStatus"],
+                    assignment,
+                )
+            except Exception as e:
+                print(f"Error in {assignment['Permission Set']} for {assignment['Principal']}: {e}")
+                failures.append((assignment, str(e)))
+                dead_letters.add("account_assignment", dict(assignment), e)
+        if not in_flight:
+            break
+
+        with idc_metrics.phase("status_poll_sleep"):
+            time.sleep(STATUS_POLL_INTERVAL)
+        for assignment, status, failure_reason in in_flight.poll():
+            if status == "SUCCEEDED":
+                succeeded += 1
+                journal.record(account_assignment_key(assignment))
+                print(
+                    f"Successfully created assignment for {assignment['Permission Set']} and {assignment['Principal']}"
+                )
+            else:
+                print(f"Error in {assignment['Permission Set']} for {assignment['Principal']}: {failure_reason}")
+                failures.append((assignment, failure_reason))
+                dead_letters.add(
+                    "account_assignment",
+                    dict(assignment),
+                    dead_letter.OperationFailed(failure_reason),
+                )
+
+    elapsed = time.monotonic() - start
+    print("\n -------------------------------------- \n")
+    print(f"Account assignments created: {succeeded}, failed: {len(failures)}")
+    print(
+        f"Elapsed: {elapsed:.1f}s ({(succeeded + len(failures)) / max(elapsed, 0.001):.1f} assignments/s)"
+    )
+    for assignment, reason in failures:
+        print(
+            f"\t-> {assignment['Account ID']} {assignment['Permission Set']} {assignment['Principal']}: {reason}"
+        )
+
+
+def application_assignment_key(application_name, principal_type, principal_name):
+    return (
+        restore_journal.APPLICATION_ASSIGNMENT,
+        application_name,
+        principal_type,
+        principal_name,
+    )
+
+
+def application_configured(application_key):
+    """
+    Whether an application was created and configured, from the journal. Journals
+    written before the 'Configured' detail existed only hold configured ones.
+    """
+    return application_key in journal and journal.get(application_key).get("Configured", True)
+
+
+def start_application(application):
+    """
+    Create one application, without its configuration.
+
+    The ARN is journaled as soon as the create call returns, so a run failing
+    before the configuration is done resumes from it instead of creating a second
+    application.
+
+    Returns:
+        str: The ARN of the new application.
+    """
+    details = application["ApplicationDetails"]
+    optional = {key: details[key] for key in ["Description", "Tags"] if details.get(key)}
+    application_arn = ssoadminclient.create_application(
+        InstanceArn=instanceARN,
+        ApplicationProviderArn=details["ApplicationProviderArn"],
+        Name=details["Name"],
+        PortalOptions=details["PortalOptions"],
+        Status=details["Status"],
+        **optional,
+    )["ApplicationArn"]
+    operations.record(
+        operation_log.APPLICATION,
+        InstanceArn=instanceARN,
+        ApplicationArn=application_arn,
+        Name=details["Name"],
+    )
+    journal.record(
+        (restore_journal.APPLICATION, details["Name"]),
+        ApplicationArn=application_arn,
+        Configured=False,
+    )
+    return application_arn
+
+
+def create_application(application, application_arn=None):
+    """
+    Create one application with its assignment configuration and authentication
+    method, run by the application workers.
+
+    An application created by an earlier run, from the journal or given as
+    'application_arn', is not created again: one whose configuration did not
+    complete is configured, the put calls being idempotent.
+
+    Returns:
+        str: The ARN of the new application, or of the one created by an earlier
+        run, from the journal.
+    """
+    application_key = (restore_journal.APPLICATION, application["ApplicationDetails"]["Name"])
+    if application_configured(application_key):
+        return journal.get(application_key)["ApplicationArn"]
+    application_arn = application_arn or journal.get(application_key).get("ApplicationArn")
+    if application_arn is None:
+        application_arn = start_application(application)
+    ssoadminclient.put_application_assignment_configuration(
+        ApplicationArn=application_arn,
+        AssignmentRequired=application["AssignmentConfiguration"]["AssignmentRequired"],
+    )
+    if application["AuthenticationMethod"]:
+        ssoadminclient.put_application_authentication_method(
+            ApplicationArn=application_arn,
+            AuthenticationMethodType=application["AuthenticationMethod"][
+                "AuthenticationMethodType"
+            ],
+            AuthenticationMethod=application["AuthenticationMethod"]["AuthenticationMethod"],
+        )
+    journal.record(application_key, ApplicationArn=application_arn, Configured=True)
+    return application_arn
+
+
+def assign_application_principal(application_arn, key, principal_id):
+    try:
+        ssoadminclient.create_application_assignment(
+            ApplicationArn=application_arn,
+            PrincipalId=principal_id,
+            PrincipalType=key[2],
+        )
+        operations.record(
+            operation_log.APPLICATION_ASSIGNMENT,
+            ApplicationArn=application_arn,
+            PrincipalType=key[2],
+            PrincipalId=principal_id,
+        )
+        result = "created"
+    except ssoadminclient.exceptions.ConflictException:
+        result = "existing"
+    journal.record(key)
+    return result
+
+
+def create_application_assignment(assignment):
+    """
+    Assign one principal to one application, run by the assignment workers.
+
+    Returns:
+        str: "created", "existing" if the principal was already assigned, or "failed".
+    """
+    application_arn, key, principal_id = assignment
+    try:
+        return assign_application_principal(application_arn, key, principal_id)
+    except Exception as e:
+        print(f"Error assigning {key[3]} to {key[1]}: {e}")
+        dead_letters.add(
+            "application_assignment",
+            {"ApplicationArn": application_arn, "Key": list(key), "PrincipalId": principal_id},
+            e,
+        )
+        return "failed"
+
+
+def resolve_application_assignments(applications):
+    """
+    Resolve the principals of the application assignments not yet journaled.
+
+    Returns:
+        tuple: (applications with their assignments as (journal key, principal ID)
+        pairs, number of assignments whose principal is not in the identity report).
+    """
+    resolved, unresolved = [], 0
     for application in applications:
-        try:
-            # Create the application
-            NewAppArn = ssoadminclient.create_application(
-                ApplicationProviderArn=application["ApplicationDetails"][
-                    "ApplicationProviderArn"
-                ],
-                Description=(
-                    application["ApplicationDetails"]["Description"]
-                    if "Description" in application["ApplicationDetails"]
-                    else "-"
-                ),
-                InstanceArn=instanceARN,
-                Name=application["ApplicationDetails"]["Name"],
-                PortalOptions=application["ApplicationDetails"]["PortalOptions"],
-                Status=application["ApplicationDetails"]["Status"],
-                Tags=(
-                    application["ApplicationDetails"]["Tags"]
-                    if "Tags" in application["ApplicationDetails"]
-                    else []
-                ),
+        name = application["ApplicationDetails"]["Name"]
+        assignments = []
+        for assignment in application["Assignments"]:
+            key = application_assignment_key(
+                name, assignment["PrincipalType"], assignment["PrincipalName"]
             )
-            # Set assignment configuration and authentication method
-            ssoadminclient.put_application_assignment_configuration(
-                ApplicationArn=NewAppArn,
-                AssignmentRequired=application["AssignmentConfiguration"][
-                    "AssignmentRequired"
-                ],
+            if key in journal:
+                continue
+            principal = entities.get(assignment["PrincipalName"])
+            if principal is None:
+                unresolved += 1
+                continue
+            assignments.append((key, principal["id"]))
+        application_key = (restore_journal.APPLICATION, name)
+        if assignments or not application_configured(application_key):
+            resolved.append((application, assignments))
+    return resolved, unresolved
+
+
+def restore_applications(applications):
+    """
+    Recreate applications from OldApplications and assign their principals.
+
+    The principals are resolved once, up front. APPLICATION_WORKERS threads then
+    create the applications, and as each one is ready its assignments are handed to
+    APPLICATION_ASSIGNMENT_WORKERS threads shared by all applications. Applications
+    and assignments already in the journal are skipped, so an application created
+    by an earlier run only gets its missing assignments.
+    """
+    pending, unresolved = resolve_application_assignments(applications)
+    created, failed = 0, 0
+    assignments = []
+    start = time.monotonic()
+    with ThreadPoolExecutor(
+        max_workers=APPLICATION_WORKERS
+    ) as application_executor, ThreadPoolExecutor(
+        max_workers=APPLICATION_ASSIGNMENT_WORKERS
+    ) as assignment_executor:
+        futures = {
+            application_executor.submit(create_application, application): (
+                application,
+                application_assignments,
             )
-            if application["AuthenticationMethod"]:
-                ssoadminclient.put_application_authentication_method(
-                    ApplicationArn=NewAppArn,
-                    AuthenticationMethodType=application["AuthenticationMethod"][
-                        "AuthenticationMethodType"
-                    ],
-                    AuthenticationMethodConfiguration=application[
-                        "AuthenticationMethod"
-                    ]["AuthenticationMethodConfiguration"],
+            for application, application_assignments in pending
+        }
+        for future in as_completed(futures):
+            application, application_assignments = futures[future]
+            name = application["ApplicationDetails"]["Name"]
+            try:
+                application_arn = future.result()
+            except Exception as e:
+                print(f"Error creating application {name}: {e}")
+                inputs = {"Application": application}
+                application_arn = journal.get((restore_journal.APPLICATION, name)).get(
+                    "ApplicationArn"
                 )
+                if application_arn:
+                    # Created before it failed, the replay configures it instead
+                    inputs["ApplicationArn"] = application_arn
+                dead_letters.add("application", inputs, e)
+                failed += 1
+                continue
+            created += 1
+            print(f"Application {name} is ready, {len(application_assignments)} assignments to create")
+            assignments.extend(
+                assignment_executor.submit(
+                    create_application_assignment, (application_arn, key, principal_id)
+                )
+                for key, principal_id in application_assignments
+            )
+        results = Counter(assignment.result() for assignment in assignments)
+    elapsed = time.monotonic() - start
+    print("\n -------------------------------------- \n")
+    print(f"Applications restored: {created}, failed: {failed}")
+    print(
+        f"Application assignments created: {results['created']}, "
+        f"already present: {results['existing']}, failed: {results['failed']}, "
+        f"unresolved: {unresolved}"
+    )
+    print(
+        f"Elapsed: {elapsed:.1f}s ({len(assignments) / max(elapsed, 0.001):.1f} assignments/s)"
+    )
 
-            # Create assignments
-            for assignment in application["Assignments"]:
-                ssoadminclient.create_application_assignment(
-                    ApplicationArn=NewAppArn,
-                    PermissionSetArn=newPermissionSets[
-                        application["ApplicationDetails"]["Name"]
-                    ]["PermissionSetArn"],
-                    PrincipalType=assignment["PrincipalType"],
-                    PrincipalId=entities[assignment["PrincipalName"]]["id"],
-                    TargetId=assignment["TargetId"] if "TargetId" in assignment else "",
-                    TargetType=(
-                        assignment["TargetType"] if "TargetId" in assignment else ""
-                    ),
+
+def group_membership_key(group_name, user_name):
+    return (restore_journal.GROUP_MEMBERSHIP, group_name, user_name)
+
+
+def create_group_membership(membership):
+    """
+    Add one user to one group, run by the membership workers.
+
+    Returns:
+        str: "created", "existing" if the user was already a member, or "failed".
+    """
+    group_name, user_name = membership
+    try:
+        return add_group_member(group_name, user_name)
+    except Exception as e:
+        print(f"Error adding {user_name} to {group_name}: {e}")
+        dead_letters.add("group_membership", {"Group": group_name, "User": user_name}, e)
+        return "failed"
+
+
+def add_group_member(group_name, user_name):
+    try:
+        membership_id = idstoreclient.create_group_membership(
+            IdentityStoreId=identityStoreId,
+            GroupId=entities[group_name]["id"],
+            MemberId={"UserId": entities[user_name]["id"]},
+        )["MembershipId"]
+        operations.record(
+            operation_log.GROUP_MEMBERSHIP,
+            IdentityStoreId=identityStoreId,
+            MembershipId=membership_id,
+        )
+        result = "created"
+    except idstoreclient.exceptions.ConflictException:
+        result = "existing"
+    journal.record(group_membership_key(group_name, user_name))
+    return result
+
+
+def load_group_memberships(file_path):
+    # OldGroupMemberships.json is streamed one group at a time
+    if not os.path.exists(file_path):
+        print(f"{file_path} not found, skipping group memberships")
+        return []
+    return json_stream.iter_json(file_path)
+
+
+def restore_group_memberships(group_memberships):
+    """
+    Recreate group memberships, given as (group name, user names) pairs.
+
+    Memberships are created by MEMBERSHIP_WORKERS threads sharing one rate-limited
+    client. Memberships already in the journal are skipped, and memberships whose
+    group or user is not in the identity report are counted as unresolved.
+    """
+    memberships, unresolved = [], 0
+    for group_name, user_names in group_memberships:
+        for user_name in user_names:
+            if group_membership_key(group_name, user_name) in journal:
+                continue
+            if group_name not in entities or user_name not in entities:
+                unresolved += 1
+                continue
+            memberships.append((group_name, user_name))
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=MEMBERSHIP_WORKERS) as executor:
+        results = Counter(executor.map(create_group_membership, memberships))
+    elapsed = time.monotonic() - start
+    print("\n -------------------------------------- \n")
+    print(
+        f"Group memberships created: {results['created']}, "
+        f"already present: {results['existing']}, failed: {results['failed']}, "
+        f"unresolved: {unresolved}"
+    )
+    print(
+        f"Elapsed: {elapsed:.1f}s ({len(memberships) / max(elapsed, 0.001):.1f} memberships/s)"
+    )
+
+
+def list_accounts_in_ous(ou_ids):
+    """Account IDs of the given OUs and of all the OUs below them."""
+    orgsclient = idc_clients.create_client(session, "organizations")
+    account_ids, parents = set(), list(ou_ids)
+    while parents:
+        parent = parents.pop()
+        account_ids.update(
+            account["Id"]
+            for account in restore_plan.paginate(
+                orgsclient.list_accounts_for_parent, "Accounts", ParentId=parent
+            )
+        )
+        parents.extend(
+            unit["Id"]
+            for unit in restore_plan.paginate(
+                orgsclient.list_organizational_units_for_parent,
+                "OrganizationalUnits",
+                ParentId=parent,
+            )
+        )
+    return account_ids
+
+
+def selective_restore():
+    """
+    Restore only the account assignments matching the SELECT_ filters.
+
+    Rows are looked up in the index of OldIdentityStoreReport.csv (see
+    restore_index), so only the matching rows are read and replayed. A compact
+    report is filtered by code instead (see compact_report).
+    """
+    filters = {}
+    if SELECT_ACCOUNT_IDS or SELECT_OU_IDS:
+        account_ids = set(SELECT_ACCOUNT_IDS)
+        if SELECT_OU_IDS:
+            account_ids |= list_accounts_in_ous(SELECT_OU_IDS)
+        filters[restore_index.ACCOUNT] = account_ids
+    if SELECT_PERMISSION_SETS:
+        filters[restore_index.PERMISSION_SET] = SELECT_PERMISSION_SETS
+    if SELECT_PRINCIPALS:
+        filters[restore_index.PRINCIPAL] = SELECT_PRINCIPALS
+    if not filters:
+        raise SystemExit("The selective restore needs at least one SELECT_ filter")
+
+    selected = compact_report.select_rows("output/OldIdentityStoreReport.csv", filters)
+    oldAssignments = [
+        assignment
+        for assignment in selected
+        if account_assignment_key(assignment) not in journal
+    ]
+    print(
+        f" -> {len(selected)} account assignments selected, "
+        f"{len(selected) - len(oldAssignments)} already restored"
+    )
+    if ASSIGNMENTS_IN_FLIGHT > 1:
+        restore_account_assignments_pipelined(oldAssignments)
+    else:
+        restore_account_assignments(oldAssignments)
+
+
+def plan_restore():
+    print(" -> Fetching the current state of the target instance...")
+    target = restore_plan.fetch_target_state(
+        ssoadminclient, instanceARN, workers=PLAN_WORKERS
+    )
+    oldAssignments = list(compact_report.iter_report("output/OldIdentityStoreReport.csv"))
+    plan = restore_plan.compute_plan(
+        oldAssignments,
+        read_large_json("output/OldPermissionSets.json"),
+        iter_applications("output/OldApplications.json"),
+        entities,
+        target,
+    )
+    restore_plan.write_plan(plan)
+    restore_plan.summarize_plan(plan)
+    print(f"Done! {restore_plan.PLAN_PATH} generated successfully!")
+
+
+def apply_permission_set_settings(arn, update):
+    """
+    Set the fields other than the policies of a permission set to their backup
+    values, see restore_plan.settings_drift(). Settings unset in the backup are
+    only removed from the target with APPLY_DELETES, and a session duration or
+    relay state cannot be unset.
+    """
+    settings = update.get("Settings", {})
+    changed = {
+        field: settings[field]
+        for field in ["SessionDuration", "RelayState"]
+        if settings.get(field)
+    }
+    if changed:
+        ssoadminclient.update_permission_set(
+            InstanceArn=instanceARN, PermissionSetArn=arn, **changed
+        )
+    if settings.get("InlinePolicyHash"):
+        ssoadminclient.put_inline_policy_to_permission_set(
+            InstanceArn=instanceARN,
+            PermissionSetArn=arn,
+            InlinePolicy=createPermSets.policyStore.get(settings["InlinePolicyHash"]),
+        )
+    elif "InlinePolicyHash" in settings and APPLY_DELETES:
+        ssoadminclient.delete_inline_policy_from_permission_set(
+            InstanceArn=instanceARN, PermissionSetArn=arn
+        )
+    if settings.get("PermissionsBoundary"):
+        ssoadminclient.put_permissions_boundary_to_permission_set(
+            InstanceArn=instanceARN,
+            PermissionSetArn=arn,
+            PermissionsBoundary=settings["PermissionsBoundary"],
+        )
+    elif "PermissionsBoundary" in settings and APPLY_DELETES:
+        ssoadminclient.delete_permissions_boundary_from_permission_set(
+            InstanceArn=instanceARN, PermissionSetArn=arn
+        )
+    if update.get("TagResource"):
+        ssoadminclient.tag_resource(
+            InstanceArn=instanceARN, ResourceArn=arn, Tags=update["TagResource"]
+        )
+    if update.get("UntagResource") and APPLY_DELETES:
+        ssoadminclient.untag_resource(
+            InstanceArn=instanceARN, ResourceArn=arn, TagKeys=update["UntagResource"]
+        )
+
+
+def apply_permission_set_changes(plan, old_permission_sets):
+    permission_set_arns = dict(plan["PermissionSetArns"])
+    # With every field of the backup: session duration, relay state, tags, inline
+    # policy from the policy store and permissions boundary
+    createPermSets.ssoadminclient = ssoadminclient
+    createPermSets.newIdCInstanceARN = instanceARN
+    createPermSets.operationLog = operations
+    for name in plan["PermissionSets"]["Create"]:
+        old_permission_set = old_permission_sets[name]
+        try:
+            arn = createPermSets.createEmptyPermissionSet(name, old_permission_set)
+            createPermSets.attachPolicies(arn, old_permission_set)
+            permission_set_arns[name] = arn
+            print(f"Successfully created permission set {name}")
+        except Exception as e:
+            print(f"Error creating permission set {name}: {e}")
+
+    for update in plan["PermissionSets"]["Update"]:
+        arn = permission_set_arns[update["Name"]]
+        try:
+            for policy_arn in update["AttachManagedPolicies"]:
+                ssoadminclient.attach_managed_policy_to_permission_set(
+                    InstanceArn=instanceARN, PermissionSetArn=arn, ManagedPolicyArn=policy_arn
                 )
-            print(
-                f"Successfully created application assignment for {application['ApplicationName']} and {application['PrincipalId']}\n"
+            for path, name in update["AttachCustomerManagedPolicies"]:
+                ssoadminclient.attach_customer_managed_policy_reference_to_permission_set(
+                    InstanceArn=instanceARN,
+                    PermissionSetArn=arn,
+                    CustomerManagedPolicyReference={"Name": name, "Path": path},
+                )
+            if APPLY_DELETES:
+                for policy_arn in update["DetachManagedPolicies"]:
+                    ssoadminclient.detach_managed_policy_from_permission_set(
+                        InstanceArn=instanceARN,
+                        PermissionSetArn=arn,
+                        ManagedPolicyArn=policy_arn,
+                    )
+                for path, name in update["DetachCustomerManagedPolicies"]:
+                    ssoadminclient.detach_customer_managed_policy_reference_from_permission_set(
+                        InstanceArn=instanceARN,
+                        PermissionSetArn=arn,
+                        CustomerManagedPolicyReference={"Name": name, "Path": path},
+                    )
+            apply_permission_set_settings(arn, update)
+            # Push the new policies to the accounts the permission set is on
+            ssoadminclient.provision_permission_set(
+                InstanceArn=instanceARN, PermissionSetArn=arn, TargetType="ALL_PROVISIONED"
             )
+            print(f"Successfully updated permission set {update['Name']}")
         except Exception as e:
-            print(f"Error in {application['ApplicationName']} for {application['PrincipalId']}: {e}")
-            print("\n Skipping to the next application... \n")
+            print(f"Error updating permission set {update['Name']}: {e}")
+
+    return {name: {"PermissionSetArn": arn} for name, arn in permission_set_arns.items()}
+
+
+def wait_for_account_assignment_deletions(in_flight):
+    """
+    Resolve account assignment deletion requests in bulk, as
+    restore_account_assignments_pipelined resolves creations.
+
+    Args:
+        in_flight (request_status.RequestPoller): The deletion requests, of the
+            assignments they delete.
+
+    Returns:
+        list: The assignments whose deletion failed, or was still unresolved
+        after STATUS_MAX_WAIT seconds.
+    """
+    failures = []
+    while in_flight:
+        with idc_metrics.phase("status_poll_sleep"):
+            time.sleep(STATUS_POLL_INTERVAL)
+        for assignment, status, failure_reason in in_flight.poll():
+            if status == "SUCCEEDED":
+                print(
+                    f"Deleted assignment of {assignment['Permission Set']} for {assignment['Principal'] or assignment['PrincipalId']}"
+                )
+            else:
+                print(f"Error deleting {assignment['Permission Set']} for {assignment['PrincipalId']}: {failure_reason}")
+                failures.append(assignment)
+    return failures
+
+
+def wait_for_application_deletions(application_arns):
+    """
+    Poll describe_application every STATUS_POLL_INTERVAL seconds until the deleted
+    applications are gone, for STATUS_MAX_WAIT seconds at most.
+
+    Returns:
+        list: The applications still there.
+    """
+    remaining = list(application_arns)
+    start = time.monotonic()
+    while remaining:
+        still_there = []
+        for application_arn in remaining:
+            try:
+                ssoadminclient.describe_application(ApplicationArn=application_arn)
+                still_there.append(application_arn)
+            except Exception as e:
+                if idc_clients.error_code(e) != "ResourceNotFoundException":
+                    still_there.append(application_arn)
+                    continue
+                print(f"Deleted application {application_arn}")
+        remaining = still_there
+        if not remaining or time.monotonic() - start > STATUS_MAX_WAIT:
+            break
+        with idc_metrics.phase("status_poll_sleep"):
+            time.sleep(STATUS_POLL_INTERVAL)
+    for application_arn in remaining:
+        print(f"Error deleting application {application_arn}: still there after {STATUS_MAX_WAIT}s")
+    return remaining
+
+
+def apply_deletes(plan):
+    """
+    Delete what the plan found in the target but not in the backup.
+
+    The account assignment and application deletions are started first and
+    resolved like the creations. Permission sets go last, as they can only be
+    deleted once their assignments are gone: one with an assignment that could not
+    be deleted is kept.
+    """
+    in_flight = request_poller(request_status.ACCOUNT_ASSIGNMENT_DELETION)
+    failed_assignments = []
+    for assignment in plan["AccountAssignments"]["Delete"]:
+        try:
+            status = ssoadminclient.delete_account_assignment(
+                InstanceArn=instanceARN,
+                TargetId=assignment["Account ID"],
+                TargetType="AWS_ACCOUNT",
+                PermissionSetArn=newPermissionSets[assignment["Permission Set"]][
+                    "PermissionSetArn"
+                ],
+                PrincipalType=assignment["Principal Type"],
+                PrincipalId=assignment["PrincipalId"],
+            )["AccountAssignmentDeletionStatus"]
+            in_flight.add(status, assignment)
+        except Exception as e:
+            print(f"Error deleting {assignment['Permission Set']} for {assignment['PrincipalId']}: {e}")
+            failed_assignments.append(assignment)
+    deleted_applications = []
+    for application_arn in plan["Applications"]["Delete"]:
+        try:
+            ssoadminclient.delete_application(ApplicationArn=application_arn)
+            deleted_applications.append(application_arn)
+        except Exception as e:
+            print(f"Error deleting application {application_arn}: {e}")
+    failed_assignments.extend(wait_for_account_assignment_deletions(in_flight))
+    wait_for_application_deletions(deleted_applications)
+
+    kept = {assignment["Permission Set"] for assignment in failed_assignments}
+    for name in plan["PermissionSets"]["Delete"]:
+        if name in kept:
+            print(f"Kept permission set {name}, some of its assignments could not be deleted")
             continue
+        try:
+            ssoadminclient.delete_permission_set(
+                InstanceArn=instanceARN,
+                PermissionSetArn=newPermissionSets[name]["PermissionSetArn"],
+            )
+            print(f"Deleted permission set {name}")
+        except Exception as e:
+            print(f"Error deleting permission set {name}: {e}")
+
+
+def apply_restore():
+    global newPermissionSets
+    plan = restore_plan.load_plan()
+    restore_plan.summarize_plan(plan)
+    newPermissionSets = apply_permission_set_changes(
+        plan, read_large_json("output/OldPermissionSets.json")
+    )
+
+    creates = [
+        assignment
+        for assignment in plan["AccountAssignments"]["Create"]
+        if account_assignment_key(assignment) not in journal
+    ]
+    if ASSIGNMENTS_IN_FLIGHT > 1:
+        restore_account_assignments_pipelined(creates)
+    else:
+        restore_account_assignments(creates)
+
+    application_names = set(plan["Applications"]["Create"])
+    restore_applications(
+        [
+            application
+            for application in iter_applications("output/OldApplications.json")
+            if application["ApplicationDetails"]["Name"] in application_names
+        ]
+    )
+    restore_group_memberships(load_group_memberships("output/OldGroupMemberships.json"))
+    if APPLY_DELETES:
+        apply_deletes(plan)
+
+
+def restore_applications_stage(applications):
+    with idc_metrics.phase("restore_applications"):
+        restore_applications(applications)
+
+
+def full_restore(old_assignments, applications, group_memberships):
+    """
+    Replay every assignment, application and group membership not yet journaled.
+
+    The applications are restored on their own threads while the account
+    assignments are created.
+    """
+    pending = [
+        assignment
+        for assignment in old_assignments
+        if account_assignment_key(assignment) not in journal
+    ]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        applications_restore = executor.submit(restore_applications_stage, applications)
+        with idc_metrics.phase("restore_account_assignments"):
+            if ASSIGNMENTS_IN_FLIGHT > 1:
+                restore_account_assignments_pipelined(pending)
+            else:
+                restore_account_assignments(pending)
+        applications_restore.result()
+
+    with idc_metrics.phase("restore_group_memberships"):
+        restore_group_memberships(group_memberships)
+
+
+def replay_application(inputs):
+    # Creates the application, or resumes from the one created before the failure,
+    # then its assignments like a restore does
+    if "ApplicationArn" not in inputs:
+        # Kept in the entry, so a failure of the configuration is not created twice
+        application_key = (
+            restore_journal.APPLICATION,
+            inputs["Application"]["ApplicationDetails"]["Name"],
+        )
+        inputs["ApplicationArn"] = journal.get(application_key).get(
+            "ApplicationArn"
+        ) or start_application(inputs["Application"])
+    create_application(inputs["Application"], inputs["ApplicationArn"])
+    restore_applications([inputs["Application"]])
+
+
+def replay_dead_letters(retry_all=False):
+    """Retry the failures of the dead-letter queue, see dead_letter.DeadLetterQueue.replay."""
+    with idc_metrics.phase("replay_dead_letters"):
+        return dead_letters.replay(
+            {
+                "account_assignment": replay_account_assignment,
+                "application": replay_application,
+                "application_assignment": lambda inputs: assign_application_principal(
+                    inputs["ApplicationArn"], tuple(inputs["Key"]), inputs["PrincipalId"]
+                ),
+                "group_membership": lambda inputs: add_group_member(
+                    inputs["Group"], inputs["User"]
+                ),
+            },
+            retry_all=retry_all,
+        )
+
+
+if __name__ == "__main__":
+    idc_metrics.enable("6_idc_remap")
+    if len(sys.argv) > 1 and not sys.argv[1].startswith("--"):
+        RESTORE_MODE = sys.argv[1]
+    instances = (ssoadminclient.list_instances()).get("Instances")
+    instanceARN = instances[0].get("InstanceArn")
+    identityStoreId = instances[0].get("IdentityStoreId")
+    with idc_metrics.phase("load_identity_index"):
+        entities = load_identity_index("output/IdentityReport.json")
+    # The journal and the dead letters of another target instance are refused,
+    # or archived with restore_journal.NEW_TARGET_FLAG
+    target = {"InstanceArn": instanceARN, "IdentityStoreId": identityStoreId}
+    new_target = restore_journal.NEW_TARGET_FLAG in sys.argv
+    try:
+        journal = restore_journal.RestoreJournal(JOURNAL_PATH, target, new_target)
+        if RESTORE_MODE != "plan":
+            dead_letters = dead_letter.DeadLetterQueue(
+                DEAD_LETTER_PATH,
+                resume=RESTORE_MODE == "replay",
+                target=target,
+                new_target=new_target,
+            )
+    except restore_journal.TargetMismatch as e:
+        raise SystemExit(str(e))
+    if len(journal):
+        print(f"Resuming from {JOURNAL_PATH}: {len(journal)} operations already completed")
+    if RESTORE_MODE != "plan":
+        operations = operation_log.OperationLog()
+
+    if RESTORE_MODE == "plan":
+        with idc_metrics.phase("plan_restore"):
+            plan_restore()
+    elif RESTORE_MODE == "apply":
+        with idc_metrics.phase("apply_restore"):
+            apply_restore()
+    elif RESTORE_MODE == "selective":
+        newPermissionSets = read_large_json("output/NewPermissionSets.json")
+        with idc_metrics.phase("selective_restore"):
+            selective_restore()
+    elif RESTORE_MODE == "replay":
+        newPermissionSets = read_large_json("output/NewPermissionSets.json")
+    else:
+        newPermissionSets = read_large_json("output/NewPermissionSets.json")
+        full_restore(
+            compact_report.iter_report("output/OldIdentityStoreReport.csv"),
+            iter_applications("output/OldApplications.json"),
+            load_group_memberships("output/OldGroupMemberships.json"),
+        )
+
+    if RESTORE_MODE != "plan":
+        if len(dead_letters):
+            replay_dead_letters(retry_all=RESTORE_MODE == "replay" and "--all" in sys.argv)
+        operations.close()
+    journal.close()
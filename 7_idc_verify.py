@@ -0,0 +1,276 @@
+import boto3, json
+import compact_report
+import idc_clients
+import idc_metrics
+import json_stream
+import restore_plan
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_REGION = "eu-west-1"
+# Permission sets, applications and principals fetched in parallel
+VERIFY_WORKERS = 16
+REPORT_PATH = "output/VerifyReport.json"
+
+session = boto3.Session(
+    aws_access_key_id="",
+    aws_secret_access_key="",
+)
+
+ssoadminclient = idc_clients.create_client(
+    session, "sso-admin", DEFAULT_REGION, workers=VERIFY_WORKERS
+)
+idstoreclient = idc_clients.create_client(
+    session, "identitystore", DEFAULT_REGION, workers=VERIFY_WORKERS
+)
+
+# Set from list_instances() when the script runs
+instanceARN = None
+identityStoreId = None
+
+
+def load_principal_names(file_path):
+    """Principal ID -> name, from the IdentityReport written by 5_new_idc_report.py."""
+    names = {}
+    try:
+        for entry in json_stream.iter_entries(file_path):
+            if isinstance(entry, tuple):
+                names[entry[1]["id"]] = entry[0]
+            else:
+                names[entry["id"]] = entry["Name"]
+    except FileNotFoundError:
+        print(f"{file_path} not found, every principal will be looked up")
+    return names
+
+
+def describe_principal(principal):
+    principal_type, principal_id = principal
+    try:
+        if principal_type == "USER":
+            return idstoreclient.describe_user(
+                IdentityStoreId=identityStoreId, UserId=principal_id
+            )["UserName"]
+        return idstoreclient.describe_group(
+            IdentityStoreId=identityStoreId, GroupId=principal_id
+        )["DisplayName"]
+    except idstoreclient.exceptions.ResourceNotFoundException:
+        return None
+
+
+def resolve_principal_names(principals, names):
+    """
+    Add the names of the principals missing from 'names', looked up in parallel.
+
+    Principals that no longer exist keep their ID as their name, so they still
+    show up in the comparison.
+    """
+    missing = sorted({principal for principal in principals if principal[1] not in names})
+    with ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as executor:
+        for principal, name in zip(missing, executor.map(describe_principal, missing)):
+            names[principal[1]] = name or principal[1]
+    return names
+
+
+def fetch_application(application):
+    arn = application["ApplicationArn"]
+    configuration = ssoadminclient.get_application_assignment_configuration(
+        ApplicationArn=arn
+    )
+    assignments = restore_plan.paginate(
+        ssoadminclient.list_application_assignments,
+        "ApplicationAssignments",
+        ApplicationArn=arn,
+    )
+    return {
+        "Details": application,
+        "AssignmentRequired": configuration.get("AssignmentRequired"),
+        "Assignments": [
+            (assignment["PrincipalType"], assignment["PrincipalId"])
+            for assignment in assignments
+        ],
+    }
+
+
+def fetch_target_applications(executor):
+    applications = restore_plan.paginate(
+        ssoadminclient.list_applications, "Applications", InstanceArn=instanceARN
+    )
+    return list(executor.map(fetch_application, applications))
+
+
+def normalize_application(details, assignment_required, assignments):
+    # The fields a restore sets, comparable between the backup and the target
+    return {
+        "ApplicationProviderArn": details.get("ApplicationProviderArn"),
+        "Status": details.get("Status"),
+        "PortalOptions": details.get("PortalOptions"),
+        "AssignmentRequired": assignment_required,
+        "Assignments": sorted(set(assignments)),
+    }
+
+
+def compare_permission_sets(old_permission_sets, target_permission_sets):
+    drift = []
+    for name in sorted(old_permission_sets.keys() & target_permission_sets.keys()):
+        old_managed, old_customer = restore_plan.policy_names(old_permission_sets[name])
+        new_managed, new_customer = restore_plan.policy_names(target_permission_sets[name])
+        fields = restore_plan.settings_drift(
+            old_permission_sets[name], target_permission_sets[name]
+        )
+        if (old_managed, old_customer) != (new_managed, new_customer) or fields:
+            drift.append(
+                {
+                    "Name": name,
+                    "MissingManagedPolicies": sorted(old_managed - new_managed),
+                    "ExtraManagedPolicies": sorted(new_managed - old_managed),
+                    "MissingCustomerManagedPolicies": sorted(old_customer - new_customer),
+                    "ExtraCustomerManagedPolicies": sorted(new_customer - old_customer),
+                    # Session duration, relay state, inline policy, boundary, tags
+                    "Fields": sorted(fields),
+                }
+            )
+    return {
+        "Missing": sorted(old_permission_sets.keys() - target_permission_sets.keys()),
+        "Extra": sorted(target_permission_sets.keys() - old_permission_sets.keys()),
+        "Drift": drift,
+    }
+
+
+def compare_applications(old_applications, target_applications, names):
+    old = {
+        application["ApplicationDetails"]["Name"]: normalize_application(
+            application["ApplicationDetails"],
+            application["AssignmentConfiguration"].get("AssignmentRequired"),
+            [
+                (assignment["PrincipalType"], assignment["PrincipalName"])
+                for assignment in application["Assignments"]
+            ],
+        )
+        for application in old_applications
+    }
+    target = {
+        application["Details"]["Name"]: normalize_application(
+            application["Details"],
+            application["AssignmentRequired"],
+            [
+                (principal_type, names[principal_id])
+                for principal_type, principal_id in application["Assignments"]
+            ],
+        )
+        for application in target_applications
+    }
+    drift = []
+    for name in sorted(old.keys() & target.keys()):
+        fields = [field for field in old[name] if old[name][field] != target[name][field]]
+        if fields:
+            drift.append({"Name": name, "Fields": fields})
+    return {
+        "Missing": sorted(old.keys() - target.keys()),
+        "Extra": sorted(target.keys() - old.keys()),
+        "Drift": drift,
+    }
+
+
+def verify():
+    """
+    Compare the target instance with the backup.
+
+    The target is crawled concurrently (permission sets and their assignments one
+    permission set per worker, applications alongside). Both sides are reduced to
+    sets of (account ID, permission set name, principal type, principal name)
+    tuples and compared, with the policies and settings of each permission set and
+    the restorable settings and assignments of each application.
+
+    Returns:
+        dict: The verification report, also written to REPORT_PATH.
+    """
+    with ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as executor:
+        applications_future = executor.submit(fetch_target_applications, executor)
+        with idc_metrics.phase("fetch_target_state"):
+            target = restore_plan.fetch_target_state(
+                ssoadminclient, instanceARN, workers=VERIFY_WORKERS
+            )
+        with idc_metrics.phase("fetch_target_applications"):
+            target_applications = applications_future.result()
+
+    principals = {(assignment[2], assignment[3]) for assignment in target["Assignments"]}
+    for application in target_applications:
+        principals.update(application["Assignments"])
+    with idc_metrics.phase("resolve_principal_names"):
+        names = resolve_principal_names(
+            principals, load_principal_names("output/IdentityReport.json")
+        )
+
+    expected = {
+        (
+            row["Account ID"],
+            row["Permission Set"],
+            row["Principal Type"],
+            row["Principal"],
+        )
+        for row in compact_report.iter_report("output/OldIdentityStoreReport.csv")
+    }
+    actual = {
+        (account_id, permission_set, principal_type, names[principal_id])
+        for account_id, permission_set, principal_type, principal_id in target[
+            "Assignments"
+        ]
+    }
+    with open("output/OldPermissionSets.json", "r") as file:
+        old_permission_sets = json.load(file)
+
+    report = {
+        "AccountAssignments": {
+            "Expected": len(expected),
+            "Matching": len(expected & actual),
+            "Missing": [list(row) for row in sorted(expected - actual)],
+            "Extra": [list(row) for row in sorted(actual - expected)],
+        },
+        "PermissionSets": compare_permission_sets(
+            old_permission_sets, target["PermissionSets"]
+        ),
+        "Applications": compare_applications(
+            json_stream.iter_entries("output/OldApplications.json"),
+            target_applications,
+            names,
+        ),
+    }
+    with open(REPORT_PATH, "w") as outfile:
+        json.dump(report, outfile, indent=2)
+    return report
+
+
+def summarize(report):
+    assignments = report["AccountAssignments"]
+    print(
+        f"\t-> AccountAssignments: {assignments['Matching']} of {assignments['Expected']} "
+        f"matching, {len(assignments['Missing'])} missing, {len(assignments['Extra'])} extra"
+    )
+    for kind in ["PermissionSets", "Applications"]:
+        changes = report[kind]
+        print(
+            f"\t-> {kind}: {len(changes['Missing'])} missing, {len(changes['Extra'])} extra, "
+            f"{len(changes['Drift'])} drifted"
+        )
+    return not (
+        assignments["Missing"]
+        or assignments["Extra"]
+        or any(
+            report[kind][key]
+            for kind in ["PermissionSets", "Applications"]
+            for key in ["Missing", "Extra", "Drift"]
+        )
+    )
+
+
+# MAIN
+if __name__ == "__main__":
+    idc_metrics.enable("7_idc_verify")
+    instances = (ssoadminclient.list_instances()).get("Instances")
+    instanceARN = instances[0].get("InstanceArn")
+    identityStoreId = instances[0].get("IdentityStoreId")
+    with idc_metrics.phase("verify"):
+        report = verify()
+    if summarize(report):
+        print(f"Done! The target matches the backup, see {REPORT_PATH}")
+    else:
+        raise SystemExit(f"The target differs from the backup, see {REPORT_PATH}")
@@ -0,0 +1,325 @@
+import argparse, json, os, sqlite3, time
+import compact_report
+import json_stream
+import restore_plan
+
+DB_NAME = "OldBackup.sqlite"
+
+SCHEMA = """
+CREATE TABLE assignments (
+    account_id TEXT, account_name TEXT, permission_set TEXT,
+    principal_type TEXT, principal TEXT
+);
+CREATE TABLE permission_sets (name TEXT PRIMARY KEY, arn TEXT, description TEXT, data TEXT);
+CREATE TABLE permission_set_policies (permission_set TEXT, policy_type TEXT, policy TEXT);
+CREATE TABLE applications (
+    name TEXT PRIMARY KEY, arn TEXT, provider_arn TEXT, status TEXT, data TEXT
+);
+CREATE TABLE application_assignments (application TEXT, principal_type TEXT, principal TEXT);
+CREATE TABLE group_memberships (group_name TEXT, user_name TEXT);
+"""
+
+# Created once the tables are filled, which is faster than updating them per row
+INDEXES = """
+CREATE INDEX assignments_account_id ON assignments (account_id);
+CREATE INDEX assignments_account_name ON assignments (account_name);
+CREATE INDEX assignments_permission_set ON assignments (permission_set);
+CREATE INDEX assignments_principal ON assignments (principal, principal_type);
+CREATE INDEX permission_set_policies_permission_set ON permission_set_policies (permission_set);
+CREATE INDEX application_assignments_principal ON application_assignments (principal, principal_type);
+CREATE INDEX group_memberships_group_name ON group_memberships (group_name);
+CREATE INDEX group_memberships_user_name ON group_memberships (user_name);
+"""
+
+# Columns compared by diff_databases, per table
+DIFF_COLUMNS = {
+    "assignments": "account_id, permission_set, principal_type, principal",
+    "permission_set_policies": "permission_set, policy_type, policy",
+    "application_assignments": "application, principal_type, principal",
+    "group_memberships": "group_name, user_name",
+}
+
+
+def database_path(output_dir="output"):
+    return os.path.join(output_dir, DB_NAME)
+
+
+def policy_rows(name, permission_set):
+    managed, customer_managed = restore_plan.policy_names(permission_set)
+    rows = [(name, "MANAGED", arn) for arn in sorted(managed)]
+    rows += [
+        (name, "CUSTOMER_MANAGED", path + policy)
+        for path, policy in sorted(customer_managed)
+    ]
+    # The inline policy by the hash of its document in the policy store
+    if permission_set.get("InlinePolicyHash"):
+        rows.append((name, "INLINE", permission_set["InlinePolicyHash"]))
+    boundary = permission_set.get("PermissionsBoundary")
+    if boundary:
+        reference = boundary.get("CustomerManagedPolicyReference")
+        rows.append(
+            (
+                name,
+                "PERMISSIONS_BOUNDARY",
+                reference.get("Path", "/") + reference["Name"]
+                if reference
+                else boundary.get("ManagedPolicyArn"),
+            )
+        )
+    return rows
+
+
+def build_database(output_dir="output"):
+    """
+    Build the SQLite query database of the backup files of an output directory.
+
+    Reads the assignment report (CSV or compact), OldPermissionSets.json,
+    OldApplications.json and, when present, OldGroupMemberships.json, and writes
+    them as indexed tables to DB_NAME in the same directory. The database is built
+    under a temporary name and swapped in once complete.
+
+    Returns:
+        str: The path of the database.
+    """
+    path = database_path(output_dir)
+    if os.path.exists(path + ".tmp"):
+        os.remove(path + ".tmp")
+    connection = sqlite3.connect(path + ".tmp")
+    try:
+        connection.executescript(SCHEMA)
+        columns = ["Account ID", "Account Name", "Permission Set", "Principal Type", "Principal"]
+        connection.executemany(
+            "INSERT INTO assignments VALUES (?, ?, ?, ?, ?)",
+            (
+                tuple(row[column] for column in columns)
+                for row in compact_report.iter_report(
+                    os.path.join(output_dir, "OldIdentityStoreReport.csv")
+                )
+            ),
+        )
+
+        with open(os.path.join(output_dir, "OldPermissionSets.json"), "r") as file:
+            permission_sets = json.load(file)
+        for name, permission_set in permission_sets.items():
+            connection.execute(
+                "INSERT INTO permission_sets VALUES (?, ?, ?, ?)",
+                (
+                    name,
+                    permission_set.get("PermissionSetArn"),
+                    permission_set.get("Description"),
+                    json.dumps(permission_set),
+                ),
+            )
+            connection.executemany(
+                "INSERT INTO permission_set_policies VALUES (?, ?, ?)",
+                policy_rows(name, permission_set),
+            )
+
+        for application in json_stream.iter_entries(
+            os.path.join(output_dir, "OldApplications.json")
+        ):
+            details = application["ApplicationDetails"]
+            connection.execute(
+                "INSERT INTO applications VALUES (?, ?, ?, ?, ?)",
+                (
+                    details["Name"],
+                    details.get("ApplicationArn"),
+                    details.get("ApplicationProviderArn"),
+                    details.get("Status"),
+                    json.dumps(application, default=str),
+                ),
+            )
+            connection.executemany(
+                "INSERT INTO application_assignments VALUES (?, ?, ?)",
+                [
+                    (details["Name"], assignment["PrincipalType"], assignment["PrincipalName"])
+                    for assignment in application["Assignments"]
+                ],
+            )
+
+        memberships_path = os.path.join(output_dir, "OldGroupMemberships.json")
+        if os.path.exists(memberships_path):
+            for group_name, user_names in json_stream.iter_json(memberships_path):
+                connection.executemany(
+                    "INSERT INTO group_memberships VALUES (?, ?)",
+                    [(group_name, user_name) for user_name in user_names],
+                )
+
+        connection.executescript(INDEXES)
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def who_has_access(connection, account):
+    """
+    Everyone with access to an account, given by ID or name.
+
+    Returns:
+        list: (permission set, principal type, principal, via group) tuples; group
+        members are listed as users with the group they inherit the access from.
+    """
+    return connection.execute(
+        """
+        SELECT permission_set, principal_type, principal, NULL FROM assignments
+        WHERE account_id = :account OR account_name = :account
+        UNION
+        SELECT a.permission_set, 'USER', m.user_name, a.principal
+        FROM assignments a JOIN group_memberships m ON m.group_name = a.principal
+        WHERE (a.account_id = :account OR a.account_name = :account)
+            AND a.principal_type = 'GROUP'
+        ORDER BY 1, 3, 4
+        """,
+        {"account": account},
+    ).fetchall()
+
+
+def principal_access(connection, principal):
+    """
+    The accounts and applications a user or group can reach, directly or through
+    the groups of a user.
+
+    Returns:
+        dict: {"Accounts": [(account ID, account name, permission set, via group)],
+        "Applications": [(application, via group)]}.
+    """
+    accounts = connection.execute(
+        """
+        SELECT account_id, account_name, permission_set, NULL FROM assignments
+        WHERE principal = :principal
+        UNION
+        SELECT a.account_id, a.account_name, a.permission_set, m.group_name
+        FROM group_memberships m JOIN assignments a
+            ON a.principal = m.group_name AND a.principal_type = 'GROUP'
+        WHERE m.user_name = :principal
+        ORDER BY 1, 3, 4
+        """,
+        {"principal": principal},
+    ).fetchall()
+    applications = connection.execute(
+        """
+        SELECT application, NULL FROM application_assignments
+        WHERE principal = :principal
+        UNION
+        SELECT a.application, m.group_name
+        FROM group_memberships m JOIN application_assignments a
+            ON a.principal = m.group_name AND a.principal_type = 'GROUP'
+        WHERE m.user_name = :principal
+        ORDER BY 1, 2
+        """,
+        {"principal": principal},
+    ).fetchall()
+    return {"Accounts": accounts, "Applications": applications}
+
+
+def permission_set_access(connection, name):
+    """
+    The policies of a permission set and the assignments that use it.
+
+    Returns:
+        dict: {"Policies": [(policy type, policy)],
+        "Assignments": [(account ID, account name, principal type, principal)]}.
+    """
+    policies = connection.execute(
+        "SELECT policy_type, policy FROM permission_set_policies "
+        "WHERE permission_set = ? ORDER BY 1, 2",
+        (name,),
+    ).fetchall()
+    assignments = connection.execute(
+        "SELECT account_id, account_name, principal_type, principal FROM assignments "
+        "WHERE permission_set = ? ORDER BY 1, 3, 4",
+        (name,),
+    ).fetchall()
+    return {"Policies": policies, "Assignments": assignments}
+
+
+def diff_databases(old_path, new_path):
+    """
+    Compare two backup databases, e.g. of two snapshots taken at different times.
+
+    Returns:
+        dict: Table -> {"Added": [...], "Removed": [...]}, the rows of DIFF_COLUMNS
+        only in the new or only in the old database.
+    """
+    connection = sqlite3.connect(new_path)
+    try:
+        connection.execute("ATTACH DATABASE ? AS old", (old_path,))
+        changes = {}
+        for table, columns in DIFF_COLUMNS.items():
+            added = f"SELECT {columns} FROM main.{table} EXCEPT SELECT {columns} FROM old.{table}"
+            removed = f"SELECT {columns} FROM old.{table} EXCEPT SELECT {columns} FROM main.{table}"
+            changes[table] = {
+                "Added": connection.execute(added + " ORDER BY 1").fetchall(),
+                "Removed": connection.execute(removed + " ORDER BY 1").fetchall(),
+            }
+        return changes
+    finally:
+        connection.close()
+
+
+def print_rows(rows, indent="\t"):
+    for row in rows:
+        print(indent + "\t".join("" if value is None else str(value) for value in row))
+
+
+# MAIN
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build and query the SQLite database of a backup."
+    )
+    parser.add_argument(
+        "--db", default=database_path(), help=f"database to query (default output/{DB_NAME})"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="build the database of an output directory")
+    build.add_argument("output_dir", nargs="?", default="output")
+    account = commands.add_parser("account", help="who has access to an account")
+    account.add_argument("account", help="account ID or name")
+    principal = commands.add_parser(
+        "principal", help="what a user or group can reach"
+    )
+    principal.add_argument("principal", help="user or group name")
+    permission_set = commands.add_parser(
+        "permission-set", help="policies and assignments of a permission set"
+    )
+    permission_set.add_argument("name")
+    diff = commands.add_parser("diff", help="compare two backup databases")
+    diff.add_argument("old_db")
+    diff.add_argument("new_db", nargs="?", help="default --db")
+    arguments = parser.parse_args()
+
+    start = time.monotonic()
+    if arguments.command == "build":
+        print(f"Done! '{build_database(arguments.output_dir)}' has been generated successfully!")
+    elif arguments.command == "diff":
+        changes = diff_databases(arguments.old_db, arguments.new_db or arguments.db)
+        for table, change in changes.items():
+            print(f"{table}: {len(change['Added'])} added, {len(change['Removed'])} removed")
+            print_rows(change["Added"], "\t+ ")
+            print_rows(change["Removed"], "\t- ")
+    else:
+        if not os.path.exists(arguments.db):
+            raise SystemExit(
+                f"{arguments.db} not found, run 'python backup_db.py build' first"
+            )
+        connection = sqlite3.connect(arguments.db)
+        if arguments.command == "account":
+            rows = who_has_access(connection, arguments.account)
+            print(f"{len(rows)} principal and permission set pairs with access to {arguments.account}")
+            print_rows(rows)
+        elif arguments.command == "principal":
+            access = principal_access(connection, arguments.principal)
+            print(f"{len(access['Accounts'])} account assignments:")
+            print_rows(access["Accounts"])
+            print(f"{len(access['Applications'])} applications:")
+            print_rows(access["Applications"])
+        else:
+            access = permission_set_access(connection, arguments.name)
+            print(f"{len(access['Policies'])} policies:")
+            print_rows(access["Policies"])
+            print(f"{len(access['Assignments'])} assignments:")
+            print_rows(access["Assignments"])
+        connection.close()
+    print(f"({(time.monotonic() - start) * 1000:.1f} ms)")
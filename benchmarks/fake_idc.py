@@ -0,0 +1,681 @@
+import datetime, json, random, threading, time, types, uuid
+from botocore.exceptions import ClientError
+
+INSTANCE_ARN = "arn:aws:sso:::instance/ssoins-fake"
+IDENTITY_STORE_ID = "d-fake"
+ROOT_ID = "r-fake"
+PAGE_SIZE = 100
+# Inline policies of the synthetic permission sets, shared by several of them
+INLINE_POLICIES = [
+    {"Version": "2012-10-17", "Statement": [{"Effect": "Allow", "Action": "s3:GetObject", "Resource": "*"}]},
+    {"Version": "2012-10-17", "Statement": [{"Effect": "Deny", "Action": "iam:*", "Resource": "*"}]},
+    {"Version": "2012-10-17", "Statement": [{"Effect": "Allow", "Action": "ec2:Describe*", "Resource": "*"}]},
+]
+
+
+class FakeError(ClientError):
+    code = "ValidationException"
+
+    def __init__(self, message, operation):
+        super().__init__({"Error": {"Code": self.code, "Message": message}}, operation)
+
+
+class ResourceNotFoundException(FakeError):
+    code = "ResourceNotFoundException"
+
+
+class ConflictException(FakeError):
+    code = "ConflictException"
+
+
+class ThrottlingException(FakeError):
+    code = "ThrottlingException"
+
+
+def page(items, key, NextToken=None, MaxResults=None):
+    start = int(NextToken or 0)
+    size = MaxResults or PAGE_SIZE
+    response = {key: items[start : start + size]}
+    if start + size < len(items):
+        response["NextToken"] = str(start + size)
+    return response
+
+
+class FakeIdC:
+    """
+    In-process stand-in for one AWS organization and its IdC instance.
+
+    Holds the state the scripts read and write (accounts, users, groups, permission
+    sets, account assignments, applications and async request statuses) behind one
+    lock, so clients can be used from many threads like real boto3 clients.
+
+    Args:
+        latency (float): Seconds every API call sleeps, to model network round trips.
+        throttle_rate (float): Probability that a call fails with ThrottlingException.
+        status_delay (float): Seconds before an async request (assignment creation or
+            deletion, permission set provisioning) leaves IN_PROGRESS.
+    """
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, status_delay=0.0, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.status_delay = status_delay
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.accounts = []
+        self.parents = {}  # account or OU ID -> parent ID
+        self.users = {}  # user ID -> user
+        self.groups = {}  # group ID -> group
+        self.user_names = {}  # user name -> user ID
+        self.group_names = {}  # display name -> group ID
+        self.memberships = {}  # group ID -> {user ID: membership ID}
+        self.permission_sets = {}  # ARN -> permission set
+        self.assignments = {}  # (account ID, permission set ARN) -> {(principal type, principal ID)}
+        self.provisioned = set()  # (permission set ARN, account ID)
+        self.applications = {}  # ARN -> application
+        self.requests = {}  # request ID -> async request
+        self.next_id = 0
+
+    @classmethod
+    def generate(cls, accounts=100, permission_sets=40, users=1000, groups=100,
+                 permission_sets_per_account=4, principals_per_assignment=3,
+                 applications=0, members_per_group=5, ous=10, seed=0, **options):
+        """
+        Build a synthetic organization, e.g. 1,000 accounts, 400 permission sets and
+        50k users. Every account gets 'permission_sets_per_account' random permission
+        sets, each assigned to 'principals_per_assignment' random users or groups, and
+        every group gets 'members_per_group' random users. Accounts are spread over
+        'ous' organizational units under the root.
+        """
+        fake = cls(seed=seed, **options)
+        r = fake.random
+        fake.accounts = [
+            {"Id": f"{100000000000 + i}", "Name": f"account-{i:05d}"} for i in range(accounts)
+        ]
+        for i, account in enumerate(fake.accounts):
+            fake.parents[account["Id"]] = f"ou-fake-{i % ous:04d}" if ous else ROOT_ID
+        for i in range(ous):
+            fake.parents[f"ou-fake-{i:04d}"] = ROOT_ID
+        for i in range(users):
+            fake.users[f"u-{i:07d}"] = {"UserId": f"u-{i:07d}", "UserName": f"user{i:07d}@example.com"}
+        for i in range(groups):
+            fake.groups[f"g-{i:06d}"] = {"GroupId": f"g-{i:06d}", "DisplayName": f"group-{i:06d}"}
+        fake.index_directory()
+        user_ids, group_ids = list(fake.users), list(fake.groups)
+        for group_id in group_ids:
+            fake.memberships[group_id] = {
+                user_id: fake.unique_id("m")
+                for user_id in r.sample(user_ids, min(members_per_group, len(user_ids)))
+            }
+        for i in range(permission_sets):
+            arn = f"{INSTANCE_ARN}/ps-{i:05d}"
+            fake.permission_sets[arn] = fake.new_permission_set(
+                arn, f"PermissionSet{i:05d}", f"Synthetic permission set {i}"
+            )
+            fake.permission_sets[arn]["ManagedPolicies"].append(
+                {"Name": "ReadOnlyAccess", "Arn": "arn:aws:iam::aws:policy/ReadOnlyAccess"}
+            )
+            if i % 4:
+                fake.permission_sets[arn]["InlinePolicy"] = json.dumps(INLINE_POLICIES[i % 3], indent=2)
+            if i % 5 == 0:
+                fake.permission_sets[arn]["PermissionsBoundary"] = {
+                    "ManagedPolicyArn": "arn:aws:iam::aws:policy/PowerUserAccess"
+                }
+            if i % 2:
+                fake.permission_sets[arn]["RelayState"] = "https://console.aws.amazon.com/s3"
+            fake.permission_sets[arn]["Tags"] = [{"Key": "team", "Value": f"team-{i % 3}"}]
+        permission_set_arns = list(fake.permission_sets)
+        for account in fake.accounts:
+            for arn in r.sample(permission_set_arns, min(permission_sets_per_account, len(permission_set_arns))):
+                fake.provisioned.add((arn, account["Id"]))
+                principals = fake.assignments.setdefault((account["Id"], arn), set())
+                for _ in range(principals_per_assignment):
+                    if group_ids and (not user_ids or r.random() < 0.5):
+                        principals.add(("GROUP", r.choice(group_ids)))
+                    else:
+                        principals.add(("USER", r.choice(user_ids)))
+        for i in range(applications):
+            arn = f"arn:aws:sso::123456789012:application/ssoins-fake/apl-{i:05d}"
+            fake.applications[arn] = fake.new_application(arn, f"application-{i:05d}")
+            if i % 2:
+                fake.applications[arn]["AuthenticationMethods"] = {
+                    "IAM": {"Iam": {"ActorPolicy": {"Version": "2012-10-17", "Statement": []}}}
+                }
+            for _ in range(principals_per_assignment):
+                principal = r.choice(group_ids) if group_ids else r.choice(user_ids)
+                fake.applications[arn]["Assignments"].add(
+                    ("GROUP" if principal in fake.groups else "USER", principal)
+                )
+        return fake
+
+    def empty_copy(self, **options):
+        """A target instance with the same accounts and directory but nothing assigned."""
+        fake = type(self)(**options)
+        fake.accounts = list(self.accounts)
+        fake.parents = dict(self.parents)
+        fake.users = dict(self.users)
+        fake.groups = dict(self.groups)
+        fake.index_directory()
+        return fake
+
+    def index_directory(self):
+        self.user_names = {user["UserName"]: user_id for user_id, user in self.users.items()}
+        self.group_names = {group["DisplayName"]: group_id for group_id, group in self.groups.items()}
+
+    def new_permission_set(self, arn, name, description):
+        return {
+            "Name": name,
+            "PermissionSetArn": arn,
+            "Description": description,
+            "CreatedDate": datetime.datetime(2024, 1, 1),
+            "SessionDuration": "PT1H",
+            "ManagedPolicies": [],
+            "CustomerManagedPolicies": [],
+            "InlinePolicy": "",
+            "PermissionsBoundary": None,
+            "Tags": [],
+        }
+
+    def new_application(self, arn, name, provider="arn:aws:sso::aws:applicationProvider/custom", **details):
+        application = {
+            "ApplicationArn": arn,
+            "ApplicationProviderArn": provider,
+            "Name": name,
+            "InstanceArn": INSTANCE_ARN,
+            "Status": "ENABLED",
+            "PortalOptions": {"Visibility": "ENABLED", "SignInOptions": {"Origin": "IDENTITY_CENTER"}},
+            "Description": f"Synthetic application {name}",
+            "CreatedDate": datetime.datetime(2024, 1, 1),
+            "AssignmentRequired": True,
+            "Assignments": set(),
+        }
+        application.update(details)
+        return application
+
+    def session(self):
+        return FakeSession(self)
+
+    def call_counts(self):
+        with self.lock:
+            return dict(self.calls)
+
+    def unique_id(self, prefix):
+        with self.lock:
+            self.next_id += 1
+            return f"{prefix}-{self.next_id:08d}"
+
+    def start_request(self, kind, on_success=None, failure_reason=None, **details):
+        request_id = str(uuid.UUID(int=self.random.getrandbits(128)))
+        created = datetime.datetime.now(datetime.timezone.utc)
+        with self.lock:
+            self.requests[request_id] = {
+                "Kind": kind,
+                "RequestId": request_id,
+                "Started": time.monotonic(),
+                "CreatedDate": created,
+                "Status": "IN_PROGRESS",
+                "OnSuccess": on_success,
+                "FailureReason": failure_reason,
+                "Details": details,
+            }
+        return {"RequestId": request_id, "Status": "IN_PROGRESS", "CreatedDate": created}
+
+    def request_status(self, request_id):
+        """Advance an async request whose delay has passed, then return its status."""
+        request = self.requests[request_id]
+        if request["Status"] == "IN_PROGRESS" and time.monotonic() - request["Started"] >= self.status_delay:
+            if request["FailureReason"]:
+                request["Status"] = "FAILED"
+            else:
+                request["Status"] = "SUCCEEDED"
+                if request["OnSuccess"]:
+                    request["OnSuccess"]()
+        status = {
+            "RequestId": request_id,
+            "Status": request["Status"],
+            "CreatedDate": request["CreatedDate"],
+            **request["Details"],
+        }
+        if request["Status"] == "FAILED":
+            status["FailureReason"] = request["FailureReason"]
+        return status
+
+
+class FakeSession:
+    def __init__(self, fake):
+        self.fake = fake
+
+    def client(self, service_name, region_name=None, config=None, **kwargs):
+        return FakeClient(self.fake, service_name)
+
+
+class FakeClient:
+    """
+    The sso-admin, identitystore and organizations operations used by the scripts.
+
+    Every public method is one API operation: it counts the call, sleeps the
+    configured latency and may raise ThrottlingException before touching state.
+    """
+
+    def __init__(self, fake, service_name):
+        self.fake = fake
+        self.service_name = service_name
+        self.handlers = []
+        self.exceptions = types.SimpleNamespace(
+            ResourceNotFoundException=ResourceNotFoundException,
+            ConflictException=ConflictException,
+            ThrottlingException=ThrottlingException,
+        )
+        self.meta = types.SimpleNamespace(
+            events=types.SimpleNamespace(register=self.register)
+        )
+
+    def register(self, event_name, handler, *args, **kwargs):
+        self.handlers.append(handler)
+
+    def __getattribute__(self, name):
+        attribute = object.__getattribute__(self, name)
+        if name.startswith("_") or not callable(attribute) or name == "register":
+            return attribute
+        fake = object.__getattribute__(self, "fake")
+        handlers = object.__getattribute__(self, "handlers")
+
+        def call(**kwargs):
+            operation = "".join(word.title() for word in name.split("_"))
+            for handler in handlers:
+                handler(model=types.SimpleNamespace(name=operation), params=kwargs)
+            with fake.lock:
+                fake.calls[name] = fake.calls.get(name, 0) + 1
+            if fake.latency:
+                time.sleep(fake.latency)
+            if fake.throttle_rate and fake.random.random() < fake.throttle_rate:
+                raise ThrottlingException("Rate exceeded", operation)
+            return attribute(**kwargs)
+
+        return call
+
+    # organizations
+
+    def list_accounts(self, **kwargs):
+        return page(self.fake.accounts, "Accounts", **kwargs)
+
+    def list_accounts_for_parent(self, ParentId, **kwargs):
+        accounts = [account for account in self.fake.accounts if self.fake.parents.get(account["Id"]) == ParentId]
+        return page(accounts, "Accounts", **kwargs)
+
+    def list_organizational_units_for_parent(self, ParentId, **kwargs):
+        units = [
+            {"Id": child, "Name": child}
+            for child, parent in sorted(self.fake.parents.items())
+            if parent == ParentId and child.startswith("ou-")
+        ]
+        return page(units, "OrganizationalUnits", **kwargs)
+
+    # identitystore
+
+    def list_users(self, IdentityStoreId, **kwargs):
+        return page(list(self.fake.users.values()), "Users", **kwargs)
+
+    def list_groups(self, IdentityStoreId, **kwargs):
+        return page(list(self.fake.groups.values()), "Groups", **kwargs)
+
+    def get_user_id(self, IdentityStoreId, AlternateIdentifier):
+        value = AlternateIdentifier["UniqueAttribute"]["AttributeValue"]
+        if value in self.fake.user_names:
+            return {"UserId": self.fake.user_names[value], "IdentityStoreId": IdentityStoreId}
+        raise ResourceNotFoundException(f"User {value} not found", "GetUserId")
+
+    def get_group_id(self, IdentityStoreId, AlternateIdentifier):
+        value = AlternateIdentifier["UniqueAttribute"]["AttributeValue"]
+        if value in self.fake.group_names:
+            return {"GroupId": self.fake.group_names[value], "IdentityStoreId": IdentityStoreId}
+        raise ResourceNotFoundException(f"Group {value} not found", "GetGroupId")
+
+    def describe_user(self, IdentityStoreId, UserId):
+        if UserId not in self.fake.users:
+            raise ResourceNotFoundException(f"User {UserId} not found", "DescribeUser")
+        return {**self.fake.users[UserId], "IdentityStoreId": IdentityStoreId}
+
+    def describe_group(self, IdentityStoreId, GroupId):
+        if GroupId not in self.fake.groups:
+            raise ResourceNotFoundException(f"Group {GroupId} not found", "DescribeGroup")
+        return {**self.fake.groups[GroupId], "IdentityStoreId": IdentityStoreId}
+
+    def list_group_memberships(self, IdentityStoreId, GroupId, **kwargs):
+        with self.fake.lock:
+            memberships = [
+                {
+                    "IdentityStoreId": IdentityStoreId,
+                    "MembershipId": membership_id,
+                    "GroupId": GroupId,
+                    "MemberId": {"UserId": user_id},
+                }
+                for user_id, membership_id in self.fake.memberships.get(GroupId, {}).items()
+            ]
+        return page(memberships, "GroupMemberships", **kwargs)
+
+    def create_group_membership(self, IdentityStoreId, GroupId, MemberId):
+        if GroupId not in self.fake.groups or MemberId["UserId"] not in self.fake.users:
+            raise ResourceNotFoundException("Group or user not found", "CreateGroupMembership")
+        membership_id = self.fake.unique_id("m")
+        with self.fake.lock:
+            members = self.fake.memberships.setdefault(GroupId, {})
+            if MemberId["UserId"] in members:
+                raise ConflictException("Membership already exists", "CreateGroupMembership")
+            members[MemberId["UserId"]] = membership_id
+        return {"MembershipId": membership_id, "IdentityStoreId": IdentityStoreId}
+
+    def delete_group_membership(self, IdentityStoreId, MembershipId):
+        with self.fake.lock:
+            for members in self.fake.memberships.values():
+                for user_id, membership_id in list(members.items()):
+                    if membership_id == MembershipId:
+                        del members[user_id]
+                        return {}
+        raise ResourceNotFoundException(f"Membership {MembershipId} not found", "DeleteGroupMembership")
+
+    # sso-admin: instances and permission sets
+
+    def list_instances(self, **kwargs):
+        return {"Instances": [{"InstanceArn": INSTANCE_ARN, "IdentityStoreId": IDENTITY_STORE_ID}]}
+
+    def list_permission_sets(self, InstanceArn, **kwargs):
+        return page(list(self.fake.permission_sets), "PermissionSets", **kwargs)
+
+    def _permission_set(self, arn):
+        if arn not in self.fake.permission_sets:
+            raise ResourceNotFoundException(f"Permission set {arn} not found", "PermissionSet")
+        return self.fake.permission_sets[arn]
+
+    def describe_permission_set(self, InstanceArn, PermissionSetArn):
+        permission_set = self._permission_set(PermissionSetArn)
+        return {
+            "PermissionSet": {
+                key: permission_set[key]
+                for key in ["Name", "PermissionSetArn", "Description", "CreatedDate", "SessionDuration", "RelayState"]
+                if permission_set.get(key) is not None
+            }
+        }
+
+    def list_managed_policies_in_permission_set(self, InstanceArn, PermissionSetArn, **kwargs):
+        return page(self._permission_set(PermissionSetArn)["ManagedPolicies"], "AttachedManagedPolicies", **kwargs)
+
+    def list_customer_managed_policy_references_in_permission_set(self, InstanceArn, PermissionSetArn, **kwargs):
+        return page(
+            self._permission_set(PermissionSetArn)["CustomerManagedPolicies"],
+            "CustomerManagedPolicyReferences",
+            **kwargs,
+        )
+
+    def get_inline_policy_for_permission_set(self, InstanceArn, PermissionSetArn):
+        return {"InlinePolicy": self._permission_set(PermissionSetArn)["InlinePolicy"]}
+
+    def put_inline_policy_to_permission_set(self, InstanceArn, PermissionSetArn, InlinePolicy):
+        with self.fake.lock:
+            self._permission_set(PermissionSetArn)["InlinePolicy"] = InlinePolicy
+        return {}
+
+    def get_permissions_boundary_for_permission_set(self, InstanceArn, PermissionSetArn):
+        boundary = self._permission_set(PermissionSetArn)["PermissionsBoundary"]
+        if boundary is None:
+            raise ResourceNotFoundException("No permissions boundary", "GetPermissionsBoundaryForPermissionSet")
+        return {"PermissionsBoundary": boundary}
+
+    def put_permissions_boundary_to_permission_set(self, InstanceArn, PermissionSetArn, PermissionsBoundary):
+        with self.fake.lock:
+            self._permission_set(PermissionSetArn)["PermissionsBoundary"] = PermissionsBoundary
+        return {}
+
+    def delete_inline_policy_from_permission_set(self, InstanceArn, PermissionSetArn):
+        with self.fake.lock:
+            self._permission_set(PermissionSetArn)["InlinePolicy"] = ""
+        return {}
+
+    def delete_permissions_boundary_from_permission_set(self, InstanceArn, PermissionSetArn):
+        with self.fake.lock:
+            self._permission_set(PermissionSetArn)["PermissionsBoundary"] = None
+        return {}
+
+    def update_permission_set(self, InstanceArn, PermissionSetArn, **kwargs):
+        with self.fake.lock:
+            self._permission_set(PermissionSetArn).update(kwargs)
+        return {}
+
+    def list_tags_for_resource(self, InstanceArn, ResourceArn, **kwargs):
+        return page(self._permission_set(ResourceArn)["Tags"], "Tags", **kwargs)
+
+    def tag_resource(self, InstanceArn, ResourceArn, Tags):
+        with self.fake.lock:
+            permission_set = self._permission_set(ResourceArn)
+            keys = {tag["Key"] for tag in Tags}
+            permission_set["Tags"] = [t for t in permission_set["Tags"] if t["Key"] not in keys] + list(Tags)
+        return {}
+
+    def untag_resource(self, InstanceArn, ResourceArn, TagKeys):
+        with self.fake.lock:
+            permission_set = self._permission_set(ResourceArn)
+            permission_set["Tags"] = [t for t in permission_set["Tags"] if t["Key"] not in TagKeys]
+        return {}
+
+    def create_permission_set(self, InstanceArn, Name, Description=None, **kwargs):
+        with self.fake.lock:
+            if any(ps["Name"] == Name for ps in self.fake.permission_sets.values()):
+                raise ConflictException(f"Permission set {Name} already exists", "CreatePermissionSet")
+        arn = f"{INSTANCE_ARN}/{self.fake.unique_id('ps')}"
+        permission_set = self.fake.new_permission_set(arn, Name, Description)
+        permission_set.update(kwargs)
+        with self.fake.lock:
+            self.fake.permission_sets[arn] = permission_set
+        return {"PermissionSet": {"Name": Name, "PermissionSetArn": arn, "Description": Description}}
+
+    def delete_permission_set(self, InstanceArn, PermissionSetArn):
+        with self.fake.lock:
+            self._permission_set(PermissionSetArn)
+            if any(arn == PermissionSetArn and principals for (_, arn), principals in self.fake.assignments.items()):
+                raise ConflictException("Permission set is still assigned", "DeletePermissionSet")
+            del self.fake.permission_sets[PermissionSetArn]
+            self.fake.provisioned = {p for p in self.fake.provisioned if p[0] != PermissionSetArn}
+        return {}
+
+    def attach_managed_policy_to_permission_set(self, InstanceArn, PermissionSetArn, ManagedPolicyArn):
+        with self.fake.lock:
+            self._permission_set(PermissionSetArn)["ManagedPolicies"].append(
+                {"Name": ManagedPolicyArn.split("/")[-1], "Arn": ManagedPolicyArn}
+            )
+        return {}
+
+    def detach_managed_policy_from_permission_set(self, InstanceArn, PermissionSetArn, ManagedPolicyArn):
+        with self.fake.lock:
+            permission_set = self._permission_set(PermissionSetArn)
+            permission_set["ManagedPolicies"] = [
+                p for p in permission_set["ManagedPolicies"] if p["Arn"] != ManagedPolicyArn
+            ]
+        return {}
+
+    def attach_customer_managed_policy_reference_to_permission_set(self, InstanceArn, PermissionSetArn, CustomerManagedPolicyReference):
+        with self.fake.lock:
+            self._permission_set(PermissionSetArn)["CustomerManagedPolicies"].append(
+                dict(CustomerManagedPolicyReference)
+            )
+        return {}
+
+    def detach_customer_managed_policy_reference_from_permission_set(self, InstanceArn, PermissionSetArn, CustomerManagedPolicyReference):
+        with self.fake.lock:
+            permission_set = self._permission_set(PermissionSetArn)
+            permission_set["CustomerManagedPolicies"] = [
+                p for p in permission_set["CustomerManagedPolicies"]
+                if p["Name"] != CustomerManagedPolicyReference["Name"]
+            ]
+        return {}
+
+    def provision_permission_set(self, InstanceArn, PermissionSetArn, TargetType, TargetId=None):
+        self._permission_set(PermissionSetArn)
+
+        def provision():
+            if TargetType == "AWS_ACCOUNT":
+                self.fake.provisioned.add((PermissionSetArn, TargetId))
+
+        status = self.fake.start_request("PROVISIONING", on_success=provision)
+        return {"PermissionSetProvisioningStatus": status}
+
+    def list_permission_set_provisioning_status(self, InstanceArn, **kwargs):
+        return self._list_request_statuses("PROVISIONING", "PermissionSetsProvisioningStatus", **kwargs)
+
+    def describe_permission_set_provisioning_status(self, InstanceArn, ProvisionPermissionSetRequestId):
+        with self.fake.lock:
+            return {"PermissionSetProvisioningStatus": self.fake.request_status(ProvisionPermissionSetRequestId)}
+
+    # sso-admin: account assignments
+
+    def list_permission_sets_provisioned_to_account(self, InstanceArn, AccountId, **kwargs):
+        with self.fake.lock:
+            arns = sorted(arn for arn, account_id in self.fake.provisioned if account_id == AccountId)
+        return page(arns, "PermissionSets", **kwargs)
+
+    def list_accounts_for_provisioned_permission_set(self, InstanceArn, PermissionSetArn, **kwargs):
+        with self.fake.lock:
+            account_ids = sorted(account_id for arn, account_id in self.fake.provisioned if arn == PermissionSetArn)
+        return page(account_ids, "AccountIds", **kwargs)
+
+    def list_account_assignments(self, InstanceArn, AccountId, PermissionSetArn, **kwargs):
+        with self.fake.lock:
+            assignments = [
+                {"AccountId": AccountId, "PermissionSetArn": PermissionSetArn, "PrincipalType": t, "PrincipalId": i}
+                for t, i in sorted(self.fake.assignments.get((AccountId, PermissionSetArn), ()))
+            ]
+        return page(assignments, "AccountAssignments", **kwargs)
+
+    def create_account_assignment(self, InstanceArn, TargetId, TargetType, PermissionSetArn, PrincipalType, PrincipalId):
+        self._permission_set(PermissionSetArn)
+        principals = self.fake.users if PrincipalType == "USER" else self.fake.groups
+
+        # Like the service, an assignment that already exists is a successful request
+        def create():
+            self.fake.assignments.setdefault((TargetId, PermissionSetArn), set()).add((PrincipalType, PrincipalId))
+            self.fake.provisioned.add((PermissionSetArn, TargetId))
+
+        status = self.fake.start_request(
+            "CREATION",
+            on_success=create,
+            failure_reason=None if PrincipalId in principals else "Principal does not exist",
+            TargetId=TargetId,
+            TargetType=TargetType,
+            PermissionSetArn=PermissionSetArn,
+            PrincipalType=PrincipalType,
+            PrincipalId=PrincipalId,
+        )
+        return {"AccountAssignmentCreationStatus": status}
+
+    def delete_account_assignment(self, InstanceArn, TargetId, TargetType, PermissionSetArn, PrincipalType, PrincipalId):
+        status = self.fake.start_request(
+            "DELETION",
+            on_success=lambda: self.fake.assignments.get((TargetId, PermissionSetArn), set()).discard(
+                (PrincipalType, PrincipalId)
+            ),
+            TargetId=TargetId,
+            TargetType=TargetType,
+            PermissionSetArn=PermissionSetArn,
+            PrincipalType=PrincipalType,
+            PrincipalId=PrincipalId,
+        )
+        return {"AccountAssignmentDeletionStatus": status}
+
+    def _list_request_statuses(self, kind, key, Filter=None, **kwargs):
+        with self.fake.lock:
+            statuses = [
+                self.fake.request_status(request_id)
+                for request_id, request in reversed(list(self.fake.requests.items()))
+                if request["Kind"] == kind
+            ]
+        # The listing only has the metadata of the requests, describe has the rest
+        statuses = [
+            {k: v for k, v in status.items() if k in ("RequestId", "Status", "CreatedDate")}
+            for status in statuses
+            if not Filter or status["Status"] == Filter["Status"]
+        ]
+        return page(statuses, key, **kwargs)
+
+    def list_account_assignment_creation_status(self, InstanceArn, **kwargs):
+        return self._list_request_statuses("CREATION", "AccountAssignmentsCreationStatus", **kwargs)
+
+    def describe_account_assignment_creation_status(self, InstanceArn, AccountAssignmentCreationRequestId):
+        with self.fake.lock:
+            return {"AccountAssignmentCreationStatus": self.fake.request_status(AccountAssignmentCreationRequestId)}
+
+    def list_account_assignment_deletion_status(self, InstanceArn, **kwargs):
+        return self._list_request_statuses("DELETION", "AccountAssignmentsDeletionStatus", **kwargs)
+
+    def describe_account_assignment_deletion_status(self, InstanceArn, AccountAssignmentDeletionRequestId):
+        with self.fake.lock:
+            return {"AccountAssignmentDeletionStatus": self.fake.request_status(AccountAssignmentDeletionRequestId)}
+
+    # sso-admin: applications
+
+    def _application(self, arn):
+        if arn not in self.fake.applications:
+            raise ResourceNotFoundException(f"Application {arn} not found", "Application")
+        return self.fake.applications[arn]
+
+    def _application_details(self, application):
+        return {
+            key: value
+            for key, value in application.items()
+            if key not in ("AssignmentRequired", "Assignments", "AuthenticationMethods")
+        }
+
+    def list_applications(self, InstanceArn, **kwargs):
+        with self.fake.lock:
+            applications = [self._application_details(a) for a in self.fake.applications.values()]
+        return page(applications, "Applications", **kwargs)
+
+    def describe_application(self, ApplicationArn):
+        return self._application_details(self._application(ApplicationArn))
+
+    def create_application(self, InstanceArn, ApplicationProviderArn, Name, **kwargs):
+        arn = f"arn:aws:sso::123456789012:application/ssoins-fake/{self.fake.unique_id('apl')}"
+        with self.fake.lock:
+            self.fake.applications[arn] = self.fake.new_application(
+                arn, Name, ApplicationProviderArn, **{k: v for k, v in kwargs.items() if k != "ClientToken"}
+            )
+        return {"ApplicationArn": arn}
+
+    def delete_application(self, ApplicationArn):
+        with self.fake.lock:
+            self._application(ApplicationArn)
+            del self.fake.applications[ApplicationArn]
+        return {}
+
+    def get_application_assignment_configuration(self, ApplicationArn):
+        return {"AssignmentRequired": self._application(ApplicationArn)["AssignmentRequired"]}
+
+    def put_application_assignment_configuration(self, ApplicationArn, AssignmentRequired):
+        self._application(ApplicationArn)["AssignmentRequired"] = AssignmentRequired
+        return {}
+
+    def get_application_authentication_method(self, ApplicationArn, AuthenticationMethodType):
+        methods = self._application(ApplicationArn).get("AuthenticationMethods", {})
+        if AuthenticationMethodType not in methods:
+            raise ResourceNotFoundException("No authentication method", "GetApplicationAuthenticationMethod")
+        return {"AuthenticationMethod": methods[AuthenticationMethodType]}
+
+    def put_application_authentication_method(self, ApplicationArn, AuthenticationMethodType, AuthenticationMethod):
+        self._application(ApplicationArn).setdefault("AuthenticationMethods", {})[AuthenticationMethodType] = AuthenticationMethod
+        return {}
+
+    def list_application_assignments(self, ApplicationArn, **kwargs):
+        assignments = [
+            {"ApplicationArn": ApplicationArn, "PrincipalType": t, "PrincipalId": i}
+            for t, i in sorted(self._application(ApplicationArn)["Assignments"])
+        ]
+        return page(assignments, "ApplicationAssignments", **kwargs)
+
+    def create_application_assignment(self, ApplicationArn, PrincipalId, PrincipalType):
+        with self.fake.lock:
+            self._application(ApplicationArn)["Assignments"].add((PrincipalType, PrincipalId))
+        return {}
+
+    def delete_application_assignment(self, ApplicationArn, PrincipalId, PrincipalType):
+        with self.fake.lock:
+            self._application(ApplicationArn)["Assignments"].discard((PrincipalType, PrincipalId))
+        return {}
@@ -0,0 +1,190 @@
+import argparse, atexit, contextlib, io, json, os, runpy, sys, tempfile, time
+
+import boto3
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import idc_metrics
+from fake_idc import FakeIdC
+
+
+def measure(name, fakes, run, verbose=False):
+    """
+    Time one stage and count the API calls it makes to the fakes.
+
+    Its metrics are written right away instead of at interpreter exit.
+
+    Returns:
+        dict: Wall time and API calls of the stage.
+    """
+    callsBefore = [fake.call_counts() for fake in fakes]
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    start = time.monotonic()
+    exit_status = 0
+    with output:
+        try:
+            run()
+        except SystemExit as e:
+            if isinstance(e.code, str):
+                print(f"{name}: {e.code}", file=sys.stderr)
+            exit_status = e.code if isinstance(e.code, int) else 1
+    elapsed = time.monotonic() - start
+    atexit.unregister(idc_metrics.write_reports)
+    idc_metrics.write_reports(os.path.splitext(name)[0])
+    idc_metrics.reset()
+    calls = {}
+    for fake, before in zip(fakes, callsBefore):
+        for operation, count in fake.call_counts().items():
+            if count != before.get(operation, 0):
+                calls[operation] = calls.get(operation, 0) + count - before.get(operation, 0)
+    return {
+        "Script": name,
+        "Seconds": round(elapsed, 3),
+        "APICalls": sum(calls.values()),
+        "Calls": calls,
+        "Exit": exit_status,
+    }
+
+
+def run_stage(script, fake, verbose=False):
+    """
+    Run one of the repository scripts end to end against a fake IdC.
+
+    boto3.Session is swapped for the fake's session, so the script runs unchanged,
+    from the current directory.
+    """
+    boto3.Session = lambda *args, **kwargs: fake.session()
+    # Scripts reading their command line must not see the benchmark's options
+    sys.argv = [script]
+    return measure(
+        script,
+        [fake],
+        lambda: runpy.run_path(os.path.join(REPO, script), run_name="__main__"),
+        verbose,
+    )
+
+
+def run_pipeline(source, target, verbose=False):
+    """Run idc_pipeline.py in one process, from the source fake into the target fake."""
+    boto3.Session = lambda *args, **kwargs: target.session()
+    import idc_pipeline
+
+    idc_pipeline.source_session = source.session()
+    idc_pipeline.target_session = target.session()
+    return measure("idc_pipeline.py", [source, target], idc_pipeline.run_pipeline, verbose)
+
+
+def assignment_names(fake):
+    """Account assignments of a fake as (account, permission set, type, principal name)."""
+    names = {}
+    names.update({user_id: user["UserName"] for user_id, user in fake.users.items()})
+    names.update({group_id: group["DisplayName"] for group_id, group in fake.groups.items()})
+    return {
+        (account_id, fake.permission_sets[arn]["Name"], principal_type, names[principal_id])
+        for (account_id, arn), principals in fake.assignments.items()
+        for principal_type, principal_id in principals
+    }
+
+
+def membership_names(fake):
+    """Group memberships of a fake as (group name, user name)."""
+    return {
+        (fake.groups[group_id]["DisplayName"], fake.users[user_id]["UserName"])
+        for group_id, members in fake.memberships.items()
+        for user_id in members
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the backup export and the restore against a synthetic fake organization."
+    )
+    parser.add_argument("--accounts", type=int, default=200)
+    parser.add_argument("--permission-sets", type=int, default=50)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--permission-sets-per-account", type=int, default=4)
+    parser.add_argument("--principals-per-assignment", type=int, default=3)
+    parser.add_argument("--applications", type=int, default=0)
+    parser.add_argument("--members-per-group", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per API call")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="probability a call is throttled")
+    parser.add_argument("--status-delay", type=float, default=0.5, help="seconds an async request stays IN_PROGRESS")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="directory for the output/ files (default: a temporary one)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--pipeline", action="store_true", help="run idc_pipeline.py instead of the separate scripts")
+    parser.add_argument("--verbose", action="store_true", help="show the scripts' own output")
+    parser.add_argument("--rollback", action="store_true", help="roll the restore back at the end with rollback.py")
+    args = parser.parse_args()
+
+    options = {"latency": args.latency, "throttle_rate": args.throttle_rate, "status_delay": args.status_delay}
+    source = FakeIdC.generate(
+        accounts=args.accounts,
+        permission_sets=args.permission_sets,
+        users=args.users,
+        groups=args.groups,
+        permission_sets_per_account=args.permission_sets_per_account,
+        principals_per_assignment=args.principals_per_assignment,
+        applications=args.applications,
+        members_per_group=args.members_per_group,
+        seed=args.seed,
+        **options,
+    )
+    target = source.empty_copy(**options)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="idc-bench-")
+    os.makedirs(os.path.join(workdir, "output"), exist_ok=True)
+    os.chdir(workdir)
+
+    if args.pipeline:
+        stages = [run_pipeline(source, target, args.verbose)]
+    else:
+        stages = [run_stage("1_old_idc_report.py", source, args.verbose)]
+        for script in ["2_idc_create_permsets.py", "5_new_idc_report.py", "6_idc_remap.py"]:
+            stages.append(run_stage(script, target, args.verbose))
+    stages.append(run_stage("7_idc_verify.py", target, args.verbose))
+
+    expected, restored = assignment_names(source), assignment_names(target)
+    results = {
+        "Parameters": vars(args),
+        "Stages": stages,
+        "Assignments": len(expected),
+        "Restored": len(expected & restored),
+        "Missing": len(expected - restored),
+        "Extra": len(restored - expected),
+        "Memberships": len(membership_names(source)),
+        "MembershipsRestored": len(membership_names(source) & membership_names(target)),
+    }
+
+    print(f"{'Stage':<28}{'Seconds':>10}{'API calls':>12}  Exit")
+    for stage in stages:
+        print(f"{stage['Script']:<28}{stage['Seconds']:>10.2f}{stage['APICalls']:>12}  {stage['Exit'] or 0}")
+    print(
+        f"Assignments: {results['Assignments']}, restored: {results['Restored']}, "
+        f"missing: {results['Missing']}, extra: {results['Extra']}"
+    )
+    print(f"Group memberships: {results['Memberships']}, restored: {results['MembershipsRestored']}")
+    if args.rollback:
+        stage = run_stage("rollback.py", target, args.verbose)
+        print(f"{stage['Script']:<28}{stage['Seconds']:>10.2f}{stage['APICalls']:>12}  {stage['Exit'] or 0}")
+        results["Rollback"] = dict(
+            stage,
+            Left={
+                "Assignments": len(assignment_names(target)),
+                "PermissionSets": len(target.permission_sets),
+                "Applications": len(target.applications),
+                "Memberships": len(membership_names(target)),
+            },
+        )
+        print("Left after the rollback: " + ", ".join(f"{k}: {v}" for k, v in results["Rollback"]["Left"].items()))
+    print(f"Outputs and metrics are in {workdir}")
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import array, csv, gzip, json, os
+import restore_index
+import snapshot_store
+
+FORMAT = "idc-compact-report"
+VERSION = 1
+
+# Tags of the dictionary table records
+ACCOUNT = "A"
+PERMISSION_SET = "P"
+PRINCIPAL = "U"
+
+
+def compact_path(report_path):
+    return os.path.splitext(report_path)[0] + ".idc.gz"
+
+
+def newest_path(report_path):
+    """
+    Pick between 'OldIdentityStoreReport.csv' and its compact variant.
+
+    Returns:
+        str: Whichever of the two exists and was written last.
+    """
+    candidates = [
+        path for path in [report_path, compact_path(report_path)] if os.path.exists(path)
+    ]
+    if not candidates:
+        return report_path
+    return max(candidates, key=os.path.getmtime)
+
+
+class CompactRow:
+    """
+    One assignment of a CompactReport, read like a row of csv.DictReader.
+
+    Only the row position is stored; the values are the shared strings of the
+    dictionary tables of the report.
+    """
+
+    __slots__ = ("report", "position")
+
+    def __init__(self, report, position):
+        self.report = report
+        self.position = position
+
+    def __getitem__(self, column):
+        report = self.report
+        account, permission_set, principal = report.codes(self.position)
+        if column == "Account ID":
+            return report.accounts[account][0]
+        if column == "Account Name":
+            return report.accounts[account][1]
+        if column == "Permission Set":
+            return report.permission_sets[permission_set]
+        if column == "Principal Type":
+            return report.principals[principal][0]
+        if column == "Principal":
+            return report.principals[principal][1]
+        raise KeyError(column)
+
+    def get(self, column, default=None):
+        try:
+            return self[column]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(snapshot_store.REPORT_HEADERS)
+
+    def __iter__(self):
+        return iter(snapshot_store.REPORT_HEADERS)
+
+    def __len__(self):
+        return len(snapshot_store.REPORT_HEADERS)
+
+
+class CompactReport:
+    """
+    Account assignments held as dictionary tables and integer-coded rows.
+
+    Accounts are (ID, name) pairs, permission sets are names and principals are
+    (type, name) pairs; every row is three codes into these tables, stored in one
+    flat array. Iterating yields CompactRow objects in report order.
+    """
+
+    def __init__(self):
+        self.accounts = []
+        self.permission_sets = []
+        self.principals = []
+        self.rows = array.array("I")
+
+    def __len__(self):
+        return len(self.rows) // 3
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield CompactRow(self, position)
+
+    def codes(self, position):
+        return self.rows[3 * position : 3 * position + 3]
+
+    def add_record(self, record):
+        if isinstance(record[0], int):
+            self.rows.extend(record)
+        elif record[0] == ACCOUNT:
+            self.accounts.append((record[1], record[2]))
+        elif record[0] == PERMISSION_SET:
+            self.permission_sets.append(record[1])
+        elif record[0] == PRINCIPAL:
+            self.principals.append((record[1], record[2]))
+        else:
+            raise ValueError(f"Unknown compact report record {record!r}")
+
+    def select(self, filters):
+        """
+        The rows matching the filters, compared by code rather than by string.
+
+        Args:
+            filters (dict): restore_index kind -> iterable of keys, with the same
+                meaning as in restore_index.select_rows.
+
+        Returns:
+            list: The matching CompactRow objects, in report order.
+        """
+        allowed = [None, None, None]
+        for kind, keys in filters.items():
+            keys = set(keys)
+            if kind == restore_index.ACCOUNT:
+                table, column, value = self.accounts, 0, lambda entry: entry[0]
+            elif kind == restore_index.PERMISSION_SET:
+                table, column, value = self.permission_sets, 1, lambda entry: entry
+            else:
+                table, column, value = self.principals, 2, lambda entry: entry[1]
+            allowed[column] = {
+                code for code, entry in enumerate(table) if value(entry) in keys
+            }
+        rows = self.rows
+        return [
+            CompactRow(self, position)
+            for position in range(len(self))
+            if all(
+                codes is None or rows[3 * position + column] in codes
+                for column, codes in enumerate(allowed)
+            )
+        ]
+
+
+class CompactReportWriter:
+    """
+    Stream account assignments to a gzip-compressed compact report.
+
+    The file holds one JSON array per line: a format header, then the table records
+    (["A", account ID, account name], ["P", permission set name] and
+    ["U", principal type, principal name]) and the rows ([account, permission set,
+    principal] codes). A table record is written just before the first row that
+    uses it, so rows can be written as they are produced and read back in one pass.
+    The written rows are also kept in memory as a CompactReport, in 'report'.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.report = CompactReport()
+        self._codes = {ACCOUNT: {}, PERMISSION_SET: {}, PRINCIPAL: {}}
+        self._file = gzip.open(path + ".tmp", "wt", encoding="utf-8")
+        self._write([FORMAT, VERSION])
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def _code(self, tag, key, record):
+        codes = self._codes[tag]
+        code = codes.get(key)
+        if code is None:
+            code = codes[key] = len(codes)
+            self._write(record)
+            self.report.add_record(record)
+        return code
+
+    def write_rows(self, entries):
+        """Write report entries, [account ID, account name, permission set, principal type, principal]."""
+        for account_id, account_name, permission_set, principal_type, principal in entries:
+            record = [
+                self._code(ACCOUNT, account_id, [ACCOUNT, account_id, account_name]),
+                self._code(PERMISSION_SET, permission_set, [PERMISSION_SET, permission_set]),
+                self._code(
+                    PRINCIPAL,
+                    (principal_type, principal),
+                    [PRINCIPAL, principal_type, principal],
+                ),
+            ]
+            self._write(record)
+            self.report.rows.extend(record)
+
+    def close(self):
+        self._file.close()
+        os.replace(self.path + ".tmp", self.path)
+
+
+def read_report(path):
+    """Load a compact report file, see CompactReportWriter."""
+    report = CompactReport()
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        header = json.loads(file.readline())
+        if header != [FORMAT, VERSION]:
+            raise ValueError(f"{path} is not a version {VERSION} compact report")
+        for line in file:
+            report.add_record(json.loads(line))
+    return report
+
+
+def iter_report(report_path):
+    """
+    Yield the rows of OldIdentityStoreReport.csv or of its compact variant.
+
+    Whichever of the two was written last is read. CSV rows are dictionaries and
+    compact rows are CompactRow objects; both are read by column name.
+    """
+    path = newest_path(report_path)
+    if path != report_path:
+        yield from read_report(path)
+        return
+    with open(report_path, "r") as report:
+        yield from csv.DictReader(report)
+
+
+def select_rows(report_path, filters):
+    """restore_index.select_rows, or CompactReport.select for a compact report."""
+    path = newest_path(report_path)
+    if path != report_path:
+        return read_report(path).select(filters)
+    return restore_index.select_rows(report_path, filters)
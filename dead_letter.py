@@ -0,0 +1,198 @@
+import json, os, random, threading, time
+import idc_clients
+import restore_journal
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+DEAD_LETTER_DIR = "output/deadletters"
+# Replay passes over the retryable entries, and the base of their jittered
+# exponential backoff, in seconds: pass n waits up to REPLAY_BACKOFF * 2**n
+REPLAY_ROUNDS = 3
+REPLAY_BACKOFF = 2.0
+# Entries replayed in parallel
+REPLAY_WORKERS = 8
+
+
+class OperationFailed(Exception):
+    """An asynchronous operation, e.g. a provisioning request, that ended as FAILED."""
+
+
+def dead_letter_path(script):
+    return os.path.join(DEAD_LETTER_DIR, f"{script}.jsonl")
+
+
+def classify(exception):
+    """
+    Returns:
+        tuple: (error class, error code, whether retrying later may succeed).
+        Throttling, transient service errors and connection failures are
+        retryable; validation errors, missing resources, etc. are not.
+    """
+    code = idc_clients.error_code(exception) or type(exception).__name__
+    retryable = (
+        code in idc_clients.THROTTLING_CODES
+        or code in idc_clients.TRANSIENT_CODES
+        or isinstance(exception, idc_clients.CONNECTION_ERRORS)
+    )
+    return type(exception).__name__, code, retryable
+
+
+class DeadLetterQueue:
+    """
+    Failed operations of a script, with everything needed to retry them.
+
+    Every failure is appended to the dead-letter file as one JSON line as soon as
+    it happens: the operation name, its inputs, the error class, code and message,
+    whether it is retryable and how many attempts were made. replay() retries the
+    entries through handlers registered by the script, one per operation, and
+    rewrites the file with what is still failing.
+
+    The file is only ever appended to on start: the entries of earlier runs stay
+    in it until a run resuming them replays them, so a new run never erases the
+    failures still waiting for 'replay'.
+
+    Like the restore journal, the file starts with a header record naming the
+    target instance, and the entries of another target are never replayed, see
+    restore_journal.check_target().
+    """
+
+    def __init__(self, path, resume=False, target=None, new_target=False):
+        """
+        Args:
+            path (str): The dead-letter file, see dead_letter_path().
+            resume (bool): Replay the entries of earlier runs too. Otherwise they
+                are kept in the file, but only the failures of this run are
+                replayed.
+            target (dict, optional): The InstanceArn and IdentityStoreId of the
+                target instance, written in the header record.
+            new_target (bool): Archive a file written for another target instead
+                of raising restore_journal.TargetMismatch.
+        """
+        self.path = path
+        self.target = target
+        self.lock = threading.Lock()
+        earlier, found, records = [], None, 0
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn last line from a crash
+                        continue
+                    records += 1
+                    if "Target" in entry:
+                        found = entry["Target"]
+                    else:
+                        earlier.append(entry)
+        if (
+            target is not None
+            and records
+            and restore_journal.check_target(path, found, target, new_target)
+        ):
+            earlier, records = [], 0
+        # The entries replayed by this run, and those of earlier runs only kept
+        self.entries, self.earlier = (earlier, []) if resume else ([], earlier)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        restore_journal.truncate_torn_line(path)
+        if target is not None and not records:
+            with open(path, "a") as file:
+                file.write(json.dumps({"Target": target}) + "\n")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _rewrite(self):
+        with open(self.path + ".tmp", "w") as file:
+            if self.target is not None:
+                file.write(json.dumps({"Target": self.target}) + "\n")
+            for entry in self.earlier + self.entries:
+                file.write(json.dumps(entry, default=str) + "\n")
+        os.replace(self.path + ".tmp", self.path)
+
+    def add(self, operation, inputs, exception, attempts=1):
+        """
+        Record a failed operation.
+
+        Args:
+            operation (str): The name of the handler that retries it.
+            inputs (dict): JSON-serializable arguments of the handler.
+            exception (Exception): The error it failed with.
+        """
+        error_class, code, retryable = classify(exception)
+        entry = {
+            "Operation": operation,
+            "Inputs": inputs,
+            "ErrorClass": error_class,
+            "ErrorCode": code,
+            "Message": str(exception),
+            "Retryable": retryable,
+            "Attempts": attempts,
+            "Time": datetime.now(timezone.utc).isoformat(),
+        }
+        line = json.dumps(entry, default=str)
+        with self.lock:
+            with open(self.path, "a") as file:
+                file.write(line + "\n")
+            self.entries.append(json.loads(line))
+
+    def replay(self, handlers, retry_all=False):
+        """
+        Retry the dead-lettered operations, REPLAY_ROUNDS times at most.
+
+        Each round waits a random time up to REPLAY_BACKOFF * 2**round, then runs
+        the entries REPLAY_WORKERS at a time. Entries that fail again are kept for
+        the next round with their new error, and the file is rewritten with the
+        entries still failing at the end, and those of earlier runs not resumed:
+        it is only cleared once everything in it was replayed successfully.
+
+        Args:
+            handlers (dict): Operation -> function taking the entry inputs and
+                raising if the operation fails again.
+            retry_all (bool): Also retry the entries whose error is not retryable.
+
+        Returns:
+            tuple: (entries that succeeded, entries still failing).
+        """
+        succeeded = 0
+        for replay_round in range(REPLAY_ROUNDS):
+            with self.lock:
+                batch, kept = [], []
+                for entry in self.entries:
+                    if entry["Operation"] in handlers and (retry_all or entry["Retryable"]):
+                        batch.append(entry)
+                    else:
+                        kept.append(entry)
+                self.entries = kept
+            if not batch:
+                break
+            time.sleep(random.uniform(0, REPLAY_BACKOFF * 2**replay_round))
+            print(f" -> Replaying {len(batch)} failed operations (round {replay_round + 1})")
+
+            def retry(entry):
+                try:
+                    handlers[entry["Operation"]](entry["Inputs"])
+                    return None
+                except Exception as e:
+                    error_class, code, retryable = classify(e)
+                    return dict(
+                        entry,
+                        ErrorClass=error_class,
+                        ErrorCode=code,
+                        Message=str(e),
+                        Retryable=retryable,
+                        Attempts=entry["Attempts"] + 1,
+                    )
+
+            with ThreadPoolExecutor(max_workers=REPLAY_WORKERS) as executor:
+                failed = [entry for entry in executor.map(retry, batch) if entry]
+            succeeded += len(batch) - len(failed)
+            with self.lock:
+                self.entries.extend(failed)
+        with self.lock:
+            self._rewrite()
+            remaining = len(self.entries)
+        print(f" -> Replayed {succeeded} failed operations, {remaining} left in {self.path}")
+        if self.earlier:
+            print(f" -> {len(self.earlier)} failed operations of earlier runs kept in {self.path}")
+        return succeeded, remaining
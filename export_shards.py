@@ -0,0 +1,276 @@
+import argparse, csv, glob, importlib, json, os, subprocess, sys
+import backup_db
+import compact_report
+import idc_metrics
+import json_stream
+import policy_store
+import restore_index
+import snapshot_store
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+# Sharded runs of 1_old_idc_report.py: 'plan' splits the organization into account
+# ID ranges, 'run' exports every range and the account-wide data each in its own
+# process and merges them, and 'merge' combines shards exported elsewhere, e.g. on
+# other hosts, once their 'output/shards/<shard>' directories are copied back.
+# 'plan' and 'run' write the shards of the run to 'output/shards/manifest.json',
+# and 'merge' only merges those, not the leftovers of an earlier run.
+export = importlib.import_module("1_old_idc_report")
+
+# Shard processes running at once
+SHARD_PROCESSES = os.cpu_count() or 4
+# Command exporting one shard, the shard is appended to it
+SHARD_COMMAND = [sys.executable, "1_old_idc_report.py"]
+# Shards of the last 'plan' or 'run', in the shards directory
+MANIFEST_FILE = "manifest.json"
+
+
+def plan_shards(count):
+    """
+    Split the accounts of the organization into 'count' contiguous ID ranges.
+
+    Returns:
+        list: Shards for 1_old_idc_report.py, "<first ID>-<last ID>", holding about
+        the same number of accounts each.
+    """
+    export.ListAccountsInOrganization()
+    account_ids = sorted(export.Accounts)
+    count = max(1, min(count, len(account_ids)))
+    shards = []
+    for index in range(count):
+        accounts = account_ids[
+            index * len(account_ids) // count : (index + 1) * len(account_ids) // count
+        ]
+        shards.append(f"{accounts[0]}-{accounts[-1]}")
+    return shards
+
+
+def run_shard(shard):
+    print(f"Exporting shard {shard}...")
+    return subprocess.run(SHARD_COMMAND + [shard]).returncode
+
+
+def run_shards(shards):
+    """Export the shards in SHARD_PROCESSES parallel processes."""
+    with ThreadPoolExecutor(max_workers=SHARD_PROCESSES) as executor:
+        failed = [
+            shard
+            for shard, returncode in zip(shards, executor.map(run_shard, shards))
+            if returncode
+        ]
+    if failed:
+        raise SystemExit(f"{len(failed)} of {len(shards)} shards failed: {failed}")
+
+
+def write_manifest(output_dir, shards, run_id=None):
+    """
+    Record the shards of a run in '<output_dir>/shards/MANIFEST_FILE'.
+
+    Returns:
+        str: The run ID, a timestamp unless given.
+    """
+    run_id = run_id or datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    os.makedirs(os.path.join(output_dir, "shards"), exist_ok=True)
+    with open(os.path.join(output_dir, "shards", MANIFEST_FILE), "w") as fp:
+        json.dump({"RunId": run_id, "Shards": shards}, fp, indent=2)
+    return run_id
+
+
+def read_manifest(output_dir):
+    """
+    The manifest of the shards of 'output_dir', or that of 'output' for the
+    instance directories of a multi-instance export, since 'plan' does not know
+    the instances.
+
+    Raises:
+        SystemExit: If there is no manifest.
+    """
+    for path in [
+        os.path.join(output_dir, "shards", MANIFEST_FILE),
+        os.path.join("output", "shards", MANIFEST_FILE),
+    ]:
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                return json.load(file)
+    raise SystemExit(
+        f"No {MANIFEST_FILE} in {os.path.join(output_dir, 'shards')}: run "
+        f"'python export_shards.py plan <N>' first, or list the shard directories to merge"
+    )
+
+
+def shard_dirs(output_dir):
+    """
+    The shard directories of the last run in '<output_dir>/shards', as listed by
+    its manifest. Directories left over from an earlier run are skipped.
+
+    Raises:
+        SystemExit: If there is no manifest, or a shard of the run is missing.
+    """
+    manifest = read_manifest(output_dir)
+    dirs = [os.path.join(output_dir, "shards", shard) for shard in manifest["Shards"]]
+    missing = [path for path in dirs if not os.path.isdir(path)]
+    if missing:
+        raise SystemExit(f"{len(missing)} shards of run {manifest['RunId']} are missing: {missing}")
+    for path in sorted(glob.glob(os.path.join(output_dir, "shards", "*"))):
+        if os.path.isdir(path) and path not in dirs:
+            print(f" -> Skipped shard '{path}', not part of run {manifest['RunId']}")
+    return dirs
+
+
+def merge_shards(output_dir="output", dirs=None):
+    """
+    Merge the partial exports of the shards into the canonical backup files.
+
+    The account assignment shards only hold report rows, with permission set ARNs
+    and principal IDs; the permission sets, applications, group memberships and
+    principal names come from the single ACCOUNT_WIDE_SHARD export, which names
+    the rows. The result does not depend on how the organization was sharded, or
+    on the order the shards finished in:
+    - report rows are deduplicated, since OU shards may overlap, and sorted by
+      account ID, permission set, principal type and principal
+    - permission sets and group memberships are sorted by name, and applications
+      by name
+    - the policy documents are copied to the policy store of the output directory
+
+    Args:
+        output_dir (str): Where the canonical files are written.
+        dirs (list, optional): Shard output directories, by default those of the
+            last run, see shard_dirs(). The ACCOUNT_WIDE_SHARD is always read from
+            '<output_dir>/shards'.
+
+    Raises:
+        SystemExit: If there are no shards, or no ACCOUNT_WIDE_SHARD export.
+    """
+    dirs = shard_dirs(output_dir) if dirs is None else sorted(dirs)
+    account_wide_dir = os.path.join(output_dir, "shards", export.ACCOUNT_WIDE_SHARD)
+    if not os.path.isdir(account_wide_dir):
+        raise SystemExit(
+            f"No '{export.ACCOUNT_WIDE_SHARD}' shard in {os.path.join(output_dir, 'shards')}, "
+            f"run 'python 1_old_idc_report.py {export.ACCOUNT_WIDE_SHARD}' first"
+        )
+    dirs = [path for path in dirs if os.path.abspath(path) != os.path.abspath(account_wide_dir)]
+    if not dirs:
+        raise SystemExit(f"No shards found in {os.path.join(output_dir, 'shards')}")
+
+    with open(os.path.join(account_wide_dir, "OldPermissionSets.json"), "r") as file:
+        permission_sets = json.load(file)
+    permission_set_names = {
+        permission_set["PermissionSetArn"]: name for name, permission_set in permission_sets.items()
+    }
+    with open(os.path.join(account_wide_dir, export.PRINCIPALS_FILE), "r") as file:
+        principal_names = json.load(file)
+    applications = {
+        application["ApplicationDetails"]["ApplicationArn"]: application
+        for application in json_stream.iter_entries(
+            os.path.join(account_wide_dir, "OldApplications.json")
+        )
+    }
+    memberships = dict(
+        json_stream.iter_json(os.path.join(account_wide_dir, "OldGroupMemberships.json"))
+    )
+    policies = policy_store.PolicyStore(output_dir)
+    policies.import_store(account_wide_dir)
+    print(f" -> Read shard '{account_wide_dir}'")
+
+    rows = set()
+    for path in dirs:
+        report_path = os.path.join(path, "OldIdentityStoreReport.csv")
+        for row in compact_report.iter_report(report_path):
+            account_id, account_name, permission_set_arn, principal_type, principal_id = (
+                row[column] for column in snapshot_store.REPORT_HEADERS
+            )
+            # Assignments of a principal or permission set deleted since the
+            # account-wide export have no name, as in an unsharded export
+            rows.add(
+                (
+                    account_id,
+                    account_name,
+                    permission_set_names.get(permission_set_arn, ""),
+                    principal_type,
+                    principal_names.get(principal_type, {}).get(principal_id, ""),
+                )
+            )
+        print(f" -> Read shard '{path}'")
+
+    report_path = os.path.join(output_dir, "OldIdentityStoreReport.csv")
+    with open(report_path, "w") as report:
+        csvwriter = csv.writer(report)
+        csvwriter.writerow(snapshot_store.REPORT_HEADERS)
+        csvwriter.writerows(sorted(rows))
+    restore_index.build_index(report_path)
+    with open(os.path.join(output_dir, "OldPermissionSets.json"), "w") as fp:
+        json.dump(dict(sorted(permission_sets.items())), fp, cls=export.SetEncoder)
+    with open(os.path.join(output_dir, "OldApplications.json"), "w") as fp:
+        json.dump(
+            sorted(
+                applications.values(),
+                key=lambda application: (
+                    application["ApplicationDetails"]["Name"],
+                    application["ApplicationDetails"]["ApplicationArn"],
+                ),
+            ),
+            fp,
+            cls=export.SetEncoder,
+            indent=2,
+        )
+    with open(os.path.join(output_dir, "OldGroupMemberships.json"), "w") as fp:
+        json.dump(
+            {group_name: sorted(memberships[group_name]) for group_name in sorted(memberships)},
+            fp,
+        )
+    if export.QUERY_DATABASE:
+        backup_db.build_database(output_dir)
+    print(
+        f"Done! {len(dirs)} shards merged into '{output_dir}': {len(rows)} assignments, "
+        f"{len(permission_sets)} permission sets, {len(applications)} applications"
+    )
+
+
+# MAIN
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shard and merge 1_old_idc_report.py runs.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    plan = commands.add_parser("plan", help="print the account ID ranges of N shards")
+    plan.add_argument("count", type=int)
+    run = commands.add_parser("run", help="export N shards in parallel and merge them")
+    run.add_argument("count", type=int)
+    merge = commands.add_parser("merge", help="merge the shards of an output directory")
+    merge.add_argument("output_dir", nargs="?", default="output")
+    merge.add_argument(
+        "shards", nargs="*", help="shard directories (default: those of the manifest)"
+    )
+    arguments = parser.parse_args()
+
+    if arguments.command == "plan":
+        shards = plan_shards(arguments.count)
+        for shard in shards:
+            print(shard)
+        write_manifest("output", [export.ACCOUNT_WIDE_SHARD] + shards)
+    elif arguments.command == "run":
+        idc_metrics.enable("export_shards")
+        # The account-wide data is exported once, by its own process
+        shards = [export.ACCOUNT_WIDE_SHARD] + plan_shards(arguments.count)
+        run_id = write_manifest("output", shards)
+        with idc_metrics.phase("run_shards"):
+            run_shards(shards)
+        # Every instance found has its own shards, see DiscoverInstances
+        output_dirs = sorted(
+            {
+                os.path.dirname(os.path.dirname(path))
+                for path in glob.glob(os.path.join("output", "**", "shards", "*"), recursive=True)
+                if os.path.isdir(path)
+            }
+        )
+        with idc_metrics.phase("merge_shards"):
+            for output_dir in output_dirs:
+                write_manifest(output_dir, shards, run_id)
+                merge_shards(
+                    output_dir,
+                    [
+                        os.path.join(output_dir, "shards", shard)
+                        for shard in shards
+                        if os.path.isdir(os.path.join(output_dir, "shards", shard))
+                    ],
+                )
+    else:
+        merge_shards(arguments.output_dir, arguments.shards or None)
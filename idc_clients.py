@@ -0,0 +1,212 @@
+import random, threading, time, uuid
+import botocore.exceptions
+import idc_metrics
+from botocore.config import Config
+
+# Starting and bounding request rate (calls per second) of every API operation
+INITIAL_RATE = 10.0
+MIN_RATE = 0.5
+MAX_RATE = 100.0
+# Starting and maximum number of concurrent calls of every API operation
+INITIAL_CONCURRENCY = 4
+# Attempts of a throttled or transiently failing call before giving up
+MAX_ATTEMPTS = 8
+
+THROTTLING_CODES = {
+    "ThrottlingException",
+    "Throttling",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "SlowDown",
+}
+TRANSIENT_CODES = {
+    "InternalServerException",
+    "InternalFailure",
+    "ServiceUnavailable",
+    "ServiceUnavailableException",
+}
+# Connection failures and timeouts raised by botocore itself rather than by the
+# service: EndpointConnectionError, ConnectTimeoutError, ConnectionClosedError,
+# ReadTimeoutError, ...
+CONNECTION_ERRORS = (
+    botocore.exceptions.ConnectionError,
+    botocore.exceptions.HTTPClientError,
+)
+# The connection errors raised before the request was sent, EndpointConnectionError,
+# ConnectTimeoutError, ...: the service cannot have acted on it
+CONNECT_ERRORS = (botocore.exceptions.ConnectionError,)
+# Operations that only read, safe to retry whatever the error
+READ_PREFIXES = ("list_", "describe_", "get_")
+# Mutating operations taking a ClientToken: one token is generated per logical
+# call and sent with every attempt, so a retry after a lost response returns the
+# object the first attempt created instead of creating a second one
+CLIENT_TOKEN_OPERATIONS = {
+    "create_application",
+    "create_instance",
+    "create_trusted_token_issuer",
+}
+
+
+def error_code(exception):
+    # The timeouts botocore inherits from requests have a 'response' of None
+    return (getattr(exception, "response", None) or {}).get("Error", {}).get("Code")
+
+
+def is_retryable(operation, exception):
+    """
+    Whether a failed call may be retried.
+
+    Throttled calls were rejected before doing anything, and calls that failed to
+    connect never reached the service, so they are always retried. Transient
+    service errors and timeouts only are for reads and for operations retried with
+    the same ClientToken: a mutating call without one, e.g. create_permission_set
+    or create_group_membership, may have been committed before its response was
+    lost, and retrying it could create a duplicate.
+    """
+    code = error_code(exception) or type(exception).__name__
+    if code in THROTTLING_CODES or isinstance(exception, CONNECT_ERRORS):
+        return True
+    if not operation.startswith(READ_PREFIXES) and operation not in CLIENT_TOKEN_OPERATIONS:
+        return False
+    return code in TRANSIENT_CODES or isinstance(exception, CONNECTION_ERRORS)
+
+
+class OperationLimiter:
+    """
+    Token bucket plus AIMD concurrency window for one API operation.
+
+    Every call takes a token, refilled at 'rate' per second, and a slot of the
+    concurrency window. Until the first throttling response, every successful call
+    raises the rate and the window by one (slow start), so an operation reaches
+    MAX_RATE within about a hundred calls; after it, successful calls raise them
+    additively. A throttling response halves both, so each operation settles just
+    below the highest rate the service accepts.
+    """
+
+    def __init__(self, max_concurrency):
+        self.condition = threading.Condition()
+        self.rate = INITIAL_RATE
+        self.tokens = 1.0
+        self.refilled = time.monotonic()
+        self.max_concurrency = max_concurrency
+        self.limit = float(min(INITIAL_CONCURRENCY, max_concurrency))
+        self.active = 0
+        self.slow_start = True
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    max(self.rate, 1.0), self.tokens + (now - self.refilled) * self.rate
+                )
+                self.refilled = now
+                if self.active < int(self.limit) and self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    self.active += 1
+                    return
+                if self.active >= int(self.limit):
+                    self.condition.wait()
+                else:
+                    self.condition.wait((1.0 - self.tokens) / self.rate)
+
+    def release(self, throttled):
+        with self.condition:
+            self.active -= 1
+            if throttled:
+                self.rate = max(MIN_RATE, self.rate / 2)
+                self.limit = max(1.0, self.limit / 2)
+                self.slow_start = False
+            elif self.slow_start:
+                self.rate = min(MAX_RATE, self.rate + 1.0)
+                self.limit = min(self.max_concurrency, self.limit + 1.0)
+            else:
+                self.rate = min(MAX_RATE, self.rate + 1.0 / self.rate)
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+
+class RateLimitedClient:
+    """
+    Wrap a boto3 client so every API call goes through its operation's limiter.
+
+    Throttled and transiently failing calls, and calls that fail to connect or
+    time out, are retried with jittered exponential backoff, up to MAX_ATTEMPTS;
+    mutating calls only when retrying cannot duplicate what they create, see
+    is_retryable(). Every attempt is recorded in idc_metrics. Everything that is
+    not an API method (meta, exceptions, ...) is passed through to the wrapped
+    client.
+    """
+
+    def __init__(self, client, max_concurrency, service_name=""):
+        self.client = client
+        self.service_name = service_name
+        self.max_concurrency = max_concurrency
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def limiter(self, operation):
+        with self.lock:
+            if operation not in self.limiters:
+                self.limiters[operation] = OperationLimiter(self.max_concurrency)
+            return self.limiters[operation]
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name.startswith("_") or not callable(attribute) or name in (
+            "can_paginate",
+            "get_paginator",
+            "get_waiter",
+            "close",
+        ):
+            return attribute
+
+        def call(**kwargs):
+            limiter = self.limiter(name)
+            if name in CLIENT_TOKEN_OPERATIONS and "ClientToken" not in kwargs:
+                kwargs["ClientToken"] = str(uuid.uuid4())
+            for attempt in range(MAX_ATTEMPTS):
+                with idc_metrics.phase("rate_limiter_wait"):
+                    limiter.acquire()
+                start = time.monotonic()
+                try:
+                    response = attribute(**kwargs)
+                except Exception as e:
+                    code = error_code(e) or type(e).__name__
+                    throttled = code in THROTTLING_CODES
+                    limiter.release(throttled)
+                    idc_metrics.record_call(
+                        self.service_name,
+                        name,
+                        time.monotonic() - start,
+                        error_code=code,
+                        throttled=throttled,
+                    )
+                    if attempt + 1 == MAX_ATTEMPTS or not is_retryable(name, e):
+                        raise
+                    with idc_metrics.phase("retry_backoff_sleep"):
+                        time.sleep(random.uniform(0, min(20.0, 0.2 * 2**attempt)))
+                    continue
+                limiter.release(False)
+                idc_metrics.record_call(self.service_name, name, time.monotonic() - start)
+                return response
+
+        return call
+
+
+def create_client(session, service_name, region_name=None, workers=10):
+    """
+    Create a rate-limited client shared by up to 'workers' threads.
+
+    The connection pool is sized to the worker count, and botocore's own retries
+    are turned off because the wrapper retries throttled calls and connection
+    errors itself.
+    """
+    config = Config(
+        max_pool_connections=max(workers, 10),
+        retries={"mode": "standard", "max_attempts": 1},
+    )
+    client = session.client(service_name, region_name=region_name, config=config)
+    return RateLimitedClient(
+        client, max_concurrency=max(workers, 1), service_name=service_name
+    )
@@ -0,0 +1,160 @@
+import atexit, bisect, json, os, threading, time
+from contextlib import contextmanager
+
+METRICS_DIR = "output/metrics"
+# Upper bounds, in seconds, of the API latency histogram buckets
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+_lock = threading.Lock()
+_calls = {}  # (service, operation) -> call statistics
+_phases = {}  # phase name -> {"Runs", "Seconds"}
+
+
+def record_call(service, operation, seconds, error_code=None, throttled=False):
+    """Record one API call attempt, successful or not, with its latency."""
+    with _lock:
+        stats = _calls.get((service, operation))
+        if stats is None:
+            stats = _calls[(service, operation)] = {
+                "Calls": 0,
+                "Errors": {},
+                "Throttles": 0,
+                "Seconds": 0.0,
+                "Buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+            }
+        stats["Calls"] += 1
+        stats["Seconds"] += seconds
+        stats["Buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        if error_code:
+            stats["Errors"][error_code] = stats["Errors"].get(error_code, 0) + 1
+        if throttled:
+            stats["Throttles"] += 1
+
+
+@contextmanager
+def phase(name):
+    """
+    Time a phase of a script, e.g. 'GenerateFiles' or the status polling sleeps.
+
+    A phase can run several times, possibly on several threads; its runs and total
+    wall time are accumulated.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - start
+        with _lock:
+            stats = _phases.setdefault(name, {"Runs": 0, "Seconds": 0.0})
+            stats["Runs"] += 1
+            stats["Seconds"] += elapsed
+
+
+def summary():
+    with _lock:
+        return {
+            "Calls": [
+                {
+                    "Service": service,
+                    "Operation": operation,
+                    "Calls": stats["Calls"],
+                    "Errors": dict(stats["Errors"]),
+                    "Throttles": stats["Throttles"],
+                    "Seconds": round(stats["Seconds"], 6),
+                    "Histogram": dict(
+                        zip(
+                            [str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"],
+                            stats["Buckets"],
+                        )
+                    ),
+                }
+                for (service, operation), stats in sorted(_calls.items())
+            ],
+            "Phases": {
+                name: {"Runs": stats["Runs"], "Seconds": round(stats["Seconds"], 6)}
+                for name, stats in _phases.items()
+            },
+        }
+
+
+def prometheus_lines(script):
+    data = summary()
+    lines = [
+        "# HELP idc_api_calls_total API call attempts.",
+        "# TYPE idc_api_calls_total counter",
+    ]
+    for call in data["Calls"]:
+        labels = f'script="{script}",service="{call["Service"]}",operation="{call["Operation"]}"'
+        lines.append(f"idc_api_calls_total{{{labels}}} {call['Calls']}")
+    lines += [
+        "# HELP idc_api_throttles_total API calls rejected by throttling.",
+        "# TYPE idc_api_throttles_total counter",
+    ]
+    for call in data["Calls"]:
+        labels = f'script="{script}",service="{call["Service"]}",operation="{call["Operation"]}"'
+        lines.append(f"idc_api_throttles_total{{{labels}}} {call['Throttles']}")
+    lines += [
+        "# HELP idc_api_errors_total API calls that failed, by error code.",
+        "# TYPE idc_api_errors_total counter",
+    ]
+    for call in data["Calls"]:
+        for code, count in sorted(call["Errors"].items()):
+            labels = f'script="{script}",service="{call["Service"]}",operation="{call["Operation"]}",code="{code}"'
+            lines.append(f"idc_api_errors_total{{{labels}}} {count}")
+    lines += [
+        "# HELP idc_api_call_duration_seconds API call latency.",
+        "# TYPE idc_api_call_duration_seconds histogram",
+    ]
+    for call in data["Calls"]:
+        labels = f'script="{script}",service="{call["Service"]}",operation="{call["Operation"]}"'
+        cumulative = 0
+        for bound, count in call["Histogram"].items():
+            cumulative += count
+            lines.append(
+                f'idc_api_call_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}'
+            )
+        lines.append(f"idc_api_call_duration_seconds_sum{{{labels}}} {call['Seconds']}")
+        lines.append(f"idc_api_call_duration_seconds_count{{{labels}}} {call['Calls']}")
+    lines += [
+        "# HELP idc_phase_duration_seconds Wall time spent in each phase.",
+        "# TYPE idc_phase_duration_seconds gauge",
+    ]
+    for name, stats in data["Phases"].items():
+        lines.append(
+            f'idc_phase_duration_seconds{{script="{script}",phase="{name}"}} {stats["Seconds"]}'
+        )
+    lines += [
+        "# HELP idc_phase_runs_total Times each phase ran.",
+        "# TYPE idc_phase_runs_total counter",
+    ]
+    for name, stats in data["Phases"].items():
+        lines.append(f'idc_phase_runs_total{{script="{script}",phase="{name}"}} {stats["Runs"]}')
+    return lines
+
+
+def write_reports(script):
+    """
+    Write the JSON summary and the Prometheus textfile of a script run.
+
+    Files go to METRICS_DIR as '<script>.json' and '<script>.prom'. The textfile is
+    written to a temporary name first, as the node_exporter textfile collector
+    expects.
+    """
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, f"{script}.json"), "w") as outfile:
+        json.dump(summary(), outfile, indent=2)
+    promPath = os.path.join(METRICS_DIR, f"{script}.prom")
+    with open(promPath + ".tmp", "w") as outfile:
+        outfile.write("\n".join(prometheus_lines(script)) + "\n")
+    os.replace(promPath + ".tmp", promPath)
+
+
+def reset():
+    with _lock:
+        _calls.clear()
+        _phases.clear()
+
+
+def enable(script):
+    """Write the metrics of this run when the script exits."""
+    atexit.register(write_reports, script)
@@ -0,0 +1,209 @@
+import boto3, importlib, json, sys
+import dead_letter
+import idc_clients
+import idc_metrics
+import operation_log
+import restore_journal
+import snapshot_store
+from concurrent.futures import ThreadPoolExecutor
+
+# Runs 1_old_idc_report.py, 2_idc_create_permsets.py, 5_new_idc_report.py and
+# 6_idc_remap.py in one process: clients are shared, each stage gets the data of
+# the previous ones in memory, and the usual output files are still written as
+# checkpoints, so any script can be re-run on its own afterwards.
+export = importlib.import_module("1_old_idc_report")
+createPermSets = importlib.import_module("2_idc_create_permsets")
+identityReport = importlib.import_module("5_new_idc_report")
+remap = importlib.import_module("6_idc_remap")
+
+SOURCE_REGION = "eu-west-1"
+TARGET_REGION = "eu-west-1"
+# Instance to export when the source region holds several (None = the only one)
+SOURCE_INSTANCE_ARN = None
+# Concurrent calls shared by every stage that works on the target instance
+TARGET_WORKERS = 32
+
+source_session = boto3.Session(
+    aws_access_key_id="",
+    aws_secret_access_key="",
+)
+target_session = boto3.Session(
+    aws_access_key_id="",
+    aws_secret_access_key="",
+)
+
+
+def connect():
+    """
+    Point every stage at the shared sessions and clients.
+
+    The export keeps its per-instance clients from the source session. The target
+    stages share one sso-admin and one identitystore client, so their rate limits
+    are tracked together.
+
+    Returns:
+        dict: The target instance, from list_instances().
+    """
+    export.session = source_session
+    export.INSTANCE_REGIONS = [SOURCE_REGION]
+    # The restore stages need every row in memory, which an incremental run skips
+    export.INCREMENTAL_BACKUP = False
+    export.orgsclient = idc_clients.create_client(
+        source_session, "organizations", workers=export.EXPORT_WORKERS
+    )
+
+    ssoadminclient = idc_clients.create_client(
+        target_session, "sso-admin", TARGET_REGION, workers=TARGET_WORKERS
+    )
+    idstoreclient = idc_clients.create_client(
+        target_session, "identitystore", TARGET_REGION, workers=TARGET_WORKERS
+    )
+    createPermSets.ssoadminclient = ssoadminclient
+    identityReport.ssoadminclient = ssoadminclient
+    identityReport.idstoreclient = idstoreclient
+    remap.ssoadminclient = ssoadminclient
+    remap.idstoreclient = idstoreclient
+
+    target = ssoadminclient.list_instances()["Instances"][0]
+    createPermSets.newIdCInstanceARN = target["InstanceArn"]
+    identityReport.InstanceARN = target["InstanceArn"]
+    identityReport.IdentityStoreId = target["IdentityStoreId"]
+    remap.instanceARN = target["InstanceArn"]
+    remap.identityStoreId = target["IdentityStoreId"]
+    return target
+
+
+def export_source():
+    """
+    Export the source instance, see 1_old_idc_report.py.
+
+    Returns:
+        dict: The exported instance, with its data in memory.
+    """
+    instances = export.RunPhase(export.DiscoverInstances)
+    if SOURCE_INSTANCE_ARN:
+        instances = [i for i in instances if i["InstanceArn"] == SOURCE_INSTANCE_ARN]
+    if len(instances) != 1:
+        raise SystemExit(
+            f"Found {len(instances)} matching source instances, "
+            "set SOURCE_INSTANCE_ARN to the one to migrate"
+        )
+    return export.ExportAllInstances(instances)[0]
+
+
+def create_permission_sets(instance, assignments):
+    """Create and provision the permission sets, see 2_idc_create_permsets.py."""
+    new_permission_sets = createPermSets.createPermissionSets(
+        instance["PermissionSetsData"]
+    )
+    with open("output/NewPermissionSets.json", "w") as outfile:
+        json.dump(new_permission_sets, outfile, cls=createPermSets.SetEncoder)
+    if createPermSets.PROVISION_PERMISSION_SETS:
+        with idc_metrics.phase("provisionPermissionSets"):
+            createPermSets.provisionPermissionSets(
+                new_permission_sets,
+                createPermSets.getAccountsByPermissionSet(assignments),
+            )
+    # Retried before the account assignments, which need the permission sets
+    if len(createPermSets.deadLetters) and createPermSets.replayDeadLetters(
+        new_permission_sets
+    ):
+        with open("output/NewPermissionSets.json", "w") as outfile:
+            json.dump(new_permission_sets, outfile, cls=createPermSets.SetEncoder)
+    return new_permission_sets
+
+
+def resolve_principals(instance, assignments):
+    """Resolve the backup principals in the target, see 5_new_idc_report.py."""
+    if identityReport.PRINCIPAL_RESOLUTION == "backup":
+        with idc_metrics.phase("mapBackupPrincipals"):
+            identityReport.mapBackupPrincipals(
+                identityReport.getPrincipals(
+                    assignments,
+                    instance["Applications"],
+                    instance["GroupMemberships"].items(),
+                )
+            )
+    else:
+        with idc_metrics.phase("mapUserIDs"):
+            identityReport.mapUserIDs()
+        with idc_metrics.phase("mapGroupIDs"):
+            identityReport.mapGroupIDs()
+    identityReport.writeIdentityReport()
+    return identityReport.report
+
+
+def run_pipeline():
+    """
+    Export the source, then restore it into the target, in one process.
+
+    Permission set creation and provisioning run while the principals are
+    resolved, and the group memberships are restored as soon as the principals
+    are known, before the permission sets are done. The account assignments and
+    applications follow once both are ready, restored at the same time.
+    """
+    target = connect()
+    with idc_metrics.phase("export"):
+        instance = export_source()
+    if export.COMPACT_REPORT:
+        assignments = list(instance["Entries"])
+    else:
+        assignments = [
+            dict(zip(snapshot_store.REPORT_HEADERS, entry))
+            for entry in instance["Entries"]
+        ]
+
+    # The journal and the dead letters of another target instance are refused, or
+    # archived with restore_journal.NEW_TARGET_FLAG
+    target = {key: target[key] for key in ["InstanceArn", "IdentityStoreId"]}
+    new_target = restore_journal.NEW_TARGET_FLAG in sys.argv
+    try:
+        remap.journal = restore_journal.RestoreJournal(remap.JOURNAL_PATH, target, new_target)
+        createPermSets.deadLetters = dead_letter.DeadLetterQueue(
+            createPermSets.DEAD_LETTER_PATH, target=target, new_target=new_target
+        )
+        remap.dead_letters = dead_letter.DeadLetterQueue(
+            remap.DEAD_LETTER_PATH, target=target, new_target=new_target
+        )
+    except restore_journal.TargetMismatch as e:
+        raise SystemExit(str(e))
+    createPermSets.operationLog = remap.operations = operation_log.OperationLog()
+    if len(remap.journal):
+        print(
+            f"Resuming from {remap.JOURNAL_PATH}: "
+            f"{len(remap.journal)} operations already completed"
+        )
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        permission_sets = executor.submit(create_permission_sets, instance, assignments)
+        remap.entities = executor.submit(resolve_principals, instance, assignments).result()
+        memberships = executor.submit(
+            remap.restore_group_memberships, instance["GroupMemberships"].items()
+        )
+        remap.newPermissionSets = permission_sets.result()
+        memberships.result()
+
+    pending = [
+        assignment
+        for assignment in assignments
+        if remap.account_assignment_key(assignment) not in remap.journal
+    ]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        applications = executor.submit(
+            remap.restore_applications_stage, instance["Applications"]
+        )
+        with idc_metrics.phase("restore_account_assignments"):
+            if remap.ASSIGNMENTS_IN_FLIGHT > 1:
+                remap.restore_account_assignments_pipelined(pending)
+            else:
+                remap.restore_account_assignments(pending)
+        applications.result()
+    if len(remap.dead_letters):
+        remap.replay_dead_letters()
+    remap.operations.close()
+    remap.journal.close()
+
+
+# MAIN
+if __name__ == "__main__":
+    idc_metrics.enable("idc_pipeline")
+    run_pipeline()
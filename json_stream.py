@@ -0,0 +1,100 @@
+import json, os
+
+CHUNK_SIZE = 1 << 16
+
+_decoder = json.JSONDecoder()
+
+
+def _skip(buffer, position, characters=" \t\r\n"):
+    while position < len(buffer) and buffer[position] in characters:
+        position += 1
+    return position
+
+
+def iter_json(file_path):
+    """
+    Stream the entries of a JSON file whose top level is an object or an array.
+
+    The file is read in CHUNK_SIZE pieces and each entry is decoded on its own, so
+    memory stays at one chunk plus one entry however large the file is.
+
+    Yields:
+        (key, value) tuples for an object, values for an array.
+    """
+    with open(file_path, "r") as file:
+        buffer, eof = file.read(CHUNK_SIZE), False
+        position = _skip(buffer, 0)
+        is_object = buffer[position] == "{"
+        position += 1
+        while True:
+            position = _skip(buffer, position, " \t\r\n,")
+            if position < len(buffer) and buffer[position] in "]}":
+                return
+            try:
+                if is_object:
+                    key, end = _decoder.raw_decode(buffer, position)
+                    end = _skip(buffer, _skip(buffer, end) + 1)
+                    value, end = _decoder.raw_decode(buffer, end)
+                    entry = (key, value)
+                else:
+                    entry, end = _decoder.raw_decode(buffer, position)
+                # An entry is only complete once the delimiter after it is in the
+                # buffer: a number split across two chunks, e.g. '3.' and '14',
+                # decodes as 3 without it
+                following = _skip(buffer, end)
+                if not eof and (following >= len(buffer) or buffer[following] not in ",]}"):
+                    raise ValueError
+            except ValueError:
+                if eof:
+                    raise
+                chunk = file.read(CHUNK_SIZE)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield entry
+            position = end
+
+
+def iter_json_lines(file_path):
+    """Yield one decoded entry per line of a line-delimited JSON file."""
+    with open(file_path, "r") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def lines_path(file_path):
+    return os.path.splitext(file_path)[0] + ".jsonl"
+
+
+def newest_path(file_path):
+    """
+    Pick between 'name.json' and its line-delimited 'name.jsonl' variant.
+
+    Returns:
+        str: Whichever of the two exists and was written last.
+    """
+    candidates = [path for path in [file_path, lines_path(file_path)] if os.path.exists(path)]
+    if not candidates:
+        return file_path
+    return max(candidates, key=os.path.getmtime)
+
+
+def iter_entries(file_path):
+    """
+    Stream the entries of a backup file, in whichever format was written last.
+
+    Yields:
+        The items of iter_json() for 'name.json', or the lines of 'name.jsonl'.
+    """
+    path = newest_path(file_path)
+    if path.endswith(".jsonl"):
+        return iter_json_lines(path)
+    return iter_json(path)
+
+
+def write_json_lines(file_path, entries):
+    with open(file_path, "w") as outfile:
+        for entry in entries:
+            outfile.write(json.dumps(entry, default=str) + "\n")
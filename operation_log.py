@@ -0,0 +1,92 @@
+import json, os, threading
+import restore_journal
+from datetime import datetime, timezone
+
+OPERATION_LOG_PATH = "output/OperationLog.jsonl"
+
+# Operations recorded by 2_idc_create_permsets.py and 6_idc_remap.py
+PERMISSION_SET = "CreatePermissionSet"
+PERMISSION_SET_PROVISIONING = "ProvisionPermissionSet"
+ACCOUNT_ASSIGNMENT = "CreateAccountAssignment"
+APPLICATION = "CreateApplication"
+APPLICATION_ASSIGNMENT = "CreateApplicationAssignment"
+GROUP_MEMBERSHIP = "CreateGroupMembership"
+
+
+class OperationLog:
+    """
+    Append-only log of everything a restore created in the target instance.
+
+    Unlike the RestoreJournal, which also records what already existed, the log
+    only holds the objects a create call returned, with the identifiers needed to
+    delete them again (ARNs, principal and account IDs, membership IDs) and the
+    request ID of asynchronous creates. rollback.py reads it to undo a restore.
+    Every record is fsync'd before the restore moves on, so nothing created can
+    be missed by a rollback after a crash.
+
+    The ARNs of the permission sets the restore created, in this run or an
+    earlier one, are kept in 'permission_sets': none of their account
+    assignments can predate the restore.
+    """
+
+    def __init__(self, path=OPERATION_LOG_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.permission_sets = {
+            record["PermissionSetArn"]
+            for record in iter_records(path)
+            if record["Operation"] == PERMISSION_SET
+        }
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        restore_journal.truncate_torn_line(path)
+        self.file = open(path, "a")
+
+    def record(self, operation, **identifiers):
+        """
+        Durably record a create.
+
+        Args:
+            operation (str): One of the operation constants of this module.
+            **identifiers: JSON-serializable identifiers of the created object.
+        """
+        line = json.dumps(
+            {
+                "Operation": operation,
+                "Time": datetime.now(timezone.utc).isoformat(),
+                **identifiers,
+            },
+            default=str,
+        )
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            if operation == PERMISSION_SET:
+                self.permission_sets.add(identifiers["PermissionSetArn"])
+
+    def close(self):
+        self.file.close()
+
+
+def iter_records(path=OPERATION_LOG_PATH):
+    """Yield the records of an operation log, in log order."""
+    if not os.path.exists(path):
+        return
+    with open(path, "r") as file:
+        for line in file:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # A torn last line from a crash
+                continue
+
+
+def read_log(path=OPERATION_LOG_PATH):
+    """
+    Returns:
+        dict: Operation -> list of its records, in log order.
+    """
+    operations = {}
+    for record in iter_records(path):
+        operations.setdefault(record["Operation"], []).append(record)
+    return operations
@@ -0,0 +1,88 @@
+import hashlib, json, os, shutil, threading
+
+POLICY_DIR = "policies"
+
+
+def canonical_document(document):
+    """
+    The canonical text of a policy document: keys sorted and no whitespace, so the
+    same policy formatted differently is stored once. Text that is not JSON is
+    kept as is.
+    """
+    try:
+        return json.dumps(json.loads(document), sort_keys=True, separators=(",", ":"))
+    except ValueError:
+        return document
+
+
+def document_hash(document):
+    """The hash a policy document is stored under, that of its canonical text."""
+    return hashlib.sha256(canonical_document(document).encode("utf-8")).hexdigest()
+
+
+class PolicyStore:
+    """
+    Content-addressed store of policy documents, e.g. the inline policies of the
+    permission sets.
+
+    Every document is written once to '<output>/policies/<hash[:2]>/<hash>.json',
+    under the SHA-256 of its canonical text, and the backup files only hold the
+    hash. Permission sets sharing an inline policy share its file, and a document
+    already in the store is not written again on the next export.
+
+    Note:
+        put() may be called from several threads.
+    """
+
+    def __init__(self, output_dir="output"):
+        self.path = os.path.join(output_dir, POLICY_DIR)
+        self.lock = threading.Lock()
+        self.written = 0
+        self.unchanged = 0
+
+    def document_path(self, document_hash):
+        return os.path.join(self.path, document_hash[:2], document_hash + ".json")
+
+    def put(self, document):
+        """
+        Store a policy document, unless the store already has it.
+
+        Returns:
+            str: The hash the document is stored under.
+        """
+        canonical = canonical_document(document)
+        document_hash = hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+        path = self.document_path(document_hash)
+        if os.path.exists(path):
+            with self.lock:
+                self.unchanged += 1
+            return document_hash
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write(canonical)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.written += 1
+        return document_hash
+
+    def get(self, document_hash):
+        """The policy document stored under a hash, in its canonical text."""
+        with open(self.document_path(document_hash), "r") as file:
+            return file.read()
+
+    def import_store(self, output_dir):
+        """
+        Copy the documents of another store, e.g. of an export shard, that this
+        one does not have yet.
+        """
+        source = os.path.join(output_dir, POLICY_DIR)
+        for directory, _, files in os.walk(source):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = self.document_path(name[: -len(".json")])
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    shutil.copyfile(os.path.join(directory, name), path)
+                    self.written += 1
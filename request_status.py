@@ -0,0 +1,169 @@
+import time
+
+# Asynchronous sso-admin requests: their list method, the key of the statuses in
+# its responses, their describe method, its request ID parameter and the key of
+# the status in its response
+ACCOUNT_ASSIGNMENT_CREATION = (
+    "list_account_assignment_creation_status",
+    "AccountAssignmentsCreationStatus",
+    "describe_account_assignment_creation_status",
+    "AccountAssignmentCreationRequestId",
+    "AccountAssignmentCreationStatus",
+)
+ACCOUNT_ASSIGNMENT_DELETION = (
+    "list_account_assignment_deletion_status",
+    "AccountAssignmentsDeletionStatus",
+    "describe_account_assignment_deletion_status",
+    "AccountAssignmentDeletionRequestId",
+    "AccountAssignmentDeletionStatus",
+)
+PERMISSION_SET_PROVISIONING = (
+    "list_permission_set_provisioning_status",
+    "PermissionSetsProvisioningStatus",
+    "describe_permission_set_provisioning_status",
+    "ProvisionPermissionSetRequestId",
+    "PermissionSetProvisioningStatus",
+)
+
+
+def list_statuses(client, instance_arn, kind, request_ids, oldest, **kwargs):
+    """
+    Resolve the status of requests with bulk list calls.
+
+    Pages through the listing of 'kind' until every request has been seen, so a
+    whole batch costs a few calls instead of one describe call per request. The
+    listing is newest first, so paging also stops at the first page ending before
+    'oldest': a request missing from the listing does not page through the whole
+    request history of the instance.
+
+    Args:
+        client: The sso-admin client.
+        instance_arn (str): The instance of the requests.
+        kind (tuple): One of the request kinds of this module.
+        request_ids (set): The requests to resolve.
+        oldest (datetime): When the oldest of them was created, at the latest.
+        **kwargs: Extra arguments of the list call, e.g. a status Filter.
+
+    Returns:
+        dict: Request ID -> status, for the requests that were listed.
+    """
+    list_method, key = kind[0], kind[1]
+    statuses = {}
+    kwargs = dict(kwargs, InstanceArn=instance_arn, MaxResults=100)
+    while True:
+        response = getattr(client, list_method)(**kwargs)
+        for status in response[key]:
+            if status["RequestId"] in request_ids:
+                statuses[status["RequestId"]] = status["Status"]
+        if (
+            len(statuses) == len(request_ids)
+            or "NextToken" not in response
+            or not response[key]
+            or response[key][-1]["CreatedDate"] < oldest
+        ):
+            return statuses
+        kwargs["NextToken"] = response["NextToken"]
+
+
+class RequestPoller:
+    """
+    In-flight asynchronous requests of one kind and instance, resolved in bulk.
+
+    poll() resolves them all with list_statuses(); only failed requests, and
+    requests still unresolved after 'timeout' seconds, are described one by one,
+    and a request still unresolved after 'max_wait' seconds is given up on and
+    reported as failed, so a request stuck IN_PROGRESS never blocks the caller.
+
+    Args:
+        client: The sso-admin client.
+        instance_arn (str): The instance of the requests.
+        kind (tuple): One of the request kinds of this module.
+        timeout (float): Seconds after which an unresolved request is described.
+        max_wait (float): Seconds after which an unresolved request is given up on.
+        poll_interval (float): Seconds between two describe calls of wait().
+    """
+
+    def __init__(self, client, instance_arn, kind, timeout, max_wait, poll_interval):
+        self.client = client
+        self.instance_arn = instance_arn
+        self.kind = kind
+        self.timeout = timeout
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.in_flight = {}  # request ID -> (item, submission time, CreatedDate)
+
+    def __len__(self):
+        return len(self.in_flight)
+
+    def add(self, status, item):
+        """
+        Track a request.
+
+        Args:
+            status (dict): The status returned by the call starting it, with its
+                RequestId and CreatedDate.
+            item: What the request is for, given back by poll().
+        """
+        self.in_flight[status["RequestId"]] = (item, time.monotonic(), status["CreatedDate"])
+
+    def describe(self, request_id):
+        return getattr(self.client, self.kind[2])(
+            InstanceArn=self.instance_arn, **{self.kind[3]: request_id}
+        )[self.kind[4]]
+
+    def poll(self):
+        """
+        Resolve the in-flight requests once.
+
+        Returns:
+            list: (item, status, failure reason) of the requests that finished,
+            status being "SUCCEEDED" or "FAILED". They are no longer tracked.
+        """
+        if not self.in_flight:
+            return []
+        statuses = list_statuses(
+            self.client,
+            self.instance_arn,
+            self.kind,
+            self.in_flight.keys(),
+            min(created for _, _, created in self.in_flight.values()),
+        )
+        finished = []
+        for request_id, (item, submitted, _) in list(self.in_flight.items()):
+            status = statuses.get(request_id)
+            waited = time.monotonic() - submitted
+            if status is None and waited > self.timeout:
+                status = self.describe(request_id)["Status"]
+            if status == "SUCCEEDED":
+                finished.append((item, status, None))
+            elif status == "FAILED":
+                finished.append((item, status, self.describe(request_id).get("FailureReason")))
+            elif waited > self.max_wait:
+                finished.append(
+                    (
+                        item,
+                        "FAILED",
+                        f"Request {request_id} still unresolved after {self.max_wait}s",
+                    )
+                )
+            else:
+                continue
+            del self.in_flight[request_id]
+        return finished
+
+    def wait(self, request_id):
+        """
+        Describe one request every 'poll_interval' seconds until it finishes, for
+        'max_wait' seconds at most, e.g. for a replayed operation.
+
+        Returns:
+            tuple: (status, failure reason), the status being "SUCCEEDED" or "FAILED".
+        """
+        submitted = time.monotonic()
+        while True:
+            status = self.describe(request_id)
+            if status["Status"] in ("SUCCEEDED", "FAILED"):
+                return status["Status"], status.get("FailureReason")
+            if time.monotonic() - submitted > self.max_wait:
+                return "FAILED", f"Request {request_id} still unresolved after {self.max_wait}s"
+            time.sleep(self.poll_interval)
@@ -0,0 +1,143 @@
+import csv, json, os
+
+ACCOUNT = "ACCOUNT"
+PERMISSION_SET = "PERMISSION_SET"
+PRINCIPAL = "PRINCIPAL"
+# Report column indexed for each kind of filter
+KEY_COLUMNS = {
+    ACCOUNT: "Account ID",
+    PERMISSION_SET: "Permission Set",
+    PRINCIPAL: "Principal",
+}
+
+
+def index_path(report_path):
+    return report_path + ".idx"
+
+
+def _source_stamp(report_path):
+    stat = os.stat(report_path)
+    return {"Size": stat.st_size, "MTime": stat.st_mtime_ns}
+
+
+def _parse_row(line):
+    return next(csv.reader([line.decode("utf-8")]))
+
+
+def build_index(report_path):
+    """
+    Build the sorted key index of an OldIdentityStoreReport.csv file.
+
+    The index has one line per (kind, key), e.g. (ACCOUNT, "123456789012"), with
+    the byte offsets of the report rows holding that key. Lines are sorted, so a
+    key is found by binary search without reading the whole index. The first line
+    records the size and modification time of the report it was built from.
+    """
+    entries = {}
+    with open(report_path, "rb") as report:
+        header = _parse_row(report.readline())
+        columns = {kind: header.index(column) for kind, column in KEY_COLUMNS.items()}
+        while True:
+            offset = report.tell()
+            line = report.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            row = _parse_row(line)
+            for kind, column in columns.items():
+                prefix = json.dumps([kind, row[column]])
+                entries.setdefault(prefix, []).append(offset)
+
+    path = index_path(report_path)
+    with open(path + ".tmp", "w") as index:
+        index.write("#" + json.dumps(_source_stamp(report_path)) + "\n")
+        for prefix in sorted(entries):
+            offsets = ",".join(str(offset) for offset in entries[prefix])
+            index.write(f"{prefix}\t{offsets}\n")
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def is_fresh(report_path):
+    """Check that the index exists and was built from the current report."""
+    try:
+        with open(index_path(report_path), "r") as index:
+            stamp = json.loads(index.readline()[1:])
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    return stamp == _source_stamp(report_path)
+
+
+def _line_at(index, position, start):
+    # The first complete line starting at or after 'position'
+    if position > start:
+        index.seek(position - 1)
+        index.readline()
+    else:
+        index.seek(start)
+    return index.readline()
+
+
+def lookup(index, kind, key):
+    """
+    Find the report offsets of one key with a binary search over the index file.
+
+    Args:
+        index: The index file, opened in binary mode.
+        kind (str): ACCOUNT, PERMISSION_SET or PRINCIPAL.
+        key (str): The account ID, permission set name or principal name.
+
+    Returns:
+        list: Byte offsets of the matching report rows.
+    """
+    target = json.dumps([kind, key]).encode("ascii")
+    index.seek(0)
+    index.readline()
+    start = index.tell()
+    low, high = start, os.fstat(index.fileno()).st_size
+    while low < high:
+        middle = (low + high) // 2
+        line = _line_at(index, middle, start)
+        if not line or line.split(b"\t", 1)[0] >= target:
+            high = middle
+        else:
+            low = middle + 1
+    line = _line_at(index, low, start)
+    prefix, _, offsets = line.rstrip(b"\n").partition(b"\t")
+    if prefix != target:
+        return []
+    return [int(offset) for offset in offsets.split(b",")]
+
+
+def select_rows(report_path, filters):
+    """
+    Read only the report rows matching the filters, through the index.
+
+    The index is rebuilt first if it is missing or older than the report. Rows
+    must match every kind of filter given, and any of the keys of a kind.
+
+    Args:
+        report_path (str): The OldIdentityStoreReport.csv file.
+        filters (dict): Kind -> iterable of keys, e.g. {ACCOUNT: ["123456789012"]}.
+
+    Returns:
+        list: The matching rows as dictionaries, in report order.
+    """
+    if not is_fresh(report_path):
+        print(f" -> Building the index of {report_path}...")
+        build_index(report_path)
+    selected = None
+    with open(index_path(report_path), "rb") as index:
+        for kind, keys in filters.items():
+            offsets = set()
+            for key in keys:
+                offsets.update(lookup(index, kind, key))
+            selected = offsets if selected is None else selected & offsets
+    rows = []
+    with open(report_path, "rb") as report:
+        header = _parse_row(report.readline())
+        for offset in sorted(selected or []):
+            report.seek(offset)
+            rows.append(dict(zip(header, _parse_row(report.readline()))))
+    return rows
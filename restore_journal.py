@@ -0,0 +1,172 @@
+import json, os, threading
+from datetime import datetime, timezone
+
+ACCOUNT_ASSIGNMENT = "ACCOUNT_ASSIGNMENT"
+APPLICATION = "APPLICATION"
+APPLICATION_ASSIGNMENT = "APPLICATION_ASSIGNMENT"
+GROUP_MEMBERSHIP = "GROUP_MEMBERSHIP"
+# Command line flag archiving a journal or dead-letter file written for another
+# target instance, instead of refusing to run, see check_target()
+NEW_TARGET_FLAG = "--new-target"
+
+
+class TargetMismatch(Exception):
+    """A journal or dead-letter file written for another target instance."""
+
+
+def truncate_torn_line(path):
+    """
+    Cut a torn last line, left by a crash in the middle of a write, back to the
+    last newline, so the next record appended starts on a line of its own instead
+    of being glued to the torn one and lost on the next load.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as file:
+        end = file.seek(0, os.SEEK_END)
+        if end == 0:
+            return
+        file.seek(end - 1)
+        if file.read(1) == b"\n":
+            return
+        position = end
+        while position > 0:
+            start = max(0, position - 4096)
+            file.seek(start)
+            newline = file.read(position - start).rfind(b"\n")
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+        file.truncate(position)
+
+
+def archive(path, reason):
+    """Move a file aside to '<name>.<reason>-<UTC time><extension>', if it exists."""
+    if os.path.exists(path):
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        base, extension = os.path.splitext(path)
+        os.replace(path, f"{base}.{reason}-{stamp}{extension}")
+
+
+def check_target(path, found, target, new_target=False):
+    """
+    Check that a file of completed or failed work was written for the target
+    instance, so nothing done in another instance, e.g. a test instance restored
+    first, is skipped or replayed in this one.
+
+    Args:
+        path (str): The journal or dead-letter file.
+        found (dict): The target of its header record, None for a file written
+            before headers were.
+        target (dict): The InstanceArn and IdentityStoreId of the target instance.
+        new_target (bool): Archive a file written for another target instead of
+            raising, the caller then starts a new one.
+
+    Returns:
+        bool: Whether the file was archived.
+
+    Raises:
+        TargetMismatch: If the file was written for another target, and not
+            new_target.
+    """
+    if found == target:
+        return False
+    if not new_target:
+        raise TargetMismatch(
+            f"{path} was written for {found or 'an unknown instance'}, not for the "
+            f"target {target}; run with {NEW_TARGET_FLAG} to archive it and start afresh"
+        )
+    archive(path, "other-target")
+    print(f"Archived {path}, written for {found or 'an unknown instance'}")
+    return True
+
+
+class RestoreJournal:
+    """
+    Append-only journal of the restore operations that completed.
+
+    Every completed operation is written as one JSON line and fsync'd before the
+    restore moves on, so a crash or an expired session never loses finished work.
+    On start, the journal is loaded into a set, so a re-run skips completed rows
+    with an O(1) lookup and no API calls.
+
+    Keys are tuples starting with the kind of operation, followed by the values
+    that identify it in the backup, e.g.
+    (ACCOUNT_ASSIGNMENT, account ID, permission set name, principal type, principal).
+
+    The keys do not name the target instance, so the first line of the journal is
+    a header record with its InstanceArn and IdentityStoreId, checked on load.
+    """
+
+    def __init__(self, path, target=None, new_target=False):
+        """
+        Args:
+            path (str): The journal file.
+            target (dict, optional): The InstanceArn and IdentityStoreId of the
+                target instance, see check_target().
+            new_target (bool): Archive a journal written for another target
+                instead of raising TargetMismatch.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.completed = set()
+        self.details = {}
+        found, records = None, 0
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn last line from a crash, the operation is redone
+                        continue
+                    records += 1
+                    if "Target" in record:
+                        found = record["Target"]
+                        continue
+                    if "Key" not in record:
+                        continue
+                    key = tuple(record.pop("Key"))
+                    self.completed.add(key)
+                    if record:
+                        self.details[key] = record
+        if target is not None and records and check_target(path, found, target, new_target):
+            self.completed, self.details, records = set(), {}, 0
+        truncate_torn_line(path)
+        self.file = open(path, "a")
+        if target is not None and not records:
+            self._write({"Target": target})
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, default=str) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def __contains__(self, key):
+        return key in self.completed
+
+    def __len__(self):
+        return len(self.completed)
+
+    def get(self, key):
+        """The extra values recorded with a completed operation, see record()."""
+        return self.details.get(key, {})
+
+    def record(self, key, **details):
+        """
+        Durably record a completed operation.
+
+        Args:
+            key (tuple): The key of the operation, see the class docstring.
+            **details: Extra JSON-serializable values to keep with the record,
+                e.g. the ARN of a created application.
+        """
+        with self.lock:
+            self._write({"Key": list(key), **details})
+            self.completed.add(key)
+            if details:
+                self.details[key] = details
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,316 @@
+import json
+import policy_store
+from concurrent.futures import ThreadPoolExecutor
+
+PLAN_PATH = "output/RestorePlan.json"
+# Fields of a permission set compared besides its policies, see settings_drift()
+PERMISSION_SET_SETTINGS = [
+    "SessionDuration",
+    "RelayState",
+    "InlinePolicyHash",
+    "PermissionsBoundary",
+    "Tags",
+]
+
+
+def paginate(method, key, **kwargs):
+    response = method(**kwargs)
+    items = list(response[key])
+    while "NextToken" in response:
+        response = method(NextToken=response["NextToken"], **kwargs)
+        items.extend(response[key])
+    return items
+
+
+def fetch_permission_set(client, instance_arn, permission_set_arn):
+    details = client.describe_permission_set(
+        InstanceArn=instance_arn, PermissionSetArn=permission_set_arn
+    )["PermissionSet"]
+    managed = paginate(
+        client.list_managed_policies_in_permission_set,
+        "AttachedManagedPolicies",
+        InstanceArn=instance_arn,
+        PermissionSetArn=permission_set_arn,
+    )
+    customer_managed = paginate(
+        client.list_customer_managed_policy_references_in_permission_set,
+        "CustomerManagedPolicyReferences",
+        InstanceArn=instance_arn,
+        PermissionSetArn=permission_set_arn,
+    )
+    inline_policy = client.get_inline_policy_for_permission_set(
+        InstanceArn=instance_arn, PermissionSetArn=permission_set_arn
+    ).get("InlinePolicy")
+    try:
+        boundary = client.get_permissions_boundary_for_permission_set(
+            InstanceArn=instance_arn, PermissionSetArn=permission_set_arn
+        ).get("PermissionsBoundary")
+    except client.exceptions.ResourceNotFoundException:
+        boundary = None
+    tags = paginate(
+        client.list_tags_for_resource,
+        "Tags",
+        InstanceArn=instance_arn,
+        ResourceArn=permission_set_arn,
+    )
+    return details["Name"], {
+        "PermissionSetArn": permission_set_arn,
+        "SessionDuration": details.get("SessionDuration"),
+        "RelayState": details.get("RelayState"),
+        "ManagedPolicies": managed,
+        "CustomerManagedPolicies": customer_managed,
+        # Hashed like the backup, see policy_store
+        "InlinePolicyHash": (
+            policy_store.document_hash(inline_policy) if inline_policy else None
+        ),
+        "PermissionsBoundary": boundary,
+        "Tags": tags,
+    }
+
+
+def fetch_permission_set_assignments(client, instance_arn, permission_set_arn):
+    assignments = []
+    for account_id in paginate(
+        client.list_accounts_for_provisioned_permission_set,
+        "AccountIds",
+        InstanceArn=instance_arn,
+        PermissionSetArn=permission_set_arn,
+    ):
+        assignments.extend(
+            paginate(
+                client.list_account_assignments,
+                "AccountAssignments",
+                InstanceArn=instance_arn,
+                AccountId=account_id,
+                PermissionSetArn=permission_set_arn,
+            )
+        )
+    return assignments
+
+
+def fetch_target_state(client, instance_arn, workers=16):
+    """
+    Prefetch the current state of the target IdC instance into in-memory indexes.
+
+    Permission sets, their policies and their account assignments are fetched
+    concurrently, one permission set per worker.
+
+    Returns:
+        dict: {
+            "PermissionSets": name -> {PermissionSetArn, ManagedPolicies,
+                CustomerManagedPolicies and the PERMISSION_SET_SETTINGS},
+            "Assignments": set of (account ID, permission set name, principal type,
+                principal ID),
+            "Applications": name -> application ARN,
+        }
+    """
+    permission_set_arns = paginate(
+        client.list_permission_sets, "PermissionSets", InstanceArn=instance_arn
+    )
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        permission_sets = dict(
+            executor.map(
+                lambda arn: fetch_permission_set(client, instance_arn, arn),
+                permission_set_arns,
+            )
+        )
+        names = {ps["PermissionSetArn"]: name for name, ps in permission_sets.items()}
+        assignments = set()
+        for permission_set_assignments in executor.map(
+            lambda arn: fetch_permission_set_assignments(client, instance_arn, arn),
+            permission_set_arns,
+        ):
+            for assignment in permission_set_assignments:
+                assignments.add(
+                    (
+                        assignment["AccountId"],
+                        names[assignment["PermissionSetArn"]],
+                        assignment["PrincipalType"],
+                        assignment["PrincipalId"],
+                    )
+                )
+    applications = {
+        application["Name"]: application["ApplicationArn"]
+        for application in paginate(
+            client.list_applications, "Applications", InstanceArn=instance_arn
+        )
+    }
+    return {
+        "PermissionSets": permission_sets,
+        "Assignments": assignments,
+        "Applications": applications,
+    }
+
+
+def policy_names(permission_set):
+    managed = {policy["Arn"] for policy in permission_set["ManagedPolicies"] or []}
+    customer_managed = {
+        (policy.get("Path", "/"), policy["Name"])
+        for policy in permission_set["CustomerManagedPolicies"] or []
+    }
+    return managed, customer_managed
+
+
+def normalize_setting(field, value):
+    # Tags as a dict, a boundary reference with its default path, and unset as None
+    if field == "Tags":
+        return {tag["Key"]: tag["Value"] for tag in value or []}
+    if field == "PermissionsBoundary" and value and "CustomerManagedPolicyReference" in value:
+        reference = value["CustomerManagedPolicyReference"]
+        return {
+            "CustomerManagedPolicyReference": {
+                "Name": reference["Name"],
+                "Path": reference.get("Path", "/"),
+            }
+        }
+    return value or None
+
+
+def settings_drift(old_permission_set, new_permission_set):
+    """
+    The PERMISSION_SET_SETTINGS that differ between a permission set of the backup
+    and the same one in the target. Fields missing from an older backup are not
+    compared.
+
+    Returns:
+        dict: Field -> (backup value, target value), normalized.
+    """
+    drift = {}
+    for field in PERMISSION_SET_SETTINGS:
+        if field not in old_permission_set:
+            continue
+        old = normalize_setting(field, old_permission_set[field])
+        new = normalize_setting(field, new_permission_set.get(field))
+        if old != new:
+            drift[field] = (old, new)
+    return drift
+
+
+def compute_plan(old_assignments, old_permission_sets, old_applications, entities, target):
+    """
+    Compute the operations needed to bring the target in line with the backup.
+
+    Both sides are reduced to sets keyed by names from the backup (permission set
+    and application names) and principal IDs from the target identity store, so the
+    plan is a plain set difference.
+
+    Args:
+        old_assignments (list): Rows of OldIdentityStoreReport.csv.
+        old_permission_sets (dict): Content of OldPermissionSets.json.
+        old_applications (iterable): Applications of OldApplications.json.
+        entities (dict): Principal name -> {"id", "type"} in the target identity store.
+        target (dict): The result of fetch_target_state().
+
+    Returns:
+        dict: Creates, updates, deletes and no-op counts per kind of entity.
+    """
+    target_permission_sets = target["PermissionSets"]
+    permission_set_updates = []
+    for name in old_permission_sets.keys() & target_permission_sets.keys():
+        old_managed, old_customer = policy_names(old_permission_sets[name])
+        new_managed, new_customer = policy_names(target_permission_sets[name])
+        drift = settings_drift(old_permission_sets[name], target_permission_sets[name])
+        old_tags, new_tags = drift.pop("Tags", ({}, {}))
+        if (
+            (old_managed, old_customer) != (new_managed, new_customer)
+            or drift
+            or old_tags != new_tags
+        ):
+            permission_set_updates.append(
+                {
+                    "Name": name,
+                    "AttachManagedPolicies": sorted(old_managed - new_managed),
+                    "DetachManagedPolicies": sorted(new_managed - old_managed),
+                    "AttachCustomerManagedPolicies": sorted(old_customer - new_customer),
+                    "DetachCustomerManagedPolicies": sorted(new_customer - old_customer),
+                    # Backup value of every other differing field, None when unset
+                    "Settings": {field: old for field, (old, _) in drift.items()},
+                    "TagResource": [
+                        {"Key": key, "Value": value}
+                        for key, value in sorted(old_tags.items())
+                        if new_tags.get(key) != value
+                    ],
+                    "UntagResource": sorted(new_tags.keys() - old_tags.keys()),
+                }
+            )
+
+    wanted, unresolved = {}, []
+    for row in old_assignments:
+        principal = entities.get(row["Principal"])
+        if principal is None:
+            unresolved.append(row)
+            continue
+        key = (
+            row["Account ID"],
+            row["Permission Set"],
+            row["Principal Type"],
+            principal["id"],
+        )
+        wanted[key] = row
+    names = {entity["id"]: name for name, entity in entities.items()}
+    assignment_deletes = [
+        {
+            "Account ID": account_id,
+            "Permission Set": permission_set,
+            "Principal Type": principal_type,
+            "Principal": names.get(principal_id),
+            "PrincipalId": principal_id,
+        }
+        for account_id, permission_set, principal_type, principal_id in sorted(
+            target["Assignments"] - wanted.keys()
+        )
+    ]
+
+    old_application_names = {
+        application["ApplicationDetails"]["Name"] for application in old_applications
+    }
+    return {
+        "PermissionSets": {
+            "Create": sorted(old_permission_sets.keys() - target_permission_sets.keys()),
+            "Update": sorted(permission_set_updates, key=lambda update: update["Name"]),
+            "Delete": sorted(target_permission_sets.keys() - old_permission_sets.keys()),
+            "NoOp": len(old_permission_sets.keys() & target_permission_sets.keys())
+            - len(permission_set_updates),
+        },
+        "PermissionSetArns": {
+            name: permission_set["PermissionSetArn"]
+            for name, permission_set in target_permission_sets.items()
+        },
+        "AccountAssignments": {
+            "Create": [
+                row for key, row in wanted.items() if key not in target["Assignments"]
+            ],
+            "Delete": assignment_deletes,
+            "NoOp": len(wanted.keys() & target["Assignments"]),
+            "Unresolved": unresolved,
+        },
+        "Applications": {
+            "Create": sorted(old_application_names - target["Applications"].keys()),
+            "Delete": sorted(
+                target["Applications"][name]
+                for name in target["Applications"].keys() - old_application_names
+            ),
+            "NoOp": len(old_application_names & target["Applications"].keys()),
+        },
+    }
+
+
+def summarize_plan(plan):
+    for kind in ["PermissionSets", "AccountAssignments", "Applications"]:
+        changes = plan[kind]
+        counts = ", ".join(
+            f"{len(value) if isinstance(value, list) else value} {action.lower()}"
+            for action, value in changes.items()
+        )
+        print(f"\t-> {kind}: {counts}")
+
+
+def write_plan(plan, path=PLAN_PATH):
+    with open(path, "w") as outfile:
+        # default=dict writes compact report rows like CSV rows
+        json.dump(plan, outfile, indent=2, default=dict)
+
+
+def load_plan(path=PLAN_PATH):
+    with open(path, "r") as file:
+        return json.load(file)
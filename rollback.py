@@ -0,0 +1,353 @@
+import argparse, glob, json, os, time
+import boto3
+import idc_clients
+import idc_metrics
+import operation_log
+import request_status
+import restore_journal
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# Undo a restore: deletes everything 2_idc_create_permsets.py and 6_idc_remap.py
+# logged as created in output/OperationLog.jsonl, in dependency order. Account
+# assignments go before their permission sets and application assignments before
+# their applications; the two chains and the group memberships run at the same time.
+DEFAULT_REGION = "eu-west-1"
+# Delete calls made in parallel, per kind of object
+ROLLBACK_WORKERS = 32
+# Account assignment deletion requests kept in flight at once, resolved in bulk
+# with list_account_assignment_deletion_status
+DELETIONS_IN_FLIGHT = 200
+# Seconds between two bulk status polls of the in-flight requests
+STATUS_POLL_INTERVAL = 2
+# Seconds after which an unresolved request is described individually
+STATUS_TIMEOUT = 60
+# Seconds after which a request still unresolved is given up on, and its
+# assignment kept in the log
+STATUS_MAX_WAIT = 600
+# Minutes a logged record may be written after its request was created, by the
+# service's clock, when looking for the failed creations among the requests
+CLOCK_SKEW_MINUTES = 5
+# Restore state made stale by a rollback, see 6_idc_remap.py
+JOURNAL_PATH = "output/RestoreJournal.jsonl"
+DEAD_LETTER_DIR = "output/deadletters"
+
+session = boto3.Session(
+    aws_access_key_id="",
+    aws_secret_access_key="",
+)
+
+ssoadminclient = idc_clients.create_client(
+    session, "sso-admin", DEFAULT_REGION, workers=2 * ROLLBACK_WORKERS
+)
+idstoreclient = idc_clients.create_client(
+    session, "identitystore", DEFAULT_REGION, workers=ROLLBACK_WORKERS
+)
+
+
+def delete(call, record, **kwargs):
+    """
+    Make one delete call for a logged record, run by the rollback workers.
+
+    Returns:
+        tuple: (record, error message), the error being None when the object is
+        deleted or already gone.
+    """
+    try:
+        call(**kwargs)
+        return record, None
+    except Exception as e:
+        if idc_clients.error_code(e) == "ResourceNotFoundException":
+            return record, None
+        return record, str(e)
+
+
+def delete_all(name, records, deleter):
+    """Run 'deleter' on every record, ROLLBACK_WORKERS at a time, and report the failures."""
+    with idc_metrics.phase(f"delete_{name}"), ThreadPoolExecutor(
+        max_workers=ROLLBACK_WORKERS
+    ) as executor:
+        results = list(executor.map(deleter, records))
+    failed = []
+    for record, error in results:
+        if error:
+            print(f"Error deleting {record_label(record)}: {error}")
+            failed.append(record)
+    print(f" -> Deleted {len(records) - len(failed)} {name.replace('_', ' ')}, {len(failed)} failed")
+    return failed
+
+
+def record_label(record):
+    return " ".join(
+        str(value)
+        for key, value in record.items()
+        if key not in ("Time", "InstanceArn", "TargetType", "RequestId")
+    )
+
+
+def failed_creations(records):
+    """
+    The request IDs of logged account assignment creations that FAILED, with bulk
+    list calls, so nothing is deleted for them.
+
+    Only the FAILED requests created since the oldest record was logged are
+    listed, not the whole creation history of the instance.
+    """
+    failed = set()
+    for instance_arn in {record["InstanceArn"] for record in records}:
+        instance_records = [record for record in records if record["InstanceArn"] == instance_arn]
+        failed.update(
+            request_status.list_statuses(
+                ssoadminclient,
+                instance_arn,
+                request_status.ACCOUNT_ASSIGNMENT_CREATION,
+                {record["RequestId"] for record in instance_records},
+                min(datetime.fromisoformat(record["Time"]) for record in instance_records)
+                - timedelta(minutes=CLOCK_SKEW_MINUTES),
+                Filter={"Status": "FAILED"},
+            )
+        )
+    return failed
+
+
+def assignment_target(record):
+    return {
+        key: record[key]
+        for key in [
+            "InstanceArn",
+            "TargetId",
+            "TargetType",
+            "PermissionSetArn",
+            "PrincipalType",
+            "PrincipalId",
+        ]
+    }
+
+
+def start_deletion(record):
+    """
+    Returns:
+        tuple: (record, deletion request status or None, error message or None).
+    """
+    try:
+        response = ssoadminclient.delete_account_assignment(**assignment_target(record))
+        return record, response["AccountAssignmentDeletionStatus"], None
+    except Exception as e:
+        if idc_clients.error_code(e) == "ResourceNotFoundException":
+            return record, None, None
+        return record, None, str(e)
+
+
+def delete_account_assignments(records):
+    """
+    Delete the logged account assignments, keeping DELETIONS_IN_FLIGHT requests in
+    flight.
+
+    Deletion requests are started ROLLBACK_WORKERS at a time and resolved in bulk
+    every STATUS_POLL_INTERVAL seconds by a request_status.RequestPoller per
+    instance: only failed requests, and requests still unresolved after
+    STATUS_TIMEOUT seconds, are described one by one, and a request still
+    unresolved after STATUS_MAX_WAIT seconds counts as failed.
+
+    Returns:
+        list: The records that could not be deleted.
+    """
+    failed_requests = failed_creations(records)
+    targets = {}
+    for record in records:
+        if record["RequestId"] not in failed_requests:
+            targets.setdefault(tuple(assignment_target(record).values()), record)
+    pending = list(targets.values())
+    pollers = {
+        instance_arn: request_status.RequestPoller(
+            ssoadminclient,
+            instance_arn,
+            request_status.ACCOUNT_ASSIGNMENT_DELETION,
+            STATUS_TIMEOUT,
+            STATUS_MAX_WAIT,
+            STATUS_POLL_INTERVAL,
+        )
+        for instance_arn in {record["InstanceArn"] for record in pending}
+    }
+    deleted, failures = 0, []
+    start = time.monotonic()
+
+    def in_flight():
+        return sum(len(poller) for poller in pollers.values())
+
+    with idc_metrics.phase("delete_account_assignments"), ThreadPoolExecutor(
+        max_workers=ROLLBACK_WORKERS
+    ) as executor:
+        while pending or in_flight():
+            batch = pending[: DELETIONS_IN_FLIGHT - in_flight()]
+            pending = pending[len(batch) :]
+            for record, status, error in executor.map(start_deletion, batch):
+                if error:
+                    print(f"Error deleting {record_label(record)}: {error}")
+                    failures.append(record)
+                elif status:
+                    pollers[record["InstanceArn"]].add(status, record)
+                else:
+                    deleted += 1
+            if not in_flight():
+                continue
+
+            with idc_metrics.phase("status_poll_sleep"):
+                time.sleep(STATUS_POLL_INTERVAL)
+            for poller in pollers.values():
+                for record, status, failure_reason in poller.poll():
+                    if status == "SUCCEEDED":
+                        deleted += 1
+                    else:
+                        print(f"Error deleting {record_label(record)}: {failure_reason}")
+                        failures.append(record)
+
+    elapsed = time.monotonic() - start
+    print(
+        f" -> Deleted {deleted} account assignments, {len(failures)} failed, "
+        f"{len(records) - len(targets)} never created "
+        f"({(deleted + len(failures)) / max(elapsed, 0.001):.1f} assignments/s)"
+    )
+    return failures
+
+
+def delete_permission_sets(records):
+    return delete_all(
+        "permission_sets",
+        records,
+        lambda record: delete(
+            ssoadminclient.delete_permission_set,
+            record,
+            InstanceArn=record["InstanceArn"],
+            PermissionSetArn=record["PermissionSetArn"],
+        ),
+    )
+
+
+def delete_application_assignments(records):
+    return delete_all(
+        "application_assignments",
+        records,
+        lambda record: delete(
+            ssoadminclient.delete_application_assignment,
+            record,
+            ApplicationArn=record["ApplicationArn"],
+            PrincipalId=record["PrincipalId"],
+            PrincipalType=record["PrincipalType"],
+        ),
+    )
+
+
+def delete_applications(records):
+    return delete_all(
+        "applications",
+        records,
+        lambda record: delete(
+            ssoadminclient.delete_application, record, ApplicationArn=record["ApplicationArn"]
+        ),
+    )
+
+
+def delete_group_memberships(records):
+    return delete_all(
+        "group_memberships",
+        records,
+        lambda record: delete(
+            idstoreclient.delete_group_membership,
+            record,
+            IdentityStoreId=record["IdentityStoreId"],
+            MembershipId=record["MembershipId"],
+        ),
+    )
+
+
+def delete_with_dependents(delete_dependents, dependents, delete_parents, parents, key):
+    """
+    Delete the dependents, then the parents none of whose dependents failed.
+
+    Returns:
+        list: The dependents that failed and the parents kept because of them.
+    """
+    failed = delete_dependents(dependents)
+    kept = {record[key] for record in failed}
+    return (
+        failed
+        + delete_parents([record for record in parents if record[key] not in kept])
+        + [record for record in parents if record[key] in kept]
+    )
+
+
+def rollback(path=operation_log.OPERATION_LOG_PATH):
+    """
+    Delete everything logged in an operation log, in dependency order.
+
+    Permission sets are only deleted once their account assignments are, and
+    applications once their assignments are; a permission set or an application
+    whose dependents could not all be deleted is kept. Permission set provisioning
+    needs no undo, it goes with the permission set.
+
+    Returns:
+        list: The records that could not be deleted, kept in the log by main so
+        the rollback can be run again.
+    """
+    operations = operation_log.read_log(path)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        chains = [
+            executor.submit(
+                delete_with_dependents,
+                delete_account_assignments,
+                operations.get(operation_log.ACCOUNT_ASSIGNMENT, []),
+                delete_permission_sets,
+                operations.get(operation_log.PERMISSION_SET, []),
+                "PermissionSetArn",
+            ),
+            executor.submit(
+                delete_with_dependents,
+                delete_application_assignments,
+                operations.get(operation_log.APPLICATION_ASSIGNMENT, []),
+                delete_applications,
+                operations.get(operation_log.APPLICATION, []),
+                "ApplicationArn",
+            ),
+            executor.submit(
+                delete_group_memberships, operations.get(operation_log.GROUP_MEMBERSHIP, [])
+            ),
+        ]
+        return [record for chain in chains for record in chain.result()]
+
+
+# MAIN
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Delete everything a restore created, from its operation log."
+    )
+    parser.add_argument("--log", default=operation_log.OPERATION_LOG_PATH)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only count what would be deleted"
+    )
+    arguments = parser.parse_args()
+
+    if not os.path.exists(arguments.log):
+        raise SystemExit(f"{arguments.log} not found, there is nothing to roll back")
+    if arguments.dry_run:
+        for operation, records in sorted(operation_log.read_log(arguments.log).items()):
+            print(f"{operation}: {len(records)}")
+    else:
+        idc_metrics.enable("rollback")
+        start = time.monotonic()
+        failed = rollback(arguments.log)
+        if failed:
+            # Only what is left, so running the rollback again finishes it
+            with open(arguments.log + ".tmp", "w") as file:
+                for record in failed:
+                    file.write(json.dumps(record, default=str) + "\n")
+            os.replace(arguments.log + ".tmp", arguments.log)
+            raise SystemExit(
+                f"{len(failed)} objects could not be deleted, they are kept in {arguments.log}"
+            )
+        # The journal and the dead letters describe a restore that no longer exists
+        restore_journal.archive(arguments.log, "rolledback")
+        restore_journal.archive(JOURNAL_PATH, "rolledback")
+        for path in glob.glob(os.path.join(DEAD_LETTER_DIR, "*.jsonl")):
+            os.remove(path)
+        print(f"Done! The restore has been rolled back in {time.monotonic() - start:.1f}s")
@@ -0,0 +1,228 @@
+import csv, hashlib, json, os, sys, threading
+from datetime import datetime, timezone
+
+SNAPSHOT_DIR = "output/snapshots"
+# Entities older than this are re-fetched even if their fingerprint is unchanged,
+# because IdC exposes no modification timestamps to fingerprint with.
+SNAPSHOT_MAX_AGE_HOURS = 24 * 7
+
+PERMISSION_SET = "PermissionSet"
+APPLICATION = "Application"
+ACCOUNT_ASSIGNMENTS = "AccountAssignments"
+KINDS = [PERMISSION_SET, APPLICATION, ACCOUNT_ASSIGNMENTS]
+
+REPORT_HEADERS = [
+    "Account ID",
+    "Account Name",
+    "Permission Set",
+    "Principal Type",
+    "Principal",
+]
+
+
+def ContentHash(obj):
+    """
+    Return the SHA-256 hash of the canonical JSON form of an object.
+
+    Keys are sorted and datetimes are serialized as strings, so the same content
+    always produces the same hash.
+    """
+    canonical = json.dumps(obj, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class SnapshotStore:
+    """
+    Content-addressed store of backup entities with one manifest per run.
+
+    Each entity (a permission set, an application or the assignment set of an
+    account) is stored once under the hash of its content in 'objects/'. A run
+    records, for every entity key, its cheap fingerprint, content hash and fetch
+    time in a manifest under 'manifests/'. The manifest of the previous run is
+    used to decide which entities can be kept without being fetched again.
+
+    Note:
+        Put() and Keep() may be called from several threads.
+    """
+
+    def __init__(self, path=SNAPSHOT_DIR):
+        self.path = path
+        self.lock = threading.Lock()
+        self.previous = LoadManifest(path)
+        self.entries = {kind: {} for kind in KINDS}
+        self.written = 0
+        os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(path, "manifests"), exist_ok=True)
+
+    def IsFresh(self, kind, key, fingerprint):
+        """
+        Check whether an entity can be kept from the previous snapshot.
+
+        Returns:
+            bool: True if the entity exists with the same fingerprint and was
+            fetched less than SNAPSHOT_MAX_AGE_HOURS ago.
+        """
+        if self.previous is None:
+            return False
+        entry = self.previous["Entities"][kind].get(key)
+        if entry is None or entry["Fingerprint"] != ContentHash(fingerprint):
+            return False
+        fetched = datetime.fromisoformat(entry["FetchedAt"])
+        age = datetime.now(timezone.utc) - fetched
+        return age.total_seconds() < SNAPSHOT_MAX_AGE_HOURS * 3600
+
+    def Keep(self, kind, key):
+        """Carry an entity over from the previous snapshot, if it has one."""
+        if self.previous is None or key not in self.previous["Entities"][kind]:
+            return
+        with self.lock:
+            self.entries[kind][key] = self.previous["Entities"][kind][key]
+
+    def Put(self, kind, key, fingerprint, content):
+        """Store a freshly fetched entity, writing its object only if it is new."""
+        contentHash = ContentHash(content)
+        objectPath = self.ObjectPath(contentHash)
+        if not os.path.exists(objectPath):
+            os.makedirs(os.path.dirname(objectPath), exist_ok=True)
+            tmpPath = f"{objectPath}.{threading.get_ident()}.tmp"
+            with open(tmpPath, "w") as fp:
+                json.dump(content, fp, default=str)
+            os.replace(tmpPath, objectPath)
+            with self.lock:
+                self.written += 1
+        with self.lock:
+            self.entries[kind][key] = {
+                "Fingerprint": ContentHash(fingerprint),
+                "Hash": contentHash,
+                "FetchedAt": datetime.now(timezone.utc).isoformat(),
+            }
+
+    def Reorder(self, kind, keys):
+        """Sort the entries of a kind by the given key order, e.g. report order."""
+        position = {key: index for index, key in enumerate(keys)}
+        with self.lock:
+            self.entries[kind] = dict(
+                sorted(
+                    self.entries[kind].items(),
+                    key=lambda item: position.get(item[0], len(position)),
+                )
+            )
+
+    def ObjectPath(self, contentHash):
+        return os.path.join(self.path, "objects", contentHash[:2], contentHash + ".json")
+
+    def Delta(self):
+        """
+        Compare this run with the previous snapshot.
+
+        Returns:
+            dict: For each entity kind, the keys that were added, changed or removed.
+        """
+        delta = {}
+        for kind in KINDS:
+            before = self.previous["Entities"][kind] if self.previous else {}
+            after = self.entries[kind]
+            delta[kind] = {
+                "Added": [key for key in after if key not in before],
+                "Changed": [
+                    key
+                    for key in after
+                    if key in before and after[key]["Hash"] != before[key]["Hash"]
+                ],
+                "Removed": [key for key in before if key not in after],
+            }
+        return delta
+
+    def Commit(self):
+        """
+        Write the manifest of this run and make it the latest snapshot.
+
+        Returns:
+            str: The path of the manifest that was written.
+        """
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+        manifest = {
+            "CreatedAt": datetime.now(timezone.utc).isoformat(),
+            "Previous": self.previous["Name"] if self.previous else None,
+            "Name": timestamp,
+            "Entities": self.entries,
+            "Delta": self.Delta(),
+        }
+        manifestPath = os.path.join(self.path, "manifests", timestamp + ".json")
+        with open(manifestPath, "w") as fp:
+            json.dump(manifest, fp, indent=2)
+        with open(os.path.join(self.path, "LATEST"), "w") as fp:
+            fp.write(timestamp)
+        return manifestPath
+
+
+def LoadManifest(path=SNAPSHOT_DIR, name=None):
+    """
+    Load a manifest from the store.
+
+    Args:
+        path (str): The snapshot store directory.
+        name (str, optional): The manifest name. Defaults to the latest one.
+
+    Returns:
+        dict: The manifest, or None if the store has no snapshot yet.
+    """
+    if name is None:
+        latestPath = os.path.join(path, "LATEST")
+        if not os.path.exists(latestPath):
+            return None
+        with open(latestPath) as fp:
+            name = fp.read().strip()
+    with open(os.path.join(path, "manifests", name + ".json")) as fp:
+        return json.load(fp)
+
+
+def LoadObject(contentHash, path=SNAPSHOT_DIR):
+    with open(
+        os.path.join(path, "objects", contentHash[:2], contentHash + ".json")
+    ) as fp:
+        return json.load(fp)
+
+
+def Materialize(path=SNAPSHOT_DIR, name=None, outputDir="output"):
+    """
+    Rebuild the canonical backup files from a snapshot manifest.
+
+    Writes 'OldIdentityStoreReport.csv', 'OldPermissionSets.json' and
+    'OldApplications.json' in the same format as a full run of 1_old_idc_report.py,
+    so the restore scripts can consume an incremental backup unchanged.
+    """
+    manifest = LoadManifest(path, name)
+    entities = manifest["Entities"]
+
+    with open(os.path.join(outputDir, "OldIdentityStoreReport.csv"), "w") as report:
+        csvwriter = csv.writer(report)
+        csvwriter.writerow(REPORT_HEADERS)
+        for entry in entities[ACCOUNT_ASSIGNMENTS].values():
+            csvwriter.writerows(LoadObject(entry["Hash"], path))
+
+    permissionSetsData = {}
+    for entry in entities[PERMISSION_SET].values():
+        permissionSet = LoadObject(entry["Hash"], path)
+        permissionSetsData.update({permissionSet["Name"]: permissionSet["Data"]})
+    with open(os.path.join(outputDir, "OldPermissionSets.json"), "w") as fp:
+        json.dump(permissionSetsData, fp)
+
+    applications = [
+        LoadObject(entry["Hash"], path) for entry in entities[APPLICATION].values()
+    ]
+    with open(os.path.join(outputDir, "OldApplications.json"), "w") as fp:
+        json.dump(applications, fp, indent=2)
+    print(f"Done! Snapshot {manifest['Name']} materialized into '{outputDir}'")
+
+
+# MAIN
+if __name__ == "__main__":
+    # Usage: python snapshot_store.py [instance output directory] [manifest name]
+    outputDir, name = "output", None
+    for argument in sys.argv[1:]:
+        if os.path.isdir(argument):
+            outputDir = argument
+        else:
+            name = argument
+    Materialize(os.path.join(outputDir, "snapshots"), name, outputDir)